@@ -10,12 +10,43 @@ try:
 except ImportError:
     # For backward compatibility with Python2
     from collections import Sequence
+from collections import deque
+from collections import OrderedDict
+import codecs
+import errno
+import io
+import itertools
+import mmap
+import multiprocessing
+import os
 import re
+import select
+import shutil
 import six
 import socket
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import unicodedata
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:
+    # For backward compatibility with Python < 3.11
+    import sre_constants
+    import sre_parse
+try:
+    import selectors
+except ImportError:
+    # For backward compatibility with Python < 3.4
+    selectors = None
+try:
+    import asyncio
+except ImportError:
+    # For backward compatibility with Python < 3.4
+    asyncio = None
 
 
 __version__ = '0.3.0'
@@ -67,6 +98,65 @@ class ExpectTimeout(Exception):
     """Exception raised when *expect* call exceeds a timeout."""
 
 
+class ExpectEOF(ExpectTimeout):
+    """Exception raised when the end of a finite stream is reached.
+
+    Raised by adapters that can tell that no more data will arrive, such as
+    :class:`MmapReplayAdapter` and :class:`FdStreamAdapter`, rather than
+    waiting out the timeout. As no match can be found once the stream has
+    ended, it is a subclass of `ExpectTimeout`.
+    """
+
+
+class SearchState(object):
+    """Progress of a resumable search over a growing buffer.
+
+    A *SearchState* records how much of a buffer has already been examined by
+    a :class:`Searcher` without finding a match. Passing the same state to
+    successive calls of :func:`Searcher.resume` allows the searcher to skip
+    over data it has already seen, so that a buffer which grows a little at a
+    time is not rescanned from the beginning on every call.
+
+    States are created by :func:`Searcher.search_state` and are only valid for
+    the *Searcher* that created them.
+    """
+
+    def __init__(self, reset_on_discard=False):
+        """
+        :param bool reset_on_discard: If ``True``, removing data from the
+            front of the buffer forces the next search to start over from the
+            beginning of the buffer.
+        """
+        self.scanned = 0
+        # No item before this index is examined by the next search
+        self.resume_from = 0
+        # Number of items examined by the last search, if recorded
+        self.examined = None
+        self.reset_on_discard = reset_on_discard
+
+    def __repr__(self):
+        return '{}(scanned={})'.format(self.__class__.__name__, self.scanned)
+
+    def discard(self, count):
+        """Account for *count* items removed from the front of the buffer.
+
+        :param int count: Number of items removed from the front of the buffer
+            since the last search.
+        """
+        if self.reset_on_discard:
+            self.scanned = 0
+            self.resume_from = 0
+        else:
+            self.scanned = max(0, self.scanned - int(count))
+            self.resume_from = max(0, self.resume_from - int(count))
+
+    def _shift(self, count):
+        """Account for *count* items added back to the front of the buffer,
+        after they were discarded while the state was not reset"""
+        self.scanned += count
+        self.resume_from += count
+
+
 class Searcher(object):
     """Base class for searching buffers.
 
@@ -80,43 +170,104 @@ class Searcher(object):
     the *search* method must match the type returned by the *match_type*
     property, and *search* must raise a `TypeError` if it does not. The
     member function :func:`_check_type` exists to provide this functionality
-    for subclass implementations.
+    for subclass implementations. Where the *match_type* is binary, any object
+    supporting the buffer protocol, such as a `bytearray` or `memoryview`, is
+    also accepted, so that received data can be searched without copying it.
+
+    Searchers may also support resumable searching through the
+    :func:`search_state` and :func:`resume` methods, and searching part of a
+    buffer without copying it through the *start* and *end* arguments of
+    *search*. The default implementations simply search the entire buffer (or
+    a slice of it) each time.
     """
 
     def __repr__(self):
         return '{}()'.format(self.__class__.__name__)
 
-    def search(self, buf):
+    def search(self, buf, start=0, end=None):
         """Search the provided buffer for a *match*.
 
         Search the provided buffer for a *match*. What exactly a *match* means
         is defined by the *Searcher* implementation. If the *match* is found,
         returns an `SequenceMatch` object, otherwise returns ``None``.
 
+        If *start* or *end* is given, ``buf[start:end]`` is searched as if it
+        had been passed on its own, and the offsets of the match are relative
+        to *start*. Implementations are not required to accept these
+        arguments; :func:`resume` slices the buffer for those that do not.
+
         :param buf: Buffer to search for a match.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search, or
+            ``None`` to search to the end of *buf*.
         """
         raise NotImplementedError('search function must be provided')
 
+    def search_state(self):
+        """Create a new :class:`SearchState` for use with :func:`resume`."""
+        return SearchState()
+
+    def resume(self, buf, state, start=0, end=None):
+        """Search the provided buffer, skipping data already examined.
+
+        Behaves like :func:`search`, but uses *state* to avoid rescanning the
+        part of ``buf[start:end]`` that was examined by previous calls.
+        Between calls, the searched part of *buf* may only grow at the end; if
+        data is removed from its front, either by removing it from *buf* or by
+        increasing *start*, :func:`SearchState.discard` must be called before
+        the next search. If the *match* is found, returns a `SequenceMatch`
+        object, otherwise returns ``None``.
+
+        :param buf: Buffer to search for a match.
+        :param SearchState state: State created by :func:`search_state`.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search, or
+            ``None`` to search to the end of *buf*.
+        """
+        buf = _plain_buffer(buf, start, end)
+        match = self.search(buf)
+        state.examined = len(buf)
+        if match is None:
+            state.scanned = len(buf)
+        return match
+
     @property
     def match_type(self):
         """Read-only property that returns type matched by this *Searcher*"""
         raise NotImplementedError('match_type must be provided')
 
+    @property
+    def max_match_length(self):
+        """Read-only property that returns the maximum number of items a
+        *match* can span, or ``None`` if it is not bounded or not known.
+
+        An :class:`Expecter` with *trim_history* enabled uses this to decide
+        how much of its history to keep while waiting for a match.
+        """
+        return None
+
     def _check_type(self, value):
         """Checks that *value* matches the type of this *Searcher*.
 
         Checks that *value* matches the type of this *Searcher*, returning the
-        value if it does and raising a `TypeError` if it does not.
+        value if it does and raising a `TypeError` if it does not. Objects
+        supporting the buffer protocol match a binary *match_type*.
 
         :return: *value* if type of *value* matches type of this *Searcher*.
         :raises TypeError: if type of *value* does not match the type of this
             *Searcher*
         """
-        if not isinstance(value, self.match_type):
-            raise TypeError('Type ' + str(type(value)) + ' does not match '
-                            'expected type ' + str(self.match_type))
-        else:
+        if isinstance(value, self.match_type):
             return value
+        if self.match_type is six.binary_type and \
+                not isinstance(value, six.text_type):
+            try:
+                memoryview(value)
+                return value
+            except TypeError:
+                pass
+        raise TypeError('Type ' + str(type(value)) + ' does not match '
+                        'expected type ' + str(self.match_type))
 
 
 class BytesSearcher(Searcher):
@@ -129,13 +280,18 @@ class BytesSearcher(Searcher):
     Python 3, it will fail on strings, as strings are Unicode by default. In
     Python 2 this class will fail on the Unicode type, as strings are ASCII by
     default.
+
+    Buffers such as `bytearray`, `memoryview` and `mmap` may be searched
+    directly. The *match* is a slice of the searched buffer, so searching a
+    `memoryview` returns a view of the matching bytes rather than a copy.
     """
 
     def __init__(self, b):
         """
         :param b: Bytes to search for. Must be a binary type (i.e. bytes)
         """
-        self._bytes = self._check_type(b)
+        self._bytes = _to_bytes(self._check_type(b))
+        self._escaped = None
 
     def __repr__(self):
         return '{}({!r})'.format(self.__class__.__name__, self._bytes)
@@ -144,22 +300,66 @@ class BytesSearcher(Searcher):
     def match_type(self):
         return six.binary_type
 
-    def search(self, buf):
+    @property
+    def max_match_length(self):
+        return len(self._bytes)
+
+    def search(self, buf, start=0, end=None):
         """Search the provided buffer for matching bytes.
 
         Search the provided buffer for matching bytes. If the *match* is found,
         returns a :class:`SequenceMatch` object, otherwise returns ``None``.
 
         :param buf: Buffer to search for a match.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
+        :return: :class:`SequenceMatch` if matched, None if no match was found.
+        """
+        self._check_type(buf)
+        start, end = _bounds(buf, start, end)
+        return self._find(buf, start, start, end)
+
+    def resume(self, buf, state, start=0, end=None):
+        """Search the provided buffer for matching bytes, skipping old data.
+
+        Only the data after the previously scanned portion of the buffer, plus
+        enough of the scanned portion to hold a match that straddles the two,
+        is searched.
+
+        :param buf: Buffer to search for a match.
+        :param SearchState state: State created by :func:`search_state`.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
         :return: :class:`SequenceMatch` if matched, None if no match was found.
         """
-        idx = self._check_type(buf).find(self._bytes)
+        self._check_type(buf)
+        start, end = _bounds(buf, start, end)
+        overlap = max(len(self._bytes) - 1, 0)
+        begin = start + max(0, state.scanned - overlap)
+        state.examined = end - begin
+        match = self._find(buf, begin, start, end)
+        if match is None:
+            state.scanned = end - start
+            state.resume_from = max(0, state.scanned - overlap)
+        return match
+
+    def _find(self, buf, begin, start, end):
+        find = getattr(buf, 'find', None)
+        if find is not None:
+            idx = find(self._bytes, begin, end)
+        else:
+            # Buffers without a find method, such as memoryview, can still be
+            # searched by the regex engine
+            if self._escaped is None:
+                self._escaped = re.compile(re.escape(self._bytes))
+            match = self._escaped.search(buf, begin, end)
+            idx = -1 if match is None else match.start()
         if idx < 0:
             return None
         else:
-            start = idx
-            end = idx + len(self._bytes)
-            return SequenceMatch(self, buf[start:end], start, end)
+            stop = idx + len(self._bytes)
+            return SequenceMatch(self, buf[idx:stop], idx - start,
+                                 stop - start)
 
 
 class TextSearcher(Searcher):
@@ -194,18 +394,48 @@ class TextSearcher(Searcher):
     def match_type(self):
         return six.text_type
 
-    def search(self, buf):
+    @property
+    def max_match_length(self):
+        """The length of the normalized text.
+
+        A match in text that is not normalized may span more characters, but
+        never more than this many ASCII characters.
+        """
+        return len(self._text)
+
+    def search(self, buf, start=0, end=None):
         """Search the provided buffer for matching text.
 
         Search the provided buffer for matching text. If the *match* is found,
         returns a :class:`SequenceMatch` object, otherwise returns ``None``.
+        The *start* and *end* of the match are indexes into *buf*, not into
+        its normalized form.
+
+        :param buf: Buffer to search for a match.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
+        :return: :class:`SequenceMatch` if matched, None if no match was found.
+        """
+        return self.resume(buf, self.search_state(), start, end)
+
+    def resume(self, buf, state, start=0, end=None):
+        """Search the provided buffer for matching text, skipping old data.
+
+        Only the text received since the previous call, plus enough of the
+        preceding text to hold a straddling match, is normalized and searched.
 
         :param buf: Buffer to search for a match.
+        :param SearchState state: State created by :func:`search_state`.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
         :return: :class:`SequenceMatch` if matched, None if no match was found.
         """
         self._check_type(buf)
-        normalized = unicodedata.normalize(self.FORM, buf)
-        idx = normalized.find(self._text)
+        return _resume_normalized(buf, state, self.FORM, len(self._text),
+                                  self._find, start, end)
+
+    def _find(self, normalized, begin):
+        idx = normalized.find(self._text, begin)
         if idx < 0:
             return None
         start = idx
@@ -213,6 +443,117 @@ class TextSearcher(Searcher):
         return SequenceMatch(self, normalized[start:end], start, end)
 
 
+# Matches runs of characters that may change when normalized
+_NON_ASCII = re.compile(u'[^\x00-\x7f]+')
+# Matches characters that normalize to themselves and never combine with the
+# characters before them: ASCII, CJK ideographs and Hangul syllables
+_STABLE = re.compile(u'[\x00-\x7f\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7a3]')
+
+
+def _resume_normalized(buf, state, form, max_width, find, start=0, end=None):
+    """Resume a search over the normalized form of a text buffer.
+
+    Normalizing part of a buffer gives the same result as normalizing the
+    whole buffer, provided the part starts at a stable character, such as an
+    ASCII character, which is unchanged by normalization and never combines
+    with the characters before it. The state therefore records the index of a
+    stable character, before which the buffer cannot change as more text
+    arrives, as the index from which the next search resumes. Only the text
+    received since the previous search is examined for stable characters.
+
+    :param buf: Text buffer to search.
+    :param SearchState state: State of the search.
+    :param form: Unicode normalization form.
+    :param int max_width: Maximum length of a normalized match.
+    :param find: Function called with the normalized text and an index to
+        start searching from, returning a :class:`SequenceMatch` with offsets
+        into the normalized text or ``None``.
+    :param int start: Index of the first item of *buf* to search.
+    :param int end: Index after the last item of *buf* to search.
+    :return: :class:`SequenceMatch` with offsets into ``buf[start:end]`` or
+        ``None``.
+    """
+    start, end = _bounds(buf, start, end)
+    scanned = start + state.scanned
+    begin = start + min(state.resume_from, state.scanned)
+    state.examined = end - begin
+    region = buf[begin:end]
+    match = find(unicodedata.normalize(form, region), 0)
+    if match is None:
+        # Searching the reversed text finds the last stable characters
+        reverse = region[::-1]
+        last = _STABLE.search(reverse, 0, end - scanned)
+        if last is not None:
+            # Each stable character starts at least one normalized character,
+            # so backing up over enough of them before the last one covers a
+            # straddling match. With too few of them, the next search starts
+            # from the same index as this one.
+            count = max(max_width - 1, 0)
+            first = last
+            if count:
+                first = next(itertools.islice(
+                    _STABLE.finditer(reverse, last.end()), count - 1, None),
+                    None)
+            if first is not None:
+                state.resume_from = end - 1 - first.start() - start
+        state.scanned = end - start
+        return None
+    first, last = _map_normalized(region, form, match.start, match.end)
+    first += begin
+    last += begin
+    return SequenceMatch(match.searcher, buf[first:last], first - start,
+                         last - start)
+
+
+def _map_normalized(text, form, start, end):
+    """Map a span of the normalized form of *text* to a span of *text*.
+
+    ASCII text maps one-to-one. Each run of other characters is normalized
+    together with the ASCII character before it, which it may combine with,
+    and a span boundary falling inside such a piece is mapped to the point
+    that splits the piece into two separately normalized halves. If there is
+    no such point, the span is widened to cover the whole piece.
+    """
+    pos = 0
+    npos = 0
+    span = [None, None]
+    for run in _NON_ASCII.finditer(text):
+        piece = max(run.start() - 1, pos)
+        # ASCII text before the piece maps one-to-one
+        for i, target in enumerate((start, end)):
+            if span[i] is None and target <= npos + piece - pos:
+                span[i] = pos + target - npos
+        npos += piece - pos
+        original = text[piece:run.end()]
+        normalized = unicodedata.normalize(form, original)
+        for i, target, default in ((0, start, 0), (1, end, len(original))):
+            if span[i] is None and target <= npos + len(normalized):
+                split = _split_normalized(original, form, normalized,
+                                          target - npos)
+                span[i] = piece + (default if split is None else split)
+        pos = run.end()
+        npos += len(normalized)
+        if span[1] is not None:
+            return span[0], span[1]
+    for i, target in enumerate((start, end)):
+        if span[i] is None:
+            span[i] = pos + target - npos
+    return span[0], span[1]
+
+
+def _split_normalized(original, form, normalized, target):
+    """Find where *original* splits to give *normalized* split at *target*"""
+    if target == len(normalized):
+        return len(original)
+    for idx in range(len(original) + 1):
+        if unicodedata.normalize(form, original[:idx]) == \
+                normalized[:target] and \
+                unicodedata.normalize(form, original[idx:]) == \
+                normalized[target:]:
+            return idx
+    return None
+
+
 class RegexSearcher(Searcher):
     """Regular expression searcher.
 
@@ -234,6 +575,7 @@ class RegexSearcher(Searcher):
         """
         super(RegexSearcher, self).__init__()
         self._regex = re.compile(pattern, regex_options)
+        self._max_width, self._anchored = _regex_width(self._regex)
 
     def __repr__(self):
         return '{}(re.compile({!r}))'.format(self.__class__.__name__,
@@ -243,7 +585,16 @@ class RegexSearcher(Searcher):
     def match_type(self):
         return type(self._regex.pattern)
 
-    def search(self, buf):
+    @property
+    def max_match_length(self):
+        """The maximum match length of the regex, from its parse tree.
+
+        ``None`` if the length is unbounded, for example due to a "*"
+        repeat, or if the regex contains lookahead or lookbehind assertions.
+        """
+        return self._max_width
+
+    def search(self, buf, start=0, end=None):
         """Search the provided buffer for a match to the object's regex.
 
         Search the provided buffer for a match to the object's regex. If the
@@ -251,13 +602,114 @@ class RegexSearcher(Searcher):
         returns ``None``.
 
         :param buf: Buffer to search for a match.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
+        :return: :class:`RegexMatch` if matched, None if no match was found.
+        """
+        return self.resume(buf, self.search_state(), start, end)
+
+    def search_state(self):
+        # Anchors like "^" and "\b" can match differently once the front of
+        # the buffer is removed, so discarding data restarts the search.
+        return SearchState(reset_on_discard=self._anchored)
+
+    def resume(self, buf, state, start=0, end=None):
+        """Search the buffer for the object's regex, skipping old data.
+
+        If the regex has a bounded match length, only the data after the
+        previously scanned portion of the buffer, plus enough of the scanned
+        portion to hold a straddling match, is searched. Regexes with an
+        unbounded match length, or containing lookahead or lookbehind
+        assertions, always search the entire buffer.
+
+        :param buf: Buffer to search for a match.
+        :param SearchState state: State created by :func:`search_state`.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
         :return: :class:`RegexMatch` if matched, None if no match was found.
         """
-        match = self._regex.search(self._check_type(buf))
+        self._check_type(buf)
+        return _resume_regex(self, buf, state, start, end)
+
+    def _resume_at(self, buf, state, start, pos, end=None):
+        self._check_type(buf)
+        return _resume_regex(self, buf, state, start, end, pos)
+
+    def _find(self, buf, begin, start, end):
+        match = self._regex.search(buf, begin, end)
         if match is not None:
-            start = match.start()
-            end = match.end()
-            return RegexMatch(self, buf[start:end], start, end, match.groups())
+            first, last = match.span()
+            return RegexMatch(self, buf[first:last], first - start,
+                              last - start, match.groups())
+
+
+def _regex_opcodes(node):
+    """Recursively yield the opcodes of a parsed regex"""
+    if isinstance(node, sre_parse.SubPattern):
+        for op, av in node:
+            yield op
+            for x in _regex_opcodes(av):
+                yield x
+    elif isinstance(node, (list, tuple)):
+        for item in node:
+            for x in _regex_opcodes(item):
+                yield x
+
+
+def _regex_width(regex):
+    """Determine the maximum match length of a compiled regex.
+
+    Returns a tuple of the maximum number of items a match can span (or
+    ``None`` if it is unbounded or cannot be determined) and whether the
+    regex contains anchors or assertions, such as "^", "\b" or "(?<=a)",
+    which look at the items around a match.
+    """
+    parsed = sre_parse.parse(regex.pattern, regex.flags)
+    opcodes = set(_regex_opcodes(parsed))
+    asserts = opcodes & set([sre_constants.ASSERT, sre_constants.ASSERT_NOT])
+    anchored = sre_constants.AT in opcodes or bool(asserts)
+    if asserts:
+        return None, anchored
+    hi = parsed.getwidth()[1]
+    if hi >= sre_constants.MAXREPEAT:
+        return None, anchored
+    return int(hi), anchored
+
+
+def _resume_regex(searcher, buf, state, start, end, pos=None):
+    """Resume a regex search of ``buf[start:end]``.
+
+    *searcher* provides the maximum match width and whether the regex is
+    anchored, and a *_find* method called with the buffer, the index to start
+    searching from and the bounds of the searched part of the buffer.
+
+    If *pos* is given, only ``buf[pos:end]`` is searched, but anchors and
+    assertions still see the items from *start*. Match offsets and the state
+    are then relative to *pos*.
+    """
+    start, end = _bounds(buf, start, end)
+    pos = start if pos is None else min(max(pos, start), end)
+    if start and searcher._anchored:
+        # Anchors and lookbehind assertions would see the items before start
+        buf = buf[start:end]
+        start, end, pos = 0, end - start, pos - start
+    begin = pos
+    if searcher._max_width is not None:
+        # One extra item covers anchors that look at the next item
+        begin += max(0, state.scanned - searcher._max_width - 1)
+    state.examined = end - begin
+    match = searcher._find(buf, begin, pos, end)
+    if match is None:
+        state.scanned = end - pos
+        if searcher._max_width is not None and not searcher._anchored:
+            state.resume_from = max(0, state.scanned - searcher._max_width - 1)
+    return match
+
+
+def _bounds(buf, start, end):
+    """Convert *start* and *end* into indexes of *buf*, as slicing would"""
+    start, end, _ = slice(start, end).indices(len(buf))
+    return start, max(start, end)
 
 
 def _flatten(n):
@@ -280,12 +732,38 @@ class SearcherCollection(Searcher, list):
 
     Note that this class requires that all of its sub-searchers have the same
     *match_type*.
+
+    When every sub-searcher is a :class:`BytesSearcher` or every sub-searcher
+    is a :class:`TextSearcher`, and the literals all begin with the same
+    prefix, they are combined into a single regex alternation, so that one
+    pass over the buffer finds the earliest match of any of them. The regex
+    engine skips quickly to each occurrence of the shared prefix, but
+    otherwise tries every alternative at each position, so literals without
+    a shared prefix are searched for one at a time, which is usually faster.
+    *fuse_literals* overrides this choice.
+
+    If *fuse_regex* is enabled, :class:`RegexSearcher` sub-searchers
+    (optionally mixed with :class:`BytesSearcher` sub-searchers) are combined
+    the same way, provided they use the same regex options and do not contain
+    backreferences or conflicting group names. Combining regexes helps most
+    when they begin with literal text, which lets the regex engine skip
+    quickly over positions where none of them can match.
     """
 
-    def __init__(self, *searchers):
+    def __init__(self, *searchers, **kwargs):
         """
         :param searchers: One or more :class:`Searcher` implementations.
+        :param bool fuse_regex: If ``True``, combine compatible
+            :class:`RegexSearcher` sub-searchers into a single regex.
+        :param bool fuse_literals: If ``True``, always combine literal
+            sub-searchers into a single regex, and if ``False``, never. By
+            default they are combined if they share a prefix.
         """
+        self.fuse_regex = kwargs.pop('fuse_regex', False)
+        self.fuse_literals = kwargs.pop('fuse_literals', None)
+        if kwargs:
+            raise TypeError('unexpected keyword argument ' +
+                            repr(next(iter(kwargs))))
         super(SearcherCollection, self).__init__()
         self.extend(_flatten(searchers))
         if not self:
@@ -309,6 +787,8 @@ class SearcherCollection(Searcher, list):
             raise ValueError(self.__class__.__name__ + ' requires that all '
                              'sub-searchers implement the same match_type')
         self._match_type = match_type
+        self._alternation_members = None
+        self._alternation = None
 
     def __repr__(self):
         return '{}({!r})'.format(self.__class__.__name__, list(self))
@@ -317,7 +797,14 @@ class SearcherCollection(Searcher, list):
     def match_type(self):
         return self._match_type
 
-    def search(self, buf):
+    @property
+    def max_match_length(self):
+        """The largest maximum match length of the sub-searchers, or ``None``
+        if that of any sub-searcher is ``None``."""
+        lengths = [getattr(x, 'max_match_length', None) for x in self]
+        return None if None in lengths else max(lengths)
+
+    def search(self, buf, start=0, end=None):
         """Search the provided buffer for a match to any sub-searchers.
 
         Search the provided buffer for a match to any of this collection's
@@ -327,18 +814,284 @@ class SearcherCollection(Searcher, list):
         ``None``.
 
         :param buf: Buffer to search for a match.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
         :return: :class:`RegexMatch` if matched, None if no match was found.
         """
         self._check_type(buf)
+        alternation = self._get_alternation()
+        if alternation is not None:
+            return alternation.search(buf, start, end)
         best_match = None
         best_index = sys.maxsize
         for searcher in self:
-            match = searcher.search(buf)
+            # Sub-searchers that do not accept offsets search a slice
+            match = _resume(searcher, buf, _search_state(searcher), start, end)
+            if match and match.start < best_index:
+                best_match = match
+                best_index = match.start
+        return best_match
+
+    def search_state(self):
+        alternation = self._get_alternation()
+        if alternation is not None:
+            return alternation.search_state()
+        return _CollectionSearchState([_search_state(x) for x in self])
+
+    def resume(self, buf, state, start=0, end=None):
+        """Search the provided buffer for any sub-searchers, skipping old data.
+
+        Each sub-searcher resumes its own search, so only data that a
+        particular sub-searcher has not yet examined is searched.
+
+        :param buf: Buffer to search for a match.
+        :param SearchState state: State created by :func:`search_state`.
+        :param int start: Index of the first item of *buf* to search.
+        :param int end: Index after the last item of *buf* to search.
+        :return: :class:`RegexMatch` if matched, None if no match was found.
+        """
+        return self._resume_at(buf, state, start, start, end)
+
+    def _resume_at(self, buf, state, start, pos, end=None):
+        self._check_type(buf)
+        if not isinstance(state, _CollectionSearchState):
+            return self._get_alternation()._resume_at(buf, state, start, pos,
+                                                      end)
+        best_match = None
+        best_index = sys.maxsize
+        for searcher, substate in zip(self, state.states):
+            match = _resume(searcher, buf, substate, start, end, pos)
             if match and match.start < best_index:
                 best_match = match
                 best_index = match.start
+        # All of the sub-searchers search up to the same end
+        state.examined = max(getattr(x, 'examined', None) or 0
+                             for x in state.states)
+        if best_match is None:
+            state.resume_from = min(getattr(x, 'resume_from', 0)
+                                    for x in state.states)
         return best_match
 
+    def _get_alternation(self):
+        """Return the combined searcher for the current sub-searchers.
+
+        Returns ``None`` if the sub-searchers cannot be combined. The result
+        is rebuilt whenever the list of sub-searchers, *fuse_regex* or
+        *fuse_literals* is modified.
+        """
+        members = (self.fuse_regex, self.fuse_literals) + tuple(self)
+        if members != self._alternation_members:
+            self._alternation_members = members
+            self._alternation = _Alternation.create(
+                members[2:], self.fuse_regex, self.fuse_literals)
+        return self._alternation
+
+
+class _Alternation(object):
+    """Finds the earliest match of several searchers in a single pass.
+
+    The patterns of the searchers are combined into one regex alternation.
+    The regex engine finds the earliest position where any pattern matches,
+    which is also where :class:`SearcherCollection` would find its match by
+    searching with each searcher in turn. The match is then attributed to the
+    first searcher, in collection order, that matches at that position.
+
+    The alternatives are deliberately not wrapped in capturing groups, as
+    doing so stops the regex engine from skipping ahead using the literal
+    prefix shared by the alternatives.
+    """
+
+    # Flags that change how an escaped literal matches
+    LITERAL_FLAGS = re.IGNORECASE | re.VERBOSE
+
+    def __init__(self, searchers, pattern, flags, normalize):
+        self.searchers = searchers
+        self._regex = re.compile(pattern, flags)
+        self._normalize = normalize
+        widths = [x.max_match_length for x in searchers]
+        self._max_width = None if None in widths else max(widths)
+        self._anchored = any(type(x) is RegexSearcher and x._anchored
+                             for x in searchers)
+
+    @classmethod
+    def create(cls, searchers, fuse_regex=False, fuse_literals=None):
+        """Combine *searchers*, or return ``None`` if they cannot be, or are
+        not to be."""
+        if len(searchers) < 2:
+            return None
+        kinds = set(type(x) for x in searchers)
+        if kinds == set([TextSearcher]):
+            literals = [x._text for x in searchers]
+            if not cls._fuse_literals(literals, fuse_literals):
+                return None
+            pattern = u'|'.join(u'(?:' + re.escape(x) + u')'
+                                for x in literals)
+            return cls(searchers, pattern, 0, True)
+        if kinds == set([BytesSearcher]):
+            literals = [x._bytes for x in searchers]
+            if not cls._fuse_literals(literals, fuse_literals):
+                return None
+            pattern = b'|'.join(b'(?:' + re.escape(x) + b')'
+                                for x in literals)
+            return cls(searchers, pattern, 0, False)
+        if fuse_regex and RegexSearcher in kinds and \
+                kinds <= set([RegexSearcher, BytesSearcher]):
+            return cls._create_regex(searchers)
+        return None
+
+    @staticmethod
+    def _fuse_literals(literals, fuse_literals):
+        """Decide whether to combine *literals*"""
+        if fuse_literals is not None:
+            return fuse_literals
+        # Without a prefix to skip to, the regex engine tries every
+        # alternative at every position, which is slower than searching for
+        # each literal in turn
+        return bool(os.path.commonprefix(literals))
+
+    @classmethod
+    def _create_regex(cls, searchers):
+        regexes = [x._regex for x in searchers if type(x) is RegexSearcher]
+        flags = regexes[0].flags
+        if any(x.flags != flags for x in regexes):
+            return None
+        if len(regexes) != len(searchers) and flags & cls.LITERAL_FLAGS:
+            return None
+        for regex in regexes:
+            # Numbered references would point at the wrong group once the
+            # regexes are combined
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+            if set(_regex_opcodes(parsed)) & set([
+                    sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS]):
+                return None
+        if isinstance(regexes[0].pattern, six.text_type):
+            join, open_, close = u'|', u'(?:', u')'
+        else:
+            join, open_, close = b'|', b'(?:', b')'
+        pieces = []
+        for searcher in searchers:
+            if type(searcher) is RegexSearcher:
+                pieces.append(searcher._regex.pattern)
+            else:
+                pieces.append(re.escape(searcher._bytes))
+        pattern = join.join(open_ + x + close for x in pieces)
+        try:
+            return cls(searchers, pattern, flags, False)
+        except re.error:
+            # For example, the same group name used in two of the regexes
+            return None
+
+    def search(self, buf, start=0, end=None):
+        return self.resume(buf, self.search_state(), start, end)
+
+    def search_state(self):
+        # As with RegexSearcher, anchors cannot be adjusted for discarded data
+        return SearchState(reset_on_discard=self._anchored)
+
+    def resume(self, buf, state, start=0, end=None):
+        if self._normalize:
+            return _resume_normalized(buf, state, TextSearcher.FORM,
+                                      self._max_width, self._find, start, end)
+        return _resume_regex(self, buf, state, start, end)
+
+    def _resume_at(self, buf, state, start, pos, end=None):
+        if self._normalize:
+            # Only literals are combined, which look at no other items
+            return self.resume(buf, state, pos, end)
+        return _resume_regex(self, buf, state, start, end, pos)
+
+    def _find(self, buf, begin, start=0, end=None):
+        if end is None:
+            end = len(buf)
+        match = self._regex.search(buf, begin, end)
+        if match is None:
+            return None
+        first = match.start()
+        for searcher in self.searchers:
+            if type(searcher) is RegexSearcher:
+                match = searcher._regex.match(buf, first, end)
+                if match is not None:
+                    last = match.end()
+                    return RegexMatch(searcher, buf[first:last], first - start,
+                                      last - start, match.groups())
+                continue
+            literal = searcher._text if self._normalize else searcher._bytes
+            last = first + len(literal)
+            # Compare slices, as not every buffer type has startswith
+            if last <= end and buf[first:last] == literal:
+                return SequenceMatch(searcher, buf[first:last], first - start,
+                                     last - start)
+
+
+class _CollectionSearchState(SearchState):
+    """:class:`SearchState` holding one state for each sub-searcher"""
+
+    def __init__(self, states):
+        # The sub-states are not all reset when data is discarded, but none
+        # of them can be shifted back once one of them has been
+        super(_CollectionSearchState, self).__init__(
+            any(getattr(x, 'reset_on_discard', True) for x in states))
+        self.states = states
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.states)
+
+    def discard(self, count):
+        super(_CollectionSearchState, self).discard(count)
+        for state in self.states:
+            state.discard(count)
+
+    def _shift(self, count):
+        super(_CollectionSearchState, self)._shift(count)
+        for state in self.states:
+            state._shift(count)
+
+
+def _search_state(searcher):
+    """Create a search state for any object implementing *search*"""
+    return getattr(searcher, 'search_state', SearchState)()
+
+
+def _resume(searcher, buf, state, start=0, end=None, pos=None):
+    """Resume a search, falling back to *search* for minimal searchers
+
+    If *pos* is given, the search begins at that index, while searchers that
+    look at the items around a match, such as anchored regexes, still see the
+    items from *start*. Match offsets are then relative to *pos*.
+    """
+    if pos is not None:
+        resume_at = getattr(searcher, '_resume_at', None)
+        if resume_at is not None:
+            return resume_at(buf, state, start, pos, end)
+        start = pos
+    resume = getattr(searcher, 'resume', None)
+    if resume is None:
+        buf = _plain_buffer(buf, start, end)
+        if isinstance(state, SearchState):
+            state.examined = len(buf)
+        return searcher.search(buf)
+    return resume(buf, state, start, end)
+
+
+def _plain_buffer(buf, start, end):
+    """Prepare ``buf[start:end]`` for a searcher without offset support.
+
+    Such searchers are also not expected to handle buffer types other than
+    the binary type, so a `bytearray` or `memoryview` is copied into one.
+    """
+    if start or end is not None:
+        buf = buf[start:end]
+    if isinstance(buf, (bytearray, memoryview)):
+        buf = _to_bytes(buf)
+    return buf
+
+
+def _to_bytes(buf):
+    """Return the binary type holding the contents of bytes-like *buf*"""
+    if isinstance(buf, six.binary_type):
+        return buf
+    return memoryview(buf).tobytes()
+
 
 class StreamAdapter(object):
     """Adapter to match varying stream objects to a single interface.
@@ -396,8 +1149,63 @@ class StreamAdapter(object):
                                   '.poll must be implemented')
 
 
+class _AdaptiveReader(object):
+    """Reads from a stream, adapting the read size.
+
+    Each read asks *read* (such as *recv* or *read*) for up to the current
+    read size, which starts at *max_read*. If a *max_read_limit* is given,
+    the read size doubles after each read that comes back full, up to
+    *max_read_limit*, so that bulk data takes fewer reads and allocations.
+    It halves after each read that fills less than a quarter of it, down to
+    *max_read* again.
+
+    Reading into a reusable buffer with *recv_into* or *readinto* would
+    still have to copy the data out into a new bytes object for each read,
+    as callers such as :class:`ThreadedStreamAdapter` keep the chunks, so
+    the data is read into the bytes object directly.
+    """
+
+    def __init__(self, read):
+        self.read_func = read
+        self.read_size = 0
+
+    def read(self, max_read, max_read_limit=None):
+        """Read up to the current read size, and adapt the read size.
+
+        Returns whatever the underlying read returns when nothing is read
+        (``None`` or an empty sequence), otherwise the data read.
+        """
+        limit = max(max_read_limit or max_read, max_read)
+        size = min(max(self.read_size, max_read), limit)
+        data = self.read_func(size)
+        if data:
+            count = len(data)
+            if count >= size:
+                size = min(size * 2, limit)
+            elif count < size // 4:
+                size = max(size // 2, max_read)
+        self.read_size = size
+        return data
+
+
 class PollingStreamAdapterMixin(object):
-    """Add *poll_period* and *max_read* properties to a `StreamAdapter`"""
+    """Add *poll_period* and *max_read* properties to a `StreamAdapter`
+
+    By default the stream is polled every *poll_period* seconds. Setting
+    *min_poll_period* enables adaptive polling: after data is received the
+    stream is polled every *min_poll_period* seconds, and each poll that
+    receives nothing multiplies the period by *poll_backoff*, up to a maximum
+    of *poll_period*. This keeps latency low while data is flowing without
+    polling an idle stream too often.
+
+    Similarly, setting *max_read_limit* lets the amount read at one time grow
+    from *max_read* up to *max_read_limit* while reads keep coming back full.
+    """
+
+    _max_read_limit = None
+    _min_poll_period = None
+    _poll_backoff = 2.0
+    _current_poll_period = None
 
     @property
     def poll_period(self):
@@ -410,6 +1218,46 @@ class PollingStreamAdapterMixin(object):
             raise ValueError('poll_period must be greater than 0')
         self._poll_period = value
 
+    @property
+    def min_poll_period(self):
+        return self._min_poll_period
+
+    @min_poll_period.setter
+    def min_poll_period(self, value):
+        if value is not None:
+            value = float(value)
+            if value <= 0:
+                raise ValueError('min_poll_period must be greater than 0')
+        self._min_poll_period = value
+        self._current_poll_period = value
+
+    @property
+    def poll_backoff(self):
+        return self._poll_backoff
+
+    @poll_backoff.setter
+    def poll_backoff(self, value):
+        value = float(value)
+        if value < 1:
+            raise ValueError('poll_backoff must be greater than or equal to 1')
+        self._poll_backoff = value
+
+    def _poll_wait(self):
+        """Return the time to wait for data before polling again.
+
+        In adaptive mode, each call backs off the period used by the next.
+        """
+        if self._min_poll_period is None:
+            return self._poll_period
+        period = min(self._current_poll_period, self._poll_period)
+        self._current_poll_period = min(period * self._poll_backoff,
+                                        self._poll_period)
+        return period
+
+    def _poll_received(self):
+        """Return to the shortest poll period after data is received"""
+        self._current_poll_period = self._min_poll_period
+
     @property
     def max_read(self):
         return self._max_read
@@ -421,6 +1269,23 @@ class PollingStreamAdapterMixin(object):
             raise ValueError('max_read must be greater than or equal to 0')
         self._max_read = value
 
+    @property
+    def max_read_limit(self):
+        return self._max_read_limit
+
+    @max_read_limit.setter
+    def max_read_limit(self, value):
+        self._max_read_limit = _check_max_read_limit(value)
+
+
+def _check_max_read_limit(value):
+    """Validate a *max_read_limit* value, which may be ``None``"""
+    if value is not None:
+        value = int(value)
+        if value <= 0:
+            raise ValueError('max_read_limit must be greater than 0')
+    return value
+
 
 class PollingStreamAdapter(StreamAdapter, PollingStreamAdapterMixin):
     """A :class:`StreamAdapter` that polls a non-blocking stream.
@@ -430,17 +1295,30 @@ class PollingStreamAdapter(StreamAdapter, PollingStreamAdapterMixin):
     non-blocking.
     """
 
-    def __init__(self, stream, poll_period=0.1, max_read=1024):
+    def __init__(self, stream, poll_period=0.1, max_read=1024,
+                 min_poll_period=None, poll_backoff=2.0, max_read_limit=None):
         """
         :param stream: Stream to poll for data.
         :param float poll_period: Time (in seconds) between polls of the
-            stream.
+            stream, or the longest time if polling is adaptive.
         :param int max_read: The maximum number of bytes/characters to read
-            from the stream at one time.
+            from the stream at one time, or the starting amount if
+            *max_read_limit* is given.
+        :param float min_poll_period: If given, enables adaptive polling, and
+            is the time (in seconds) between polls after data is received.
+        :param float poll_backoff: Factor the time between adaptive polls is
+            multiplied by after each poll that receives nothing.
+        :param int max_read_limit: If given, the amount read at one time
+            grows up to this many bytes/characters while reads come back
+            full, and shrinks back to *max_read* as they come back short.
         """
         super(PollingStreamAdapter, self).__init__(stream)
         self.poll_period = poll_period
         self.max_read = max_read
+        self.min_poll_period = min_poll_period
+        self.poll_backoff = poll_backoff
+        self.max_read_limit = max_read_limit
+        self._reader = _AdaptiveReader(stream.read)
 
     def poll(self, timeout):
         """
@@ -450,12 +1328,16 @@ class PollingStreamAdapter(StreamAdapter, PollingStreamAdapterMixin):
         end_time = time.time() + timeout
         while True:
             # Keep reading until data is received or timeout
-            incoming = self.stream.read(self._max_read)
+            incoming = self._reader.read(self._max_read,
+                                         self._max_read_limit)
             if incoming:
+                self._poll_received()
                 return incoming
-            if (end_time - time.time()) < 0:
+            remaining = end_time - time.time()
+            if remaining < 0:
                 raise ExpectTimeout()
-            time.sleep(self._poll_period)
+            # Never sleep past the timeout
+            time.sleep(min(self._poll_wait(), remaining))
 
 
 class PollingSocketStreamAdapter(StreamAdapter, PollingStreamAdapterMixin):
@@ -463,126 +1345,1139 @@ class PollingSocketStreamAdapter(StreamAdapter, PollingStreamAdapterMixin):
 
     Polls a non-blocking socket for data until new data is available or a
     timeout is exceeded.
+
+    By default each call to :func:`poll` saves the timeout of the socket and
+    restores it afterwards. If *own_timeout* is enabled, the adapter instead
+    takes over the timeout of the socket: the timeout is only changed when
+    the wait needed differs from the previous one, and is left in place
+    between polls, so a poll that finds data waiting costs a single wait and
+    a single read. The timeout then also applies to anything else done with
+    the socket, such as *send*, and must not be changed elsewhere.
     """
 
-    def __init__(self, sock, poll_period=0.1, max_read=1024):
+    def __init__(self, sock, poll_period=0.1, max_read=1024,
+                 min_poll_period=None, poll_backoff=2.0, max_read_limit=None,
+                 own_timeout=False):
         """
         :param sock: Socket to poll for data.
-        :param float poll_period: Time (in seconds) between poll of the socket.
+        :param float poll_period: Time (in seconds) between poll of the socket,
+            or the longest time if polling is adaptive.
         :param int max_read: The maximum number of bytes/characters to read
-            from the socket at one time.
+            from the socket at one time, or the starting amount if
+            *max_read_limit* is given.
+        :param float min_poll_period: If given, enables adaptive polling, and
+            is the time (in seconds) between polls after data is received.
+        :param float poll_backoff: Factor the time between adaptive polls is
+            multiplied by after each poll that receives nothing.
+        :param int max_read_limit: If given, the number of bytes read at one
+            time grows up to this amount while reads come back full, and
+            shrinks back to *max_read* as they come back short.
+        :param bool own_timeout: If ``True``, leave the timeout of the socket
+            set between polls rather than restoring it after each one.
         """
         super(PollingSocketStreamAdapter, self).__init__(sock)
+        self.own_timeout = own_timeout
+        self._socket_timeout = None
         self.poll_period = poll_period
         self.max_read = max_read
+        self.min_poll_period = min_poll_period
+        self.poll_backoff = poll_backoff
+        self.max_read_limit = max_read_limit
+        self._reader = _AdaptiveReader(sock.recv)
 
     def poll(self, timeout):
         """
-        :param float timeout: Timeout in seconds. A timeout that is less than
-            the poll_period will still cause a single read that may take up to
-            poll_period seconds.
+        :param float timeout: Timeout in seconds. Each read of the socket
+            waits for at most the poll period, and never past the timeout.
         """
         now = time.time()
         end_time = now + float(timeout)
+        if self.own_timeout:
+            return self._poll(now, end_time)
         prev_timeout = self.stream.gettimeout()
-        self.stream.settimeout(self._poll_period)
-        incoming = None
         try:
-            while (end_time - now) >= 0:
-                try:
-                    incoming = self.stream.recv(self._max_read)
-                except socket.timeout:
-                    pass
-                if incoming:
-                    return incoming
-                now = time.time()
-            raise ExpectTimeout()
+            return self._poll(now, end_time)
         finally:
             self.stream.settimeout(prev_timeout)
+            self._socket_timeout = None
+
+    def _poll(self, now, end_time):
+        while (end_time - now) >= 0:
+            incoming = None
+            wait = min(self._poll_wait(), end_time - now)
+            if wait != self._socket_timeout:
+                self.stream.settimeout(wait)
+                self._socket_timeout = wait
+            try:
+                incoming = self._reader.read(self._max_read,
+                                             self._max_read_limit)
+            except socket.timeout:
+                pass
+            except socket.error as e:
+                # A timeout of 0 makes the socket non-blocking
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            if incoming:
+                self._poll_received()
+                return incoming
+            now = time.time()
+        raise ExpectTimeout()
+
+
+class SelectorStreamAdapter(StreamAdapter):
+    """A :class:`StreamAdapter` that waits for a stream to become readable.
+
+    Rather than reading the stream every *poll_period* seconds, waits on the
+    file descriptor of the stream (using :mod:`selectors` where available)
+    until data arrives or the timeout is exceeded. Data is returned as soon
+    as it is received, and no time is spent polling an idle stream.
+
+    Works with sockets and, except on Windows, with any stream that has a
+    *fileno* method. Sockets are read with *recv*, and other streams with
+    *read*; the read must not block once the file descriptor is readable.
+    Buffered :mod:`io` streams, such as the *stdout* of a
+    :class:`subprocess.Popen`, are read through their *raw* stream, so that
+    no data is left in the buffer where waiting on the file descriptor would
+    not see it; data buffered before the adapter was created is not seen.
+    Data that an SSL socket has already received is read before waiting.
+    """
 
+    def __init__(self, stream, max_read=1024, max_read_limit=None):
+        """
+        :param stream: Stream or socket to wait on.
+        :param int max_read: The maximum number of bytes/characters to read
+            from the stream at one time, or the starting amount if
+            *max_read_limit* is given.
+        :param int max_read_limit: If given, the amount read at one time
+            grows up to this many bytes/characters while reads come back
+            full, and shrinks back to *max_read* as they come back short.
+        """
+        super(SelectorStreamAdapter, self).__init__(stream)
+        self.max_read = max_read
+        self.max_read_limit = max_read_limit
+        self._selector = None
+        self._reader = self._create_reader()
 
-class ExpectBytesMixin(object):
+    @property
+    def max_read(self):
+        return self._max_read
 
-    def expect_bytes(self, b, timeout=3):
-        """Wait for a match to the bytes in *b* to appear on the stream.
+    @max_read.setter
+    def max_read(self, value):
+        value = int(value)
+        if value < 0:
+            raise ValueError('max_read must be greater than or equal to 0')
+        self._max_read = value
 
-        Waits for input matching the bytes *b* for up to *timeout* seconds.
-        If a match is found, a :class:`SequenceMatch` result is returned.  If
-        no match is found within *timeout* seconds, raise an
-        :class:`ExpectTimeout` exception.
+    @property
+    def max_read_limit(self):
+        return self._max_read_limit
+
+    @max_read_limit.setter
+    def max_read_limit(self, value):
+        self._max_read_limit = _check_max_read_limit(value)
+
+    def _create_reader(self):
+        """Create the :class:`_AdaptiveReader` used to read the stream"""
+        stream = self.stream
+        if hasattr(stream, 'recv'):
+            return _AdaptiveReader(stream.recv)
+        # A buffered stream reads ahead into its buffer, so its raw stream is
+        # read instead
+        stream = getattr(stream, 'raw', stream)
+        return _AdaptiveReader(stream.read)
 
-        :param b: The byte pattern to search for.
-        :param float timeout: Timeout in seconds.
-        :return: :class:`SequenceMatch` if matched, None if no match was found.
+    def poll(self, timeout):
+        """
+        :param float timeout: Timeout in seconds. If the end of the stream is
+            reached, no more data can arrive, and `ExpectTimeout` is raised
+            once the timeout has passed.
         """
-        return self.expect(BytesSearcher(b), timeout)
+        end_time = time.time() + float(timeout)
+        while True:
+            remaining = end_time - time.time()
+            if self._wait(max(remaining, 0)):
+                incoming = self._reader.read(self._max_read,
+                                             self._max_read_limit)
+                if incoming:
+                    return incoming
+                if incoming is not None:
+                    # Readable but empty: the end of the stream was reached
+                    self._end_of_stream(end_time)
+            elif remaining <= 0:
+                raise ExpectTimeout()
 
+    def _end_of_stream(self, end_time):
+        """Wait until *end_time*, and raise `ExpectTimeout`"""
+        remaining = end_time - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        raise ExpectTimeout()
+
+    def close(self):
+        """Close the underlying stream."""
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        self.stream.close()
+
+    def _wait(self, timeout):
+        """Wait up to *timeout* seconds for the stream to become readable"""
+        if hasattr(self.stream, 'recv') and \
+                getattr(self.stream, 'pending', lambda: 0)():
+            # Data already decrypted by an SSL socket isn't visible on the
+            # file descriptor
+            return True
+        if self._selector is None:
+            self._selector = _StreamSelector()
+            self._selector.register(self.fileno(), self)
+        return bool(self._selector.select(timeout))
+
+
+class FdStreamAdapter(SelectorStreamAdapter):
+    """A :class:`StreamAdapter` that reads a file descriptor directly.
+
+    Reads a raw file descriptor, such as a pipe, FIFO or the master side of a
+    pseudo-terminal, with :func:`os.read`, bypassing the buffering of Python
+    file objects.
+    The file descriptor is made non-blocking, and waited on in the same way
+    as :class:`SelectorStreamAdapter`, so data is returned as soon as it
+    arrives. Not supported on Windows.
+
+    *write* writes to the file descriptor, or to *write_fd* if one is given,
+    which allows for example both pipes of a subprocess to be used through
+    the one adapter.
+    """
 
-class ExpectTextMixin(object):
+    def __init__(self, fd, write_fd=None, max_read=1024, max_read_limit=None,
+                 encoding=None, errors='strict'):
+        """
+        :param fd: File descriptor to read from, or an object with a *fileno*
+            method, such as the *stdout* of a :class:`subprocess.Popen`.
+        :param write_fd: File descriptor (or object with a *fileno* method)
+            that *write* writes to, if different from *fd*.
+        :param int max_read: The maximum number of bytes to read from the file
+            descriptor at one time, or the starting amount if
+            *max_read_limit* is given.
+        :param int max_read_limit: If given, the number of bytes read at one
+            time grows up to this amount while reads come back full, and
+            shrinks back to *max_read* as they come back short.
+        :param str encoding: If given, received bytes are decoded into text
+            using this encoding.
+        :param str errors: Error handling scheme used when decoding.
+        """
+        self.fd = _fileno(fd)
+        self.write_fd = self.fd if write_fd is None else _fileno(write_fd)
+        self._write_stream = write_fd
+        _set_nonblocking(self.fd)
+        super(FdStreamAdapter, self).__init__(fd, max_read, max_read_limit)
+        self.encoding = encoding
+        if encoding is None:
+            self._decoder = None
+        else:
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors)
 
-    def expect_text(self, text, timeout=3):
-        """Wait for a match to the text in *text* to appear on the stream.
+    def fileno(self):
+        return self.fd
 
-        Waits for input matching the text *text* for up to *timeout*
-        seconds. If a match is found, a :class:`SequenceMatch` result is
-        returned.  If no match is found within *timeout* seconds, raise an
-        :class:`ExpectTimeout` exception.
+    def _end_of_stream(self, end_time):
+        raise ExpectEOF()
 
-        :param text: The plain-text pattern to search for.
+    def _create_reader(self):
+        fd = self.fd
+        return _AdaptiveReader(
+            _nonblocking(lambda size: os.read(fd, size), b''))
+
+    def poll(self, timeout):
+        """
         :param float timeout: Timeout in seconds.
-        :return: :class:`SequenceMatch` if matched, None if no match was found.
+        :raises ExpectEOF: If the end of the stream is reached, as no more
+            data can arrive.
         """
-        return self.expect(TextSearcher(text), timeout)
+        if self._decoder is None:
+            return super(FdStreamAdapter, self).poll(timeout)
+        end_time = time.time() + float(timeout)
+        while True:
+            incoming = super(FdStreamAdapter, self).poll(
+                end_time - time.time())
+            text = self._decoder.decode(incoming)
+            if text:
+                return text
+            # Only part of a character was received
 
+    def write(self, data):
+        """Write all of *data* to the file descriptor.
 
-class ExpectRegexMixin(object):
+        Text is encoded with the *encoding* of the adapter, or UTF-8. If the
+        file descriptor is non-blocking and cannot take all of the data at
+        once, waits until it can take more.
 
-    def expect_regex(self, pattern, timeout=3, regex_options=0):
-        """Wait for a match to the regex in *pattern* to appear on the stream.
+        :return: The number of bytes written.
+        """
+        if isinstance(data, six.text_type):
+            data = data.encode(self.encoding or 'utf-8')
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            try:
+                written += os.write(self.write_fd, view[written:])
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                select.select([], [self.write_fd], [])
+        return written
+
+    def close(self):
+        """Close the file descriptors, or the objects they were taken from."""
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        _close_fd(self.stream)
+        if self.write_fd != self.fd:
+            _close_fd(self._write_stream)
+
+
+def _fileno(fd):
+    """Return the file descriptor of *fd*, which may already be one"""
+    if isinstance(fd, six.integer_types):
+        return fd
+    return fd.fileno()
+
+
+def _close_fd(fd):
+    """Close a file descriptor, or the object it was taken from"""
+    if isinstance(fd, six.integer_types):
+        os.close(fd)
+    else:
+        fd.close()
 
-        Waits for input matching the regex *pattern* for up to *timeout*
-        seconds. If a match is found, a :class:`RegexMatch` result is returned.
-        If no match is found within *timeout* seconds, raise an
-        :class:`ExpectTimeout` exception.
 
-        :param pattern: The pattern to search for, as a single compiled regex
-            or a string that will be processed as a regex.
-        :param float timeout: Timeout in seconds.
-        :param regex_options: Options passed to the regex engine.
-        :return: :class:`RegexMatch` if matched, None if no match was found.
-        """
-        return self.expect(RegexSearcher(pattern, regex_options), timeout)
+def _set_nonblocking(fd):
+    """Make reads of the file descriptor *fd* return without waiting"""
+    try:
+        os.set_blocking(fd, False)
+    except AttributeError:
+        # For backward compatibility with Python < 3.5
+        import fcntl
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
 
-class Expecter(object):
-    """Base class for consuming input and waiting for a pattern to appear.
+def _nonblocking(read, eof):
+    """Wrap a read of a non-blocking file descriptor to return ``None`` if
+    no data is available, like the read methods of Python file objects.
 
-    Implements the base class for *Expecter* types, which wrap over a
-    :class:`StreamAdapter` type and provide methods for applying a
-    :class:`Searcher` to the received data. Any attributes not part of this
-    class are delegated to the underlying :class:`StreamAdapter` type.
+    The master side of a pseudo-terminal reports `errno.EIO` once the other
+    side is closed, which is treated as the end of the stream, and returns
+    *eof*.
+    """
+    def wrapper(arg):
+        try:
+            return read(arg)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            if e.errno == errno.EIO:
+                return eof
+            raise
+    return wrapper
+
+
+class PtyStreamAdapter(FdStreamAdapter):
+    """A :class:`FdStreamAdapter` over a process running on a
+    pseudo-terminal, as started by :func:`spawn`.
+
+    Reads and writes the master side of the pseudo-terminal. Once the process
+    exits and closes the terminal, the end of the stream is reached. The
+    terminal echoes what is written to it, as a terminal normally would.
+    Not supported on Windows.
     """
 
-    def __init__(self, stream_adapter, input_callback, window, close_adapter):
+    def __init__(self, fd, process, max_read=1024, max_read_limit=None,
+                 encoding=None, errors='strict'):
         """
-        :param StreamAdapter stream_adapter: The :class:`StreamAdapter` object
-            to receive data from.
-        :param function input_callback: Callback function with one parameter
-            that is called each time new data is read from the
-            *stream_adapter*.
-        :param int window: Number of historical objects (bytes, characters,
-            etc.) to buffer.
-        :param bool close_adapter: If ``True``, and the Expecter is used as a
-            context manager, closes the adapter at the end of the context
-            manager.
+        :param int fd: Master file descriptor of the pseudo-terminal.
+        :param subprocess.Popen process: Process running on the terminal.
+        :param int max_read: The maximum number of bytes to read from the
+            terminal at one time, or the starting amount if *max_read_limit*
+            is given.
+        :param int max_read_limit: If given, the number of bytes read at one
+            time grows up to this amount while reads come back full, and
+            shrinks back to *max_read* as they come back short.
+        :param str encoding: If given, received bytes are decoded into text
+            using this encoding.
+        :param str errors: Error handling scheme used when decoding.
         """
-        self.stream_adapter = stream_adapter
-        if not input_callback:
-            self.input_callback = lambda _: None
-        else:
-            self.input_callback = input_callback
+        super(PtyStreamAdapter, self).__init__(
+            fd, max_read=max_read, max_read_limit=max_read_limit,
+            encoding=encoding, errors=errors)
+        self.process = process
+
+    def wait(self, timeout=None):
+        """Wait for the process to exit.
+
+        :param float timeout: Timeout in seconds, or ``None`` to wait
+            indefinitely.
+        :return: The exit status of the process.
+        :raises ExpectTimeout: If the process is still running once the
+            timeout has passed.
+        """
+        if timeout is None:
+            return self.process.wait()
+        end_time = time.time() + float(timeout)
+        period = 0.001
+        while self.process.poll() is None:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                raise ExpectTimeout()
+            time.sleep(min(period, remaining))
+            period = min(period * 2, 0.05)
+        return self.process.returncode
+
+    def close(self, timeout=1.0):
+        """Close the terminal and wait for the process to exit.
+
+        Closing the terminal sends the process a hangup signal. If it is
+        still running after *timeout* seconds it is terminated, and if that
+        does not stop it within another *timeout* seconds it is killed.
+
+        :param float timeout: Time (in seconds) to wait at each step.
+        :return: The exit status of the process.
+        """
+        super(PtyStreamAdapter, self).close()
+        for stop in (None, self.process.terminate, self.process.kill):
+            if self.process.poll() is not None:
+                break
+            if stop is not None:
+                stop()
+            try:
+                return self.wait(timeout)
+            except ExpectTimeout:
+                pass
+        return self.wait()
+
+
+def _make_controlling_terminal():
+    """Run in a spawned process to make its terminal the controlling one"""
+    import fcntl
+    import termios
+    os.setsid()
+    if hasattr(termios, 'TIOCSCTTY'):
+        fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+# Run by a new interpreter in a spawned process, after the process has
+# started a new session, to make the terminal on its standard input the
+# controlling one and then run the program. Unlike a preexec_fn, this is safe
+# in a parent process with threads, as no Python code runs between fork and
+# exec.
+_CONTROLLING_TERMINAL_LAUNCHER = (
+    'import fcntl, os, sys, termios\n'
+    'if hasattr(termios, "TIOCSCTTY"):\n'
+    '    fcntl.ioctl(0, termios.TIOCSCTTY, 0)\n'
+    'else:\n'
+    '    os.close(os.open(os.ttyname(0), os.O_RDWR))\n'
+    'os.execv(sys.argv[1], sys.argv[2:])\n')
+
+
+def _popen_on_terminal(argv, fd, env, cwd):
+    """Start *argv* in a new session with the terminal *fd* as its
+    controlling terminal and standard streams"""
+    kwargs = dict(stdin=fd, stdout=fd, stderr=fd, env=env, cwd=cwd,
+                  close_fds=True)
+    if not hasattr(shutil, 'which') or not sys.executable:
+        # For backward compatibility with Python < 3.3
+        return subprocess.Popen(argv, preexec_fn=_make_controlling_terminal,
+                                **kwargs)
+    if isinstance(argv, (six.text_type, six.binary_type)):
+        argv = [argv]
+    argv = list(argv)
+    # The program is looked up here, so that a missing program raises the
+    # same error as subprocess.Popen instead of failing in the launcher
+    executable = argv[0]
+    if os.sep not in os.fsdecode(executable):
+        path = os.pathsep.join(os.get_exec_path(env))
+        executable = shutil.which(os.fsdecode(executable), path=path)
+        if executable is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), argv[0])
+    launcher = [sys.executable, '-E', '-s', '-S', '-c',
+                _CONTROLLING_TERMINAL_LAUNCHER, executable]
+    return subprocess.Popen(launcher + argv, start_new_session=True,
+                            **kwargs)
+
+
+class MmapReplayAdapter(StreamAdapter):
+    """A :class:`StreamAdapter` that replays a captured file.
+
+    Maps the file into memory and returns it in slices of up to *max_read*
+    bytes, as :class:`memoryview` objects over the mapping, so no data is
+    copied by the adapter and no time is spent waiting. Once the whole file
+    has been returned, :func:`poll` raises `ExpectEOF` straight away instead
+    of `ExpectTimeout`. The *position* attribute holds the offset in the file
+    of the next byte to be returned.
+
+    Replaying a file this fast is only useful while matches are being
+    searched for, so a large *window* on the :class:`Expecter` is not needed.
+    """
+
+    def __init__(self, file, max_read=1024 * 1024, encoding=None,
+                 errors='strict'):
+        """
+        :param file: Path of the file to replay, or a file object opened for
+            reading in binary mode.
+        :param int max_read: The maximum number of bytes to return from each
+            call to :func:`poll`.
+        :param str encoding: If given, the bytes are decoded into text using
+            this encoding, which copies them.
+        :param str errors: Error handling scheme used when decoding.
+        """
+        if isinstance(file, (six.binary_type, six.text_type)):
+            stream = open(file, 'rb')
+        else:
+            stream = file
+        super(MmapReplayAdapter, self).__init__(stream)
+        self.max_read = max_read
+        self.position = 0
+        size = os.fstat(stream.fileno()).st_size
+        if size:
+            self._mmap = mmap.mmap(stream.fileno(), size,
+                                   access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        else:
+            # Empty files cannot be mapped
+            self._mmap = None
+            self._view = memoryview(b'')
+        if encoding is None:
+            self._decoder = None
+        else:
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors)
+
+    @property
+    def max_read(self):
+        return self._max_read
+
+    @max_read.setter
+    def max_read(self, value):
+        value = int(value)
+        if value <= 0:
+            raise ValueError('max_read must be greater than 0')
+        self._max_read = value
+
+    def __len__(self):
+        return len(self._view)
+
+    def poll(self, timeout):
+        """
+        :param float timeout: Unused, as data is always available until the
+            end of the file.
+        :raises ExpectEOF: Once the end of the file has been reached.
+        """
+        while self.position < len(self._view):
+            start = self.position
+            self.position = min(start + self._max_read, len(self._view))
+            incoming = self._view[start:self.position]
+            if self._decoder is None:
+                return incoming
+            text = self._decoder.decode(incoming,
+                                        self.position == len(self._view))
+            if text:
+                return text
+        raise ExpectEOF()
+
+    def close(self):
+        """Unmap and close the file."""
+        self._view = memoryview(b'')
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Slices returned by poll() are still in use, and the file
+                # is unmapped once they are released
+                pass
+        self.stream.close()
+
+
+class _StreamSelector(object):
+    """Waits for any of a number of streams to become readable.
+
+    Uses :mod:`selectors` where available, and otherwise falls back to
+    :func:`select.select`.
+    """
+
+    def __init__(self):
+        self._streams = {}
+        if selectors is None:
+            self._selector = None
+        else:
+            self._selector = selectors.DefaultSelector()
+
+    def __len__(self):
+        return len(self._streams)
+
+    def register(self, stream, data):
+        """Wait for *stream*, which is identified by *data* when readable"""
+        self._streams[stream] = data
+        if self._selector is not None:
+            self._selector.register(stream, selectors.EVENT_READ, data)
+
+    def unregister(self, stream):
+        """Stop waiting for *stream*"""
+        del self._streams[stream]
+        if self._selector is not None:
+            self._selector.unregister(stream)
+
+    def select(self, timeout):
+        """Return the *data* of the streams that are readable"""
+        timeout = max(timeout, 0)
+        if not self._streams:
+            # Some platforms can't select on an empty set of streams
+            time.sleep(timeout)
+            return []
+        if self._selector is None:
+            readable = select.select(list(self._streams), [], [], timeout)[0]
+            return [self._streams[x] for x in readable]
+        return [key.data for key, _ in self._selector.select(timeout)]
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+
+
+class ThreadedStreamAdapter(StreamAdapter):
+    """A :class:`StreamAdapter` that reads a stream in a background thread.
+
+    Other adapters only read from their stream while an *Expecter* is waiting
+    for data, so between expectations received data accumulates in operating
+    system or driver buffers, and a sender may stall or lose data once they
+    are full. A *ThreadedStreamAdapter* starts a thread that keeps reading the
+    stream into a bounded queue, and :func:`poll` returns everything queued so
+    far as a single chunk. While the queue is full the thread stops reading,
+    so that memory use is limited.
+
+    The stream is read through another adapter, by default the one chosen by
+    :func:`wrap`. Errors raised by that adapter stop the thread and are raised
+    by :func:`poll` once the data received before them has been returned.
+    :func:`close` stops the thread and closes the stream.
+    """
+
+    def __init__(self, stream, max_queued=64, poll_period=0.1):
+        """
+        :param stream: Stream to read, or a :class:`StreamAdapter` to read it
+            through.
+        :param int max_queued: Maximum number of chunks, each read by a single
+            poll of the underlying adapter, to hold in the queue.
+        :param float poll_period: Maximum time (in seconds) the thread waits
+            for data or for space in the queue before checking whether it has
+            been stopped.
+        """
+        if isinstance(stream, StreamAdapter):
+            adapter = stream
+        else:
+            adapter = _adapter_for(stream)
+        super(ThreadedStreamAdapter, self).__init__(adapter.stream)
+        self.adapter = adapter
+        self.poll_period = poll_period
+        max_queued = int(max_queued)
+        if max_queued <= 0:
+            raise ValueError('max_queued must be greater than 0')
+        self._queue = six.moves.queue.Queue(max_queued)
+        self._error = None
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='ThreadedStreamAdapter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def poll_period(self):
+        return self._poll_period
+
+    @poll_period.setter
+    def poll_period(self, value):
+        value = float(value)
+        if value <= 0:
+            raise ValueError('poll_period must be greater than 0')
+        self._poll_period = value
+
+    def poll(self, timeout):
+        """
+        :param float timeout: Timeout in seconds.
+        """
+        chunks = []
+        try:
+            if self._error is None:
+                item = self._queue.get(timeout=max(float(timeout), 0))
+            else:
+                item = self._queue.get_nowait()
+            while item is not None:
+                chunks.append(item)
+                item = self._queue.get_nowait()
+        except six.moves.queue.Empty:
+            pass
+        if chunks:
+            if isinstance(chunks[0], six.text_type):
+                return six.text_type().join(chunks)
+            # Chunks may be memoryviews, which have no join method
+            return b''.join(chunks)
+        if self._error is not None:
+            raise self._error
+        raise ExpectTimeout()
+
+    def close(self):
+        """Stop the background thread and close the underlying stream."""
+        self._stopping.set()
+        self._thread.join()
+        self.adapter.close()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                incoming = self.adapter.poll(self._poll_period)
+            except ExpectEOF as e:
+                error = e
+            except ExpectTimeout:
+                continue
+            except Exception as e:
+                error = e
+            else:
+                self._put(incoming)
+                continue
+            self._error = error
+            # Wake up poll() to raise the error
+            self._put(None)
+            return
+
+    def _put(self, item):
+        """Add *item* to the queue, waiting for space unless stopped"""
+        while not self._stopping.is_set():
+            try:
+                self._queue.put(item, timeout=self._poll_period)
+                return
+            except six.moves.queue.Full:
+                pass
+
+
+class AsyncStreamAdapter(StreamAdapter):
+    """A :class:`StreamAdapter` over an :class:`asyncio.StreamReader`.
+
+    Unlike other adapters, :func:`poll` does not block: it returns an
+    :class:`asyncio.Future` that resolves to the data read from the reader,
+    or raises `ExpectTimeout` if no data arrives in time. It is used by the
+    :class:`AsyncBytesExpecter` and :class:`AsyncTextExpecter` types, and
+    must be polled from a running event loop.
+
+    Attributes that the reader does not have are delegated to the *writer*,
+    if one is given, so that the adapter can be used like the pair of streams
+    returned by :func:`asyncio.open_connection`.
+    """
+
+    def __init__(self, reader, writer=None, max_read=1024, encoding=None,
+                 errors='strict'):
+        """
+        :param asyncio.StreamReader reader: Reader to receive data from.
+        :param asyncio.StreamWriter writer: Optional writer for sending data,
+            which is closed when the adapter is closed.
+        :param int max_read: The maximum number of bytes to read from the
+            reader at one time.
+        :param str encoding: If given, received bytes are decoded into text
+            using this encoding.
+        :param str errors: Error handling scheme used when decoding.
+        """
+        super(AsyncStreamAdapter, self).__init__(reader)
+        self.writer = writer
+        self.max_read = max_read
+        self._read = None
+        self._waiter = None
+        self._abandoned = None
+        # Data read after the poll it was read for had finished
+        self._pending = []
+        if encoding is None:
+            self._decoder = None
+        else:
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors)
+
+    def __getattr__(self, attr):
+        try:
+            return getattr(self.stream, attr)
+        except AttributeError:
+            writer = self.__dict__.get('writer')
+            if writer is None:
+                raise
+            return getattr(writer, attr)
+
+    @property
+    def max_read(self):
+        return self._max_read
+
+    @max_read.setter
+    def max_read(self, value):
+        value = int(value)
+        if value <= 0:
+            raise ValueError('max_read must be greater than 0')
+        self._max_read = value
+
+    def poll(self, timeout):
+        """
+        :param float timeout: Timeout in seconds. If the end of the stream is
+            reached, no more data can arrive, and `ExpectTimeout` is raised
+            once the timeout has passed.
+        :return: :class:`asyncio.Future` resolving to the received data.
+        """
+        loop = _event_loop()
+        result = loop.create_future()
+
+        def expire():
+            if not result.done():
+                result.set_exception(ExpectTimeout())
+
+        def read():
+            # Only one read is made at a time, and a read still in progress
+            # when a poll finishes is taken over by the next poll
+            if self._read is None:
+                self._read = asyncio.ensure_future(
+                    self.stream.read(self._max_read))
+                self._read.add_done_callback(self._read_done)
+            self._waiter = on_read
+
+        def on_read(task):
+            if result.done():
+                self._keep(task)
+            elif task.cancelled():
+                if task is self._abandoned:
+                    read()
+                else:
+                    result.cancel()
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                received(task.result())
+
+        def received(data):
+            if not data:
+                # End of stream: nothing more will arrive before the timeout
+                pass
+            elif self._decoder is None:
+                result.set_result(data)
+            else:
+                text = self._decoder.decode(data)
+                if text:
+                    result.set_result(text)
+                else:
+                    # Only part of a character was received
+                    read()
+
+        def finish(_):
+            timer.cancel()
+            if self._waiter is on_read:
+                self._waiter = None
+                # Cancelling a read leaves its data in the reader for next time
+                self._abandoned = self._read
+                self._read.cancel()
+
+        timer = loop.call_later(max(float(timeout), 0), expire)
+        result.add_done_callback(finish)
+        if self._pending:
+            pending = b''.join(self._pending)
+            del self._pending[:]
+            received(pending)
+        else:
+            read()
+        return result
+
+    def _read_done(self, task):
+        self._read = None
+        waiter, self._waiter = self._waiter, None
+        if waiter is None:
+            self._keep(task)
+        else:
+            waiter(task)
+
+    def _keep(self, task):
+        """Keep the data of a read that completed after its poll finished"""
+        if not task.cancelled() and task.exception() is None and \
+                task.result():
+            self._pending.append(task.result())
+
+    def close(self):
+        """Close the writer, if there is one."""
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _event_loop():
+    """Return the running event loop"""
+    try:
+        return asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):
+        # For backward compatibility with Python < 3.7
+        return asyncio.get_event_loop()
+
+
+def _selectable(stream):
+    """Check whether waiting on the file descriptor of *stream* shows when
+    it has data to read.
+
+    Buffered streams, and SSL sockets, can hold data that is not visible on
+    their file descriptor, so only plain sockets and unbuffered raw streams
+    can be waited on.
+    """
+    if hasattr(stream, 'recv'):
+        if hasattr(stream, 'pending'):
+            return False
+    # Windows can only wait on sockets
+    elif sys.platform == 'win32' or not isinstance(stream, io.RawIOBase):
+        return False
+    try:
+        stream.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+    return True
+
+
+class SearcherCache(object):
+    """Bounded least-recently-used cache of :class:`Searcher` objects.
+
+    Constructing a searcher validates its pattern and, depending on the type,
+    normalizes or compiles it. Scripts that issue the same expectation many
+    times can use a *SearcherCache* to pay that cost once. The
+    ``expect_bytes``, ``expect_text`` and ``expect_regex`` methods of the
+    :class:`Expecter` types look up their searchers in the expecter's
+    *searcher_cache*, which by default is a cache shared by all expecters.
+
+    Cached searchers are reused between calls, so only searchers that do not
+    change after construction should be cached.
+    """
+
+    def __init__(self, maxsize=128):
+        """
+        :param int maxsize: Maximum number of searchers to keep. A *maxsize*
+            of 0 disables caching.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._searchers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._searchers)
+
+    def __repr__(self):
+        return '{}(maxsize={}, size={}, hits={}, misses={})'.format(
+            self.__class__.__name__, self._maxsize, len(self), self.hits,
+            self.misses)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        value = int(value)
+        if value < 0:
+            raise ValueError('maxsize must be greater than or equal to 0')
+        self._maxsize = value
+        if hasattr(self, '_searchers'):
+            with self._lock:
+                self._evict()
+
+    def get(self, searcher_type, *args):
+        """Return a searcher equivalent to ``searcher_type(*args)``.
+
+        The searcher is created and added to the cache if it is not already
+        present. Arguments of different types are never considered equal, so
+        for example a binary and a text pattern never share an entry.
+
+        :param searcher_type: :class:`Searcher` type to create.
+        :param args: Arguments passed to the *searcher_type* constructor.
+        """
+        key = (searcher_type, args, tuple(type(x) for x in args))
+        try:
+            with self._lock:
+                searcher = self._searchers.pop(key)
+                self._searchers[key] = searcher
+                self.hits += 1
+                return searcher
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable arguments can't be cached
+            return searcher_type(*args)
+
+        searcher = searcher_type(*args)
+        with self._lock:
+            self.misses += 1
+            self._searchers[key] = searcher
+            self._evict()
+        return searcher
+
+    def clear(self):
+        """Remove all searchers from the cache and reset the counters."""
+        with self._lock:
+            self._searchers.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _evict(self):
+        while len(self._searchers) > self._maxsize:
+            self._searchers.popitem(last=False)
+
+
+#: Cache used by expecters that are not given a *searcher_cache*
+default_searcher_cache = SearcherCache()
+
+
+class ExpectBytesMixin(object):
+
+    def expect_bytes(self, b, timeout=3):
+        """Wait for a match to the bytes in *b* to appear on the stream.
+
+        Waits for input matching the bytes *b* for up to *timeout* seconds.
+        If a match is found, a :class:`SequenceMatch` result is returned.  If
+        no match is found within *timeout* seconds, raise an
+        :class:`ExpectTimeout` exception.
+
+        :param b: The byte pattern to search for.
+        :param float timeout: Timeout in seconds.
+        :return: :class:`SequenceMatch` if matched, None if no match was found.
+        """
+        return self.expect(self.searcher_cache.get(BytesSearcher, b), timeout)
+
+
+class ExpectTextMixin(object):
+
+    def expect_text(self, text, timeout=3):
+        """Wait for a match to the text in *text* to appear on the stream.
+
+        Waits for input matching the text *text* for up to *timeout*
+        seconds. If a match is found, a :class:`SequenceMatch` result is
+        returned.  If no match is found within *timeout* seconds, raise an
+        :class:`ExpectTimeout` exception.
+
+        :param text: The plain-text pattern to search for.
+        :param float timeout: Timeout in seconds.
+        :return: :class:`SequenceMatch` if matched, None if no match was found.
+        """
+        return self.expect(self.searcher_cache.get(TextSearcher, text),
+                           timeout)
+
+
+class ExpectRegexMixin(object):
+
+    def expect_regex(self, pattern, timeout=3, regex_options=0):
+        """Wait for a match to the regex in *pattern* to appear on the stream.
+
+        Waits for input matching the regex *pattern* for up to *timeout*
+        seconds. If a match is found, a :class:`RegexMatch` result is returned.
+        If no match is found within *timeout* seconds, raise an
+        :class:`ExpectTimeout` exception.
+
+        :param pattern: The pattern to search for, as a single compiled regex
+            or a string that will be processed as a regex.
+        :param float timeout: Timeout in seconds.
+        :param regex_options: Options passed to the regex engine.
+        :return: :class:`RegexMatch` if matched, None if no match was found.
+        """
+        searcher = self.searcher_cache.get(RegexSearcher, pattern,
+                                           regex_options)
+        return self.expect(searcher, timeout)
+
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    # For backward compatibility with Python < 3.3
+    _clock = time.time
+
+
+class ExpectStats(object):
+    """Breakdown of the time spent in a single *expect* call.
+
+    Recorded by an :class:`Expecter` created with *collect_stats* enabled,
+    and available as its *last_stats* attribute once the call has returned
+    or raised. Times are in seconds.
+
+    :ivar float wall_time: Time from the start to the end of the call.
+    :ivar float poll_time: Time spent blocked in the *poll* method of the
+        stream adapter, or for the asynchronous expecters, waiting for the
+        futures it returns.
+    :ivar float search_time: Time spent searching the history, including
+        trimming it to the window.
+    :ivar int polls: Number of calls to *poll*, including one that raised.
+    :ivar int received: Number of items (bytes or characters) received.
+    :ivar int scanned: Number of items of history examined by the searches
+        in the call, counting again any items that a search examines again,
+        such as those that could hold a match straddling new data, or the
+        whole history for searchers that cannot resume a search.
+    :ivar bool matched: ``True`` if the call returned a match.
+    """
+
+    def __init__(self):
+        self.wall_time = 0.0
+        self.poll_time = 0.0
+        self.search_time = 0.0
+        self.polls = 0
+        self.received = 0
+        self.scanned = 0
+        self.matched = False
+
+    def __repr__(self):
+        return ('{}(wall_time={:.6f}, poll_time={:.6f}, search_time={:.6f}, '
+                'polls={}, received={}, scanned={}, matched={})'.format(
+                    self.__class__.__name__, self.wall_time, self.poll_time,
+                    self.search_time, self.polls, self.received,
+                    self.scanned, self.matched))
+
+
+class Expecter(object):
+    """Base class for consuming input and waiting for a pattern to appear.
+
+    Implements the base class for *Expecter* types, which wrap over a
+    :class:`StreamAdapter` type and provide methods for applying a
+    :class:`Searcher` to the received data. Any attributes not part of this
+    class are delegated to the underlying :class:`StreamAdapter` type.
+    """
+
+    def __init__(self, stream_adapter, input_callback, window, close_adapter,
+                 searcher_cache=None, trim_history=False, collect_stats=False):
+        """
+        :param StreamAdapter stream_adapter: The :class:`StreamAdapter` object
+            to receive data from.
+        :param function input_callback: Callback function with one parameter
+            that is called each time new data is read from the
+            *stream_adapter*.
+        :param int window: Number of historical objects (bytes, characters,
+            etc.) to buffer.
+        :param bool close_adapter: If ``True``, and the Expecter is used as a
+            context manager, closes the adapter at the end of the context
+            manager.
+        :param SearcherCache searcher_cache: Cache of searchers used by the
+            ``expect_*`` convenience methods. If ``None``, the module-wide
+            :data:`default_searcher_cache` is used.
+        :param bool trim_history: If ``True``, while waiting for a match only
+            as much history as could still be part of a match is kept, as
+            determined by the *max_match_length* of the searcher. Searchers
+            whose maximum match length is unknown, or that contain anchors or
+            assertions such as "^", keep *window* objects.
+            Data discarded this way is no longer available to later *expect*
+            calls with other searchers.
+        :param bool collect_stats: If ``True``, each *expect* call records an
+            :class:`ExpectStats` in the *last_stats* attribute. If ``False``,
+            no time is spent measuring.
+        """
+        self.stream_adapter = stream_adapter
+        if not input_callback:
+            self.input_callback = lambda _: None
+        else:
+            self.input_callback = input_callback
         self.window = window
         self.close_adapter = close_adapter
+        if searcher_cache is None:
+            searcher_cache = default_searcher_cache
+        self.searcher_cache = searcher_cache
+        self.trim_history = trim_history
+        self.collect_stats = collect_stats
+        self.last_stats = None
 
     # Delegate undefined methods to underlying stream
     def __getattr__(self, attr):
@@ -628,12 +2523,138 @@ class Expecter(object):
         """
         raise NotImplementedError('Expecter must implement "expect"')
 
+    def _measured_expect(self, searcher, timeout):
+        """Implement *expect* while recording an :class:`ExpectStats`"""
+        stats = self.last_stats = ExpectStats()
+        started = _clock()
+        end = time.time() + float(timeout)
+        state = _search_state(searcher)
+        try:
+            match = self._measured_search(searcher, state, stats)
+            while not match:
+                before = _clock()
+                try:
+                    # poll() will raise ExpectTimeout if time is exceeded
+                    incoming = self._stream_adapter.poll(end - time.time())
+                finally:
+                    stats.poll_time += _clock() - before
+                    stats.polls += 1
+                stats.received += len(incoming)
+                self._feed(incoming)
+                match = self._measured_search(searcher, state, stats)
+            stats.matched = True
+            return self._consume(match)
+        finally:
+            stats.wall_time = _clock() - started
+
+    def _measured_search(self, searcher, state, stats):
+        # Searchers with their own states may not record what they examine,
+        # in which case the items they had not yet covered are counted
+        unscanned = max(len(self._history) - getattr(state, 'scanned', 0), 0)
+        before = _clock()
+        try:
+            return self._search(searcher, state)
+        finally:
+            stats.search_time += _clock() - before
+            examined = getattr(state, 'examined', None)
+            stats.scanned += unscanned if examined is None else examined
+
+    def _retain(self, searcher, state):
+        """Return how much history to keep while *searcher* has not matched"""
+        # Anchors such as "^" and "\b", whose states are reset on discard,
+        # would match at the new start of a trimmed history
+        if self.trim_history and not getattr(state, 'reset_on_discard', True):
+            length = getattr(searcher, 'max_match_length', None)
+            if length is not None:
+                return min(length, self._window)
+        return self._window
+
+    def iter_matches(self, searcher, timeout=None, idle_timeout=3):
+        """Yield every match of *searcher* in the stream, in order.
+
+        Searches the incoming data in a single pass, consuming the history up
+        to the end of each match as it is yielded, so that the next match is
+        searched for only in the data after it. All of the data received is
+        searched, even if more than *window* items arrive at once. The
+        iteration ends without an exception when *timeout* seconds have
+        passed, when no new data arrives for *idle_timeout* seconds, or when
+        the stream adapter raises `ExpectEOF`.
+
+        Other *expect* methods should not be called until the iteration has
+        ended.
+
+        :param Searcher searcher: :class:`Searcher` to apply to underlying
+            stream.
+        :param float timeout: Total time in seconds to search for, or ``None``
+            for no limit.
+        :param float idle_timeout: Time in seconds to wait for new data, or
+            ``None`` to wait until *timeout* has passed.
+        """
+        iteration = _MatchIteration(self, searcher, timeout, idle_timeout,
+                                    time.time)
+        while True:
+            match = iteration.search()
+            if match is not None:
+                yield match
+                continue
+            try:
+                incoming = self._stream_adapter.poll(iteration.wait())
+            except (ExpectTimeout, ExpectEOF):
+                return
+            self._feed(incoming)
+
+
+class _MatchIteration(object):
+    """The progress of an *iter_matches* call through the stream of
+    *expecter*, with the time read from *clock*."""
+
+    def __init__(self, expecter, searcher, timeout, idle_timeout, clock):
+        if timeout is None and idle_timeout is None:
+            raise ValueError('timeout or idle_timeout must be given')
+        self.expecter = expecter
+        self.searcher = searcher
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.end = None if timeout is None else clock() + float(timeout)
+        self.state = _search_state(searcher)
+        self.offset = 0
+
+    def search(self):
+        """Return and consume the next match in the history, or ``None``"""
+        expecter = self.expecter
+        length = len(expecter._history)
+        if length < self.offset:
+            return None
+        match = expecter._search(self.searcher, self.state, self.offset)
+        if not match:
+            # Items trimmed from the history come first from those before
+            # the offset
+            trimmed = length - len(expecter._history)
+            self.offset = max(self.offset - trimmed, 0)
+            return None
+        # The rest of the history follows the match, and is unsearched.
+        # After an empty match, the search resumes one item past it, so that
+        # it isn't matched again.
+        self.state = _search_state(self.searcher)
+        self.offset = 1 if match.start == match.end else 0
+        return expecter._consume(match, trim=False)
+
+    def wait(self):
+        """Return how long to wait for more data"""
+        if self.end is None:
+            return float(self.idle_timeout)
+        wait = self.end - self.clock()
+        if self.idle_timeout is not None:
+            wait = min(wait, float(self.idle_timeout))
+        return wait
+
 
 class BytesExpecter(Expecter, ExpectBytesMixin, ExpectRegexMixin):
     """:class:`Expecter` interface for searching a byte-oriented stream."""
 
     def __init__(self, stream_adapter, input_callback=None, window=1024,
-                 close_adapter=True):
+                 close_adapter=True, searcher_cache=None, trim_history=False,
+                 history=None, collect_stats=False):
         """
         :param StreamAdapter stream_adapter: The :class:`StreamAdapter` object
             to receive data from.
@@ -641,11 +2662,28 @@ class BytesExpecter(Expecter, ExpectBytesMixin, ExpectRegexMixin):
             that is called each time new data is read from the
             *stream_adapter*.
         :param int window: Number of historical bytes to buffer.
+        :param SearcherCache searcher_cache: Cache of searchers used by the
+            ``expect_*`` convenience methods. Defaults to the module-wide
+            :data:`default_searcher_cache`.
+        :param bool trim_history: If ``True``, keep only as much history as
+            the searcher could still match while waiting for a match.
+        :param SpillHistory history: An empty :class:`SpillHistory` in which
+            to keep the history, for windows too large to hold in memory. If
+            ``None``, the history is kept in memory.
+        :param bool collect_stats: If ``True``, record an :class:`ExpectStats`
+            for each *expect* call in *last_stats*.
         """
         super(BytesExpecter, self).__init__(stream_adapter, input_callback,
-                                            window, close_adapter)
-        self._history = six.binary_type()
-        self._start = 0
+                                            window, close_adapter,
+                                            searcher_cache, trim_history,
+                                            collect_stats)
+        if history is None:
+            # Holds only unconsumed data. Appending to and deleting from the
+            # front of a bytearray does not copy the rest of the buffer.
+            history = bytearray()
+        elif len(history):
+            raise ValueError('history must be empty')
+        self._history = history
 
     def expect(self, searcher, timeout=3):
         """Wait for input matching *searcher*
@@ -660,24 +2698,58 @@ class BytesExpecter(Expecter, ExpectBytesMixin, ExpectRegexMixin):
             stream.
         :param float timeout: Timeout in seconds.
         """
+        if self.collect_stats:
+            return self._measured_expect(searcher, timeout)
         timeout = float(timeout)
         end = time.time() + timeout
-        match = searcher.search(self._history[self._start:])
+        state = _search_state(searcher)
+        match = self._search(searcher, state)
         while not match:
             # poll() will raise ExpectTimeout if time is exceeded
-            incoming = self._stream_adapter.poll(end - time.time())
-            self.input_callback(incoming)
-            self._history += incoming
-            match = searcher.search(self._history[self._start:])
-            trimlength = len(self._history) - self._window
-            if trimlength > 0:
-                self._start -= trimlength
-                self._history = self._history[trimlength:]
-
-        self._start += match.end
-        if (self._start < 0):
-            self._start = 0
+            self._feed(self._stream_adapter.poll(end - time.time()))
+            match = self._search(searcher, state)
+        return self._consume(match)
+
+    def _feed(self, incoming):
+        """Add data received from the stream adapter to the history"""
+        self.input_callback(incoming)
+        self._history += incoming
+
+    def _search(self, searcher, state, offset=0):
+        """Search the history, trimming it to the window if there's no match
+
+        The search begins *offset* items into the history, and the state is
+        relative to that index, but anchors still see the items before it.
+        """
+        # The history is searched in place, without copying it into bytes
+        if isinstance(self._history, bytearray):
+            match = _resume(searcher, self._history, state, 0, None, offset)
+        else:
+            buf, start = self._history.contents()
+            match = _resume(searcher, buf, state, start, None, start + offset)
+        if match and offset:
+            match.start += offset
+            match.end += offset
+        trimlength = len(self._history) - self._retain(searcher, state)
+        if trimlength > 0 and not match:
+            del self._history[:trimlength]
+            state.discard(max(trimlength - offset, 0))
+        return match
 
+    def _consume(self, match, trim=True):
+        """Remove the history up to the end of *match* and return *match*
+
+        If *trim* is ``False``, the history after the match is kept in full
+        rather than trimmed to the window, so that it can still be searched.
+        """
+        # Matches slice the history, but callers expect bytes that don't
+        # refer to the history, which is modified below
+        if isinstance(match.match, (bytearray, memoryview)):
+            match.match = _to_bytes(match.match)
+        del self._history[:match.end]
+        trimlength = len(self._history) - self._window
+        if trim and trimlength > 0:
+            del self._history[:trimlength]
         return match
 
 
@@ -685,7 +2757,8 @@ class TextExpecter(Expecter, ExpectTextMixin, ExpectRegexMixin):
     """:class:`Expecter` interface for searching a text-oriented stream."""
 
     def __init__(self, stream_adapter, input_callback=None, window=1024,
-                 close_adapter=True):
+                 close_adapter=True, searcher_cache=None, trim_history=False,
+                 collect_stats=False):
         """
         :param StreamAdapter stream_adapter: The :class:`StreamAdapter` object
             to receive data from.
@@ -693,11 +2766,20 @@ class TextExpecter(Expecter, ExpectTextMixin, ExpectRegexMixin):
             that is called each time new data is read from the
             *stream_adapter*.
         :param int window: Number of historical characters to buffer.
+        :param SearcherCache searcher_cache: Cache of searchers used by the
+            ``expect_*`` convenience methods. Defaults to the module-wide
+            :data:`default_searcher_cache`.
+        :param bool trim_history: If ``True``, keep only as much history as
+            the searcher could still match while waiting for a match.
+        :param bool collect_stats: If ``True``, record an :class:`ExpectStats`
+            for each *expect* call in *last_stats*.
         """
         super(TextExpecter, self).__init__(stream_adapter, input_callback,
-                                           window, close_adapter)
-        self._history = six.text_type()
-        self._start = 0
+                                           window, close_adapter,
+                                           searcher_cache, trim_history,
+                                           collect_stats)
+        # Holds only unconsumed data
+        self._history = _TextHistory()
 
     def expect(self, searcher, timeout=3):
         """Wait for input matching *searcher*.
@@ -712,36 +2794,868 @@ class TextExpecter(Expecter, ExpectTextMixin, ExpectRegexMixin):
             stream.
         :param float timeout: Timeout in seconds.
         """
+        if self.collect_stats:
+            return self._measured_expect(searcher, timeout)
         timeout = float(timeout)
         end = time.time() + timeout
-        match = searcher.search(self._history[self._start:])
+        state = _search_state(searcher)
+        match = self._search(searcher, state)
         while not match:
             # poll() will raise ExpectTimeout if time is exceeded
-            incoming = self._stream_adapter.poll(end - time.time())
-            self.input_callback(incoming)
-            self._history += incoming
-            match = searcher.search(self._history[self._start:])
-            trimlength = len(self._history) - self._window
-            if trimlength > 0:
-                self._start -= trimlength
-                self._history = self._history[trimlength:]
-
-        self._start += match.end
-        if (self._start < 0):
-            self._start = 0
+            self._feed(self._stream_adapter.poll(end - time.time()))
+            match = self._search(searcher, state)
+        return self._consume(match)
+
+    def _feed(self, incoming):
+        """Add text received from the stream adapter to the history"""
+        self.input_callback(incoming)
+        self._history.append(incoming)
+
+    def _search(self, searcher, state, offset=0):
+        """Search the history, trimming it to the window if there's no match
+
+        The search begins *offset* items into the history, and the state is
+        relative to that index, but anchors still see the items before it.
+        """
+        # Only the text that the search examines is joined into one string,
+        # and the state is shifted to refer to it while searching
+        skip = 0
+        if not offset and not getattr(state, 'reset_on_discard', True):
+            skip = getattr(state, 'resume_from', 0)
+        text, start, skipped = self._history.region(skip)
+        if skipped:
+            state.discard(skipped)
+        match = _resume(searcher, text, state, start, None, start + offset)
+        if match:
+            match.start += skipped + offset
+            match.end += skipped + offset
+        elif skipped:
+            state._shift(skipped)
+        retain = self._retain(searcher, state)
+        tail = _stable_tail(text, start, retain, self._window)
+        if skipped and tail == len(text) - start:
+            # The tail may extend into the text that was left out
+            text, start = self._history.contents()
+            tail = _stable_tail(text, start, retain, self._window)
+        trimlength = len(self._history) - tail
+        if trimlength > 0 and not match:
+            self._history.discard(trimlength)
+            state.discard(max(trimlength - offset, 0))
+        return match
 
+    def _consume(self, match, trim=True):
+        """Remove the history up to the end of *match* and return *match*
+
+        If *trim* is ``False``, the history after the match is kept in full
+        rather than trimmed to the window, so that it can still be searched.
+        """
+        self._history.discard(match.end)
+        trimlength = len(self._history) - self._window
+        if trim and trimlength > 0:
+            self._history.discard(trimlength)
         return match
 
 
+class _AsyncExpectMixin(object):
+    """Implement *expect* over a :class:`StreamAdapter` that returns futures.
+
+    Uses the *_feed*, *_search* and *_consume* methods of the synchronous
+    *Expecter* it is mixed into, so that matching behaves exactly the same.
+    """
+
+    def iter_matches(self, searcher, timeout=None, idle_timeout=3):
+        """Iterate asynchronously over every match of *searcher*.
+
+        Returns an asynchronous iterator, for use with ``async for``, that
+        searches the stream in the same way as :func:`Expecter.iter_matches`,
+        and ends when *timeout* seconds have passed, when no new data arrives
+        for *idle_timeout* seconds, or when the stream adapter raises
+        `ExpectEOF`.
+
+        :param Searcher searcher: :class:`Searcher` to apply to underlying
+            stream.
+        :param float timeout: Total time in seconds to search for, or ``None``
+            for no limit.
+        :param float idle_timeout: Time in seconds to wait for new data, or
+            ``None`` to wait until *timeout* has passed.
+        """
+        return _AsyncMatches(self, _MatchIteration(
+            self, searcher, timeout, idle_timeout, _event_loop().time))
+
+    def expect(self, searcher, timeout=3):
+        """Wait for input matching *searcher*.
+
+        Returns an :class:`asyncio.Future` that resolves to the match result
+        once input matching *searcher* is received, or raises
+        :class:`ExpectTimeout` if no match is found within *timeout* seconds.
+        Cancelling the future stops waiting without losing any received data.
+
+        :param Searcher searcher: :class:`Searcher` to apply to underlying
+            stream.
+        :param float timeout: Timeout in seconds.
+        """
+        stats = None
+        if self.collect_stats:
+            stats = self.last_stats = ExpectStats()
+        loop = _event_loop()
+        end = loop.time() + float(timeout)
+        state = _search_state(searcher)
+
+        def search():
+            if stats is None:
+                match = self._search(searcher, state)
+            else:
+                match = self._measured_search(searcher, state, stats)
+            if not match:
+                return None
+            if stats is not None:
+                stats.matched = True
+            return self._consume(match)
+
+        return self._wait_for(search, lambda: end - loop.time(), stats)
+
+    def _wait_for(self, search, wait, stats=None, stop=None):
+        """Return a future resolving to the first result of *search* that is
+        not ``None``, polling the stream adapter for up to *wait()* seconds
+        while there is none.
+
+        The time spent is recorded in the :class:`ExpectStats` *stats*, if it
+        is given. If *stop* is given, `ExpectTimeout` and `ExpectEOF` raised
+        by the stream adapter are replaced by it.
+        """
+        result = _event_loop().create_future()
+        polls = []
+        started = [_clock(), None]
+
+        def step(poll=None):
+            if result.done():
+                if poll is not None and not poll.cancelled() and \
+                        poll.exception() is None:
+                    # Keep the data received after the future was cancelled
+                    self._feed(poll.result())
+                return
+            if poll is not None and poll.cancelled():
+                result.cancel()
+                return
+            try:
+                if poll is not None:
+                    if stats is not None:
+                        stats.poll_time += _clock() - started[1]
+                        stats.polls += 1
+                    incoming = poll.result()
+                    if stats is not None:
+                        stats.received += len(incoming)
+                    self._feed(incoming)
+                match = search()
+                if match is not None:
+                    result.set_result(match)
+                    return
+                started[1] = _clock()
+                polls.append(self._stream_adapter.poll(wait()))
+            except (ExpectTimeout, ExpectEOF) as e:
+                result.set_exception(e if stop is None else stop())
+                return
+            except Exception as e:
+                result.set_exception(e)
+                return
+            polls[-1].add_done_callback(step)
+
+        def finish(_):
+            if stats is not None:
+                stats.wall_time = _clock() - started[0]
+            for poll in polls:
+                poll.cancel()
+
+        result.add_done_callback(finish)
+        step()
+        return result
+
+    def __aenter__(self):
+        future = _event_loop().create_future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, type_, value, traceback):
+        future = _event_loop().create_future()
+        future.set_result(self.__exit__(type_, value, traceback))
+        return future
+
+
+class _AsyncMatches(object):
+    """Asynchronous iterator returned by *iter_matches* of the asynchronous
+    expecters."""
+
+    def __init__(self, expecter, iteration):
+        self._expecter = expecter
+        self._iteration = iteration
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._expecter._wait_for(self._iteration.search,
+                                        self._iteration.wait,
+                                        stop=StopAsyncIteration)
+
+
+class AsyncBytesExpecter(_AsyncExpectMixin, BytesExpecter):
+    """:class:`BytesExpecter` for use with :mod:`asyncio`.
+
+    Searches a byte-oriented stream in the same way as :class:`BytesExpecter`,
+    but *expect* and the ``expect_*`` methods return a future that is awaited
+    instead of blocking, so that a single thread can wait on many streams.
+    Usually created by :func:`wrap_async`::
+
+        reader, writer = await asyncio.open_connection(host, port)
+        expecter = streamexpect.wrap_async(reader, writer)
+        writer.write(b'status\r\n')
+        match = await expecter.expect_bytes(b'ready', timeout=5)
+
+    The stream adapter must be an :class:`AsyncStreamAdapter` or another
+    adapter whose *poll* method returns an :class:`asyncio.Future`.
+    """
+
+
+class AsyncTextExpecter(_AsyncExpectMixin, TextExpecter):
+    """:class:`TextExpecter` for use with :mod:`asyncio`.
+
+    Searches a text-oriented stream in the same way as :class:`TextExpecter`,
+    but *expect* and the ``expect_*`` methods return a future that is awaited
+    instead of blocking. The stream adapter must return futures resolving to
+    text, such as an :class:`AsyncStreamAdapter` with an *encoding*.
+    """
+
+
+class ExpectMultiplexer(object):
+    """Wait for matches on many expecters at once.
+
+    Holds pairs of a :class:`BytesExpecter` or :class:`TextExpecter` and the
+    :class:`Searcher` to apply to it, and waits on the streams of all of them
+    together, either for the first match (:func:`expect_any`) or for a match
+    on every expecter (:func:`expect_all`). Data received while waiting is
+    added to each expecter's history as if the expecter had received it
+    itself, and the history of an expecter that matches is consumed up to the
+    end of its match.
+
+    The streams of expecters using a :class:`SelectorStreamAdapter`, or a
+    polling adapter over a selectable stream, are waited on together with a
+    single selector. Other adapters are polled every *poll_period* seconds.
+    """
+
+    # Adapters that only read their stream when polled, so that waiting on
+    # the stream shows when a poll will return data
+    SELECTABLE_ADAPTERS = (SelectorStreamAdapter, PollingStreamAdapter,
+                           PollingSocketStreamAdapter)
+
+    def __init__(self, pairs=(), poll_period=0.1):
+        """
+        :param pairs: Iterable of ``(expecter, searcher)`` tuples.
+        :param float poll_period: Time (in seconds) between polls of
+            expecters whose streams can't be waited on with a selector.
+        """
+        self._pairs = []
+        for expecter, searcher in pairs:
+            self.add(expecter, searcher)
+        self.poll_period = poll_period
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._pairs)
+
+    @property
+    def pairs(self):
+        """List of the ``(expecter, searcher)`` pairs, in the order added"""
+        return list(self._pairs)
+
+    @property
+    def poll_period(self):
+        return self._poll_period
+
+    @poll_period.setter
+    def poll_period(self, value):
+        value = float(value)
+        if value <= 0:
+            raise ValueError('poll_period must be greater than 0')
+        self._poll_period = value
+
+    def add(self, expecter, searcher):
+        """Add an *expecter* and the *searcher* to apply to its stream.
+
+        :param expecter: :class:`BytesExpecter` or :class:`TextExpecter` to
+            wait on. Each expecter may only be added once.
+        :param Searcher searcher: :class:`Searcher` to apply to the stream.
+        """
+        if not isinstance(expecter, (BytesExpecter, TextExpecter)) or \
+                isinstance(expecter, _AsyncExpectMixin):
+            raise TypeError('expecter must be a BytesExpecter or '
+                            'TextExpecter')
+        if any(x is expecter for x, _ in self._pairs):
+            raise ValueError('expecter has already been added')
+        self._pairs.append((expecter, searcher))
+
+    def expect_any(self, timeout=3):
+        """Wait for the first expecter to match.
+
+        Returns a tuple of the first expecter to match and its match result.
+        If none of the expecters matches within *timeout* seconds, raises an
+        :class:`ExpectTimeout` exception.
+
+        :param float timeout: Timeout in seconds.
+        """
+        matches = self._expect(timeout, 1)
+        for (expecter, _), match in zip(self._pairs, matches):
+            if match:
+                return expecter, match
+
+    def expect_all(self, timeout=3):
+        """Wait for every expecter to match.
+
+        Returns a list of the match results, in the order the expecters were
+        added. If not every expecter matches within *timeout* seconds, raises
+        an :class:`ExpectTimeout` exception, which has a *matches* attribute
+        holding the same list, with ``None`` for the expecters that did not
+        match.
+
+        :param float timeout: Timeout in seconds.
+        """
+        return self._expect(timeout, len(self._pairs))
+
+    def _expect(self, timeout, wanted):
+        """Wait until *wanted* expecters match, returning a list of matches"""
+        end = time.time() + float(timeout)
+        matches = [None] * len(self._pairs)
+        states = [_search_state(searcher) for _, searcher in self._pairs]
+        found = [0]
+
+        def search(index):
+            expecter, searcher = self._pairs[index]
+            match = expecter._search(searcher, states[index])
+            if match:
+                matches[index] = expecter._consume(match)
+                found[0] += 1
+            return match
+
+        # Data received earlier may already match
+        polled = []
+        # What each selected expecter is registered by, to unregister it
+        keys = {}
+        selector = _StreamSelector()
+
+        def drop(index):
+            """Stop waiting for the expecter at *index*"""
+            if index in keys:
+                selector.unregister(keys.pop(index))
+            else:
+                polled.remove(index)
+
+        try:
+            for index, (expecter, _) in enumerate(self._pairs):
+                if search(index):
+                    if found[0] >= wanted:
+                        return matches
+                    continue
+                adapter = expecter.stream_adapter
+                if isinstance(adapter, FdStreamAdapter):
+                    keys[index] = adapter.fd
+                elif isinstance(adapter, self.SELECTABLE_ADAPTERS) and \
+                        _selectable(adapter.stream):
+                    keys[index] = adapter.stream
+                else:
+                    polled.append(index)
+                    continue
+                selector.register(keys[index], index)
+
+            while True:
+                remaining = end - time.time()
+                wait = remaining
+                if polled:
+                    wait = min(wait, self._poll_period)
+                ready = selector.select(wait)
+                for index in ready + polled:
+                    expecter, _ = self._pairs[index]
+                    adapter = expecter.stream_adapter
+                    try:
+                        incoming = adapter.poll(0)
+                    except ExpectEOF:
+                        drop(index)
+                        continue
+                    except ExpectTimeout:
+                        if index in ready and \
+                                not isinstance(adapter, FdStreamAdapter):
+                            # Readable without data: the stream has ended
+                            drop(index)
+                        continue
+                    expecter._feed(incoming)
+                    if not search(index):
+                        continue
+                    if found[0] >= wanted:
+                        return matches
+                    drop(index)
+                if remaining <= 0:
+                    error = ExpectTimeout()
+                    error.matches = matches
+                    raise error
+        finally:
+            selector.close()
+
+
+def _stable_tail(text, start, count, limit):
+    """Return the length of the shortest tail of ``text[start:]`` holding
+    *count* stable characters, up to at most *limit* characters.
+
+    Normalized text searches back up over stable characters, such as ASCII
+    characters, to find matches that straddle old and new text, as each
+    starts at least one normalized character, so this is how much text such
+    a search may examine again.
+    """
+    if count >= limit:
+        return limit
+    if not count:
+        return 0
+    stop = max(start, len(text) - limit)
+    # Search a growing tail, so that the whole of a long text is not reversed
+    size = 4 * count
+    while True:
+        begin = max(stop, len(text) - size)
+        found = next(itertools.islice(
+            _STABLE.finditer(text[begin:][::-1]), count - 1, None), None)
+        if found is not None:
+            return found.end()
+        if begin == stop:
+            return len(text) - stop
+        size *= 4
+
+
+class _TextHistory(object):
+    """Text buffer stored as a list of chunks.
+
+    Appending text adds a chunk, and discarding text from the front drops
+    whole chunks and records an offset into the first remaining chunk, so
+    neither operation copies the rest of the buffer. Contiguous text is only
+    built when :func:`contents` or :func:`region` is called, and is kept as a
+    single chunk so that repeated calls without new data do not copy it
+    again.
+    """
+
+    def __init__(self):
+        self._chunks = deque()
+        self._offset = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, text):
+        """Add *text* to the end of the buffer."""
+        if text:
+            self._chunks.append(text)
+            self._length += len(text)
+
+    def discard(self, count):
+        """Remove up to *count* characters from the front of the buffer."""
+        count = min(int(count), self._length)
+        self._length -= count
+        count += self._offset
+        while self._chunks and count >= len(self._chunks[0]):
+            count -= len(self._chunks.popleft())
+        self._offset = count
+
+    def contents(self):
+        """Return a text object and the index at which the buffer starts in it.
+
+        Discarded text before the index is only removed once it makes up most
+        of the text object, so that discarding text does not usually require
+        a copy of the rest of the buffer.
+        """
+        if self._offset > self._length:
+            self._chunks[0] = self._chunks[0][self._offset:]
+            self._offset = 0
+        if len(self._chunks) > 1:
+            joined = six.text_type().join(self._chunks)
+            self._chunks.clear()
+            self._chunks.append(joined)
+        if self._chunks:
+            return self._chunks[0], self._offset
+        return six.text_type(), 0
+
+    def region(self, skip):
+        """Return a text object holding all but up to *skip* characters from
+        the front of the buffer, the index at which the rest of the buffer
+        starts in it, and the number of characters left out.
+
+        Only the chunks holding the rest of the buffer are joined, so the
+        cost of a call does not depend on the number of characters left out.
+        """
+        skip = max(int(skip), 0)
+        if not skip:
+            text, start = self.contents()
+            return text, start, 0
+        keep = self._length - skip
+        if keep <= 0:
+            return six.text_type(), 0, self._length
+        tail = []
+        size = 0
+        while size < keep:
+            chunk = self._chunks.pop()
+            tail.append(chunk)
+            size += len(chunk)
+        tail.reverse()
+        # At least the discarded text at the front of the buffer is cut off
+        cut = size - keep
+        if cut:
+            self._chunks.append(tail[0][:cut])
+            tail[0] = tail[0][cut:]
+        text = six.text_type().join(tail)
+        self._chunks.append(text)
+        return text, 0, self._length - keep
+
+    def text(self):
+        """Return the contents of the buffer as a single text object."""
+        text, start = self.contents()
+        return text[start:]
+
+
+class SpillHistory(object):
+    """Byte history that spills to a temporary file once it grows large.
+
+    Used as the *history* of a :class:`BytesExpecter` to make a very large
+    *window* practical. Up to *memory_limit* bytes are held in memory as
+    usual. Beyond that, the history is written to an anonymous temporary
+    file that is memory-mapped for searching, and new data is buffered in
+    memory until the next search, or until *memory_limit* bytes of it have
+    arrived. Pages of the mapping are backed by the file rather than by the
+    process, so the operating system can reclaim them, and only the pages
+    that are searched need to be resident. Once discarding data brings the
+    history under half of *memory_limit*, it is moved back into memory and
+    the file is closed.
+    """
+
+    def __init__(self, memory_limit=16 * 1024 * 1024, dir=None):
+        """
+        :param int memory_limit: The number of bytes to hold in memory before
+            spilling the history to a file.
+        :param str dir: Directory in which to create the temporary file, or
+            ``None`` for the default temporary directory.
+        """
+        memory_limit = int(memory_limit)
+        if memory_limit < 1:
+            raise ValueError('memory_limit must be at least 1')
+        self.memory_limit = memory_limit
+        self.dir = dir
+        # New data, or the whole history while it is not spilled
+        self._tail = bytearray()
+        self._file = None
+        # Number of bytes written to the file, and discarded from its front
+        self._size = 0
+        self._offset = 0
+        self._view = None
+
+    def __len__(self):
+        return self._size - self._offset + len(self._tail)
+
+    @property
+    def spilled(self):
+        """Read-only property that is ``True`` while the history is in a
+        file"""
+        return self._file is not None
+
+    def __iadd__(self, data):
+        self._tail += data
+        if len(self._tail) > self.memory_limit:
+            self._flush()
+        return self
+
+    def __delitem__(self, key):
+        if (not isinstance(key, slice) or key.start is not None or
+                key.step is not None or key.stop is None or key.stop < 0):
+            raise TypeError('only data from the front of the history can be '
+                            'deleted')
+        self.discard(key.stop)
+
+    def discard(self, count):
+        """Remove up to *count* bytes from the front of the history."""
+        count = min(int(count), len(self))
+        if self._file is None:
+            del self._tail[:count]
+            return
+        spilled = self._size - self._offset
+        if count >= spilled:
+            del self._tail[:count - spilled]
+            self.close()
+            return
+        self._offset += count
+        if len(self) <= self.memory_limit // 2:
+            self._tail[:0] = self._map()[self._offset:]
+            self.close()
+        elif self._offset > self._size // 2:
+            self._compact()
+
+    def contents(self):
+        """Return a buffer holding the history and the index at which the
+        history starts in it.
+
+        While the history is spilled, the buffer is a :class:`memoryview`
+        over the mapped file, which is remapped only after new data has been
+        written to it.
+        """
+        if self._file is None:
+            return self._tail, 0
+        if self._tail:
+            self._flush()
+        return self._map(), self._offset
+
+    def close(self):
+        """Discard any spilled data and close the temporary file."""
+        if self._file is not None:
+            # The mapping is released once the last view of it is dropped
+            self._view = None
+            self._file.close()
+            self._file = None
+            self._size = self._offset = 0
+
+    def _flush(self):
+        """Append the data held in memory to the file, creating it if needed"""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.dir)
+        self._file.write(self._tail)
+        self._size += len(self._tail)
+        del self._tail[:]
+        self._view = None
+
+    def _map(self):
+        """Return a view of the whole file, mapping it if it has grown"""
+        if self._view is None:
+            self._file.flush()
+            self._view = memoryview(mmap.mmap(self._file.fileno(), self._size,
+                                              access=mmap.ACCESS_READ))
+        return self._view
+
+    def _compact(self):
+        """Copy the live part of the file into a new one, once most of the
+        file has been discarded"""
+        view = self._map()
+        compacted = tempfile.TemporaryFile(dir=self.dir)
+        compacted.write(view[self._offset:self._size])
+        self._view = None
+        self._file.close()
+        self._file = compacted
+        self._size -= self._offset
+        self._offset = 0
+
+
 def _echo_text(value):
     sys.stdout.write(value)
 
 
 def _echo_bytes(value):
+    value = _to_bytes(value)
     sys.stdout.write(value.decode('ascii', errors='backslashreplace'))
 
 
-def wrap(stream, unicode=False, window=1024, echo=False, close_stream=True):
+def _input_callback(unicode, echo, transcript):
+    """Return the *input_callback* for the *echo* and *transcript* arguments
+    of the ``wrap`` functions"""
+    if echo:
+        echo = _echo_text if unicode else _echo_bytes
+    else:
+        echo = None
+    if echo is None or transcript is None:
+        return echo or transcript
+
+    def callback(value):
+        echo(value)
+        transcript(value)
+    return callback
+
+
+_transcript_sessions = itertools.count(1)
+
+
+class TranscriptSink(object):
+    """Writes the data received by an :class:`Expecter` to a transcript file.
+
+    A *TranscriptSink* is used as the *input_callback* of an *Expecter*, or
+    as the *transcript* argument of :func:`wrap` and its counterparts. Each
+    call only adds the data to a list in memory, and a background thread
+    writes the collected data to the file in a single write every
+    *flush_interval* seconds, or sooner once *buffer_size* bytes are waiting,
+    so that logging does not delay the search for a match. Text is encoded
+    with *encoding* before it is written.
+
+    If *file* is a path, it may contain ``{pid}`` and ``{session}`` fields,
+    which are replaced by the process ID and a number counting the sinks
+    created by the process, so that each session gets a file of its own.
+    With *max_bytes* set, a file that has reached *max_bytes* bytes is
+    renamed with a ``.1`` suffix, older transcripts move to ``.2`` and so on
+    up to *backup_count*, and a new file is started, as in
+    :class:`logging.handlers.RotatingFileHandler`.
+
+    :func:`close` must be called to write the remaining data and stop the
+    thread; the sink can also be used as a context manager. Errors raised
+    while writing stop the thread, and are raised by the next call.
+    """
+
+    def __init__(self, file, flush_interval=1.0, buffer_size=64 * 1024,
+                 max_bytes=None, backup_count=1, encoding='utf-8'):
+        """
+        :param file: Path of the transcript file, which is appended to, or a
+            file object opened for writing in binary mode, which is not
+            rotated or closed.
+        :param float flush_interval: Maximum time (in seconds) data waits in
+            memory before it is written, or ``None`` to only write it once
+            *buffer_size* bytes are waiting.
+        :param int buffer_size: Number of waiting bytes that causes them to be
+            written straight away.
+        :param int max_bytes: Size at which the file is rotated, or ``None``
+            to never rotate it.
+        :param int backup_count: Number of rotated files to keep.
+        :param str encoding: Encoding used to write text.
+        """
+        if flush_interval is not None:
+            flush_interval = float(flush_interval)
+            if flush_interval <= 0:
+                raise ValueError('flush_interval must be greater than 0')
+        self.flush_interval = flush_interval
+        buffer_size = int(buffer_size)
+        if buffer_size <= 0:
+            raise ValueError('buffer_size must be greater than 0')
+        self.buffer_size = buffer_size
+        if max_bytes is not None:
+            max_bytes = int(max_bytes)
+            if max_bytes <= 0:
+                raise ValueError('max_bytes must be greater than 0')
+        self.max_bytes = max_bytes
+        self.backup_count = int(backup_count)
+        self.encoding = encoding
+
+        if isinstance(file, (six.binary_type, six.text_type)):
+            self.path = file.format(pid=os.getpid(),
+                                    session=next(_transcript_sessions))
+            self._file = open(self.path, 'ab')
+            self._written = self._file.tell()
+        else:
+            self.path = None
+            self._file = file
+            self._written = 0
+
+        self._pending = []
+        self._pending_size = 0
+        self._lock = threading.Lock()
+        # Held while writing, so flush() and the thread write in turn
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run,
+                                        name='TranscriptSink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+    def __call__(self, value):
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise ValueError('transcript sink is closed')
+        if isinstance(value, six.text_type):
+            value = value.encode(self.encoding)
+        else:
+            # The caller may modify or unmap the buffer after the call
+            value = _to_bytes(value)
+        with self._lock:
+            self._pending.append(value)
+            self._pending_size += len(value)
+            # Only wake the thread once, when the buffer fills up
+            full = (self._pending_size >= self.buffer_size >
+                    self._pending_size - len(value))
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write the waiting data to the file and flush it."""
+        if self._error is not None:
+            raise self._error
+        self._write_pending()
+        with self._write_lock:
+            self._file.flush()
+
+    def close(self):
+        """Write the waiting data, stop the thread and close the file."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        try:
+            if self._error is None:
+                self._write_pending()
+                self._file.flush()
+        finally:
+            if self.path is not None:
+                self._file.close()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            while not self._closed:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                self._write_pending()
+                self._file.flush()
+        except Exception as e:
+            self._error = e
+
+    def _write_pending(self):
+        with self._write_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                data = b''.join(self._pending)
+                self._pending = []
+                self._pending_size = 0
+            data = memoryview(data)
+            while data:
+                count = len(data)
+                if self.max_bytes is not None and self.path is not None:
+                    if self._written >= self.max_bytes:
+                        self._rotate()
+                    count = min(count, self.max_bytes - self._written)
+                self._file.write(data[:count])
+                self._written += count
+                data = data[count:]
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path, index)
+            if os.path.exists(source):
+                _replace(source, '%s.%d' % (self.path, index + 1))
+        if self.backup_count > 0:
+            _replace(self.path, self.path + '.1')
+        self._file = open(self.path, 'wb')
+        self._written = 0
+
+
+def _replace(source, destination):
+    """Rename *source* to *destination*, replacing it if it exists"""
+    if os.path.exists(destination):
+        # For backward compatibility with Python < 3.3, which lacks
+        # os.replace, and Windows, where os.rename does not replace
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def wrap(stream, unicode=False, window=1024, echo=False, close_stream=True,
+         threaded=False, transcript=None):
     """Wrap a stream to implement expect functionality.
 
     This function provides a convenient way to wrap any Python stream (a
@@ -750,6 +3664,13 @@ def wrap(stream, unicode=False, window=1024, echo=False, close_stream=True):
     to the stream, while passing normal stream functions like *read*/*recv*
     and *write*/*send* through to the underlying stream.
 
+    Sockets and unbuffered streams with a file descriptor are read using a
+    :class:`SelectorStreamAdapter`, so that data is matched as soon as it
+    arrives. Other streams, including buffered streams and SSL sockets, are
+    polled with a :class:`PollingStreamAdapter` or
+    :class:`PollingSocketStreamAdapter`; pipes are best wrapped with
+    :func:`wrap_fd`.
+
     Here's an example of opening and wrapping a pair of network sockets::
 
         import socket
@@ -769,21 +3690,16 @@ def wrap(stream, unicode=False, window=1024, echo=False, close_stream=True):
     :param bool echo: If ``True``, echoes received characters to stdout.
     :param bool close_stream: If ``True``, and the wrapper is used as a context
         manager, closes the stream at the end of the context manager.
+    :param bool threaded: If ``True``, the stream is read continuously by a
+        :class:`ThreadedStreamAdapter`, even while not waiting for a match.
+    :param TranscriptSink transcript: Optional :class:`TranscriptSink`, or
+        other function with one parameter, that received data is passed to.
     """
-    if hasattr(stream, 'read'):
-        proxy = PollingStreamAdapter(stream)
-    elif hasattr(stream, 'recv'):
-        proxy = PollingSocketStreamAdapter(stream)
-    else:
-        raise TypeError('stream must have either read or recv method')
-
-    if echo and unicode:
-        callback = _echo_text
-    elif echo and not unicode:
-        callback = _echo_bytes
-    else:
-        callback = None
+    proxy = _adapter_for(stream)
+    if threaded:
+        proxy = ThreadedStreamAdapter(proxy)
 
+    callback = _input_callback(unicode, echo, transcript)
     if unicode:
         expecter = TextExpecter(proxy, input_callback=callback, window=window,
                                 close_adapter=close_stream)
@@ -794,21 +3710,368 @@ def wrap(stream, unicode=False, window=1024, echo=False, close_stream=True):
     return expecter
 
 
+def _adapter_for(stream):
+    """Create the :class:`StreamAdapter` best suited to *stream*"""
+    if _selectable(stream):
+        return SelectorStreamAdapter(stream)
+    elif hasattr(stream, 'read'):
+        return PollingStreamAdapter(stream)
+    elif hasattr(stream, 'recv'):
+        return PollingSocketStreamAdapter(stream)
+    else:
+        raise TypeError('stream must have either read or recv method')
+
+
+def wrap_fd(fd, unicode=False, window=1024, echo=False, close_stream=True,
+            write_fd=None, encoding='utf-8', transcript=None):
+    """Wrap a file descriptor to implement expect functionality.
+
+    The counterpart of :func:`wrap` for raw file descriptors, such as pipes,
+    FIFOs and pseudo-terminals, which are read using a
+    :class:`FdStreamAdapter`. Not supported on Windows.
+
+    Here's an example of automating a command through its pipes::
+
+        import subprocess
+        import streamexpect
+
+        proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        expecter = streamexpect.wrap_fd(proc.stdout, write_fd=proc.stdin)
+        expecter.write(b'hello\n')
+        match = expecter.expect_bytes(b'hello', timeout=5)
+
+    :param fd: The file descriptor (or object with a *fileno* method) to
+        read from.
+    :param bool unicode: If ``True``, the wrapper will be configured for
+        Unicode matching, otherwise matching will be done on binary.
+    :param int window: Historical characters to buffer.
+    :param bool echo: If ``True``, echoes received characters to stdout.
+    :param bool close_stream: If ``True``, and the wrapper is used as a context
+        manager, closes the file descriptors at the end of the context
+        manager.
+    :param write_fd: File descriptor (or object with a *fileno* method) that
+        *write* writes to, if different from *fd*.
+    :param str encoding: Encoding used to decode received data if *unicode*
+        is ``True``.
+    :param TranscriptSink transcript: Optional :class:`TranscriptSink`, or
+        other function with one parameter, that received data is passed to.
+    """
+    callback = _input_callback(unicode, echo, transcript)
+    if unicode:
+        proxy = FdStreamAdapter(fd, write_fd, encoding=encoding)
+        return TextExpecter(proxy, input_callback=callback, window=window,
+                            close_adapter=close_stream)
+    else:
+        proxy = FdStreamAdapter(fd, write_fd)
+        return BytesExpecter(proxy, input_callback=callback, window=window,
+                             close_adapter=close_stream)
+
+
+def spawn(argv, unicode=False, window=1024, echo=False, close_stream=True,
+          env=None, cwd=None, encoding='utf-8', transcript=None):
+    """Start a process on a pseudo-terminal and wrap it for expect.
+
+    The process is started in a new session with the pseudo-terminal as its
+    controlling terminal and standard streams, and is read using a
+    :class:`PtyStreamAdapter`, so output is matched as soon as it arrives.
+    The process is available as the *process* attribute of the returned
+    object, and *write*, *wait* and *close* methods write to the terminal,
+    wait for the process to exit, and close the terminal and wait for the
+    process to exit, respectively. Not supported on Windows.
+
+    Here's an example of driving an interactive command::
+
+        import streamexpect
+
+        with streamexpect.spawn(['python', '-i']) as expecter:
+            expecter.expect_bytes(b'>>> ', timeout=5)
+            expecter.write(b'6 * 7\n')
+            expecter.expect_bytes(b'42', timeout=5)
+
+    :param argv: Program and arguments to run, as for
+        :class:`subprocess.Popen`.
+    :param bool unicode: If ``True``, the wrapper will be configured for
+        Unicode matching, otherwise matching will be done on binary.
+    :param int window: Historical characters to buffer.
+    :param bool echo: If ``True``, echoes received characters to stdout.
+    :param bool close_stream: If ``True``, and the wrapper is used as a context
+        manager, closes the terminal and waits for the process at the end of
+        the context manager.
+    :param dict env: Environment for the process, or ``None`` to inherit it.
+    :param str cwd: Working directory for the process.
+    :param str encoding: Encoding used to decode received data if *unicode*
+        is ``True``.
+    :param TranscriptSink transcript: Optional :class:`TranscriptSink`, or
+        other function with one parameter, that received data is passed to.
+    """
+    master_fd, slave_fd = os.openpty()
+    try:
+        process = _popen_on_terminal(argv, slave_fd, env, cwd)
+    except Exception:
+        os.close(master_fd)
+        raise
+    finally:
+        os.close(slave_fd)
+
+    callback = _input_callback(unicode, echo, transcript)
+    if unicode:
+        proxy = PtyStreamAdapter(master_fd, process, encoding=encoding)
+        return TextExpecter(proxy, input_callback=callback, window=window,
+                            close_adapter=close_stream)
+    else:
+        proxy = PtyStreamAdapter(master_fd, process)
+        return BytesExpecter(proxy, input_callback=callback, window=window,
+                             close_adapter=close_stream)
+
+
+def scan_file(path, searcher, workers=None, chunk_size=None):
+    """Find every match of *searcher* in a file, using a pool of processes.
+
+    Finds the same matches, in the same order, as searching the whole file
+    from the start and resuming after the end of each match (as
+    :func:`Expecter.iter_matches` does), but splits the file into chunks
+    that are searched in parallel. Adjacent chunks overlap by the maximum
+    match length of the searcher, less one, so that matches spanning the
+    boundary between chunks are found. Each chunk is searched through a
+    memory map of the file, without reading it into memory.
+
+    *searcher* may be a :class:`BytesSearcher`, a binary
+    :class:`RegexSearcher` or a :class:`SearcherCollection` of them, and must
+    be able to be pickled. If the maximum match length of the searcher is not
+    bounded, or any regex contains anchors or assertions such as "^" or
+    "\b" that would match differently at the start of a chunk, the file is
+    searched as a single chunk.
+
+    Here's an example of searching a captured console log::
+
+        import streamexpect
+
+        searcher = streamexpect.SearcherCollection(
+            streamexpect.BytesSearcher(b'Kernel panic'),
+            streamexpect.RegexSearcher(br'Oops: [0-9a-f]{4}'))
+        for match in streamexpect.scan_file('console.log', searcher):
+            print(match.start, match.match)
+
+    :param str path: Path of the file to search.
+    :param Searcher searcher: :class:`Searcher` to apply to the file.
+    :param int workers: Number of processes to search with, by default the
+        number of CPUs. If 1, the file is searched in this process.
+    :param int chunk_size: Number of bytes in each chunk. By default, the
+        file is split into four chunks for each worker, of at least 1 MiB.
+    :return: List of match objects, whose *start* and *end* are offsets in
+        the file, in the order they occur in the file.
+    """
+    if searcher.match_type is not six.binary_type:
+        raise TypeError('scan_file requires a searcher of binary type')
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    size = os.path.getsize(path)
+    overlap = _chunk_overlap(searcher)
+    if chunk_size is None:
+        chunk_size = max(-(-size // (workers * 4)), 1024 * 1024)
+    chunk_size = int(chunk_size)
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be greater than 0')
+    if overlap is None:
+        chunk_size = max(size, 1)
+    bounds = [(x, min(x + chunk_size, size))
+              for x in range(0, size, chunk_size)]
+    tasks = [(path, searcher, start, end, overlap or 0)
+             for start, end in bounds]
+
+    if workers == 1 or len(tasks) <= 1:
+        results = [_scan_chunk(x) for x in tasks]
+    else:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            results = pool.map(_scan_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Chunks are searched from their start, but the search of the whole file
+    # resumes after the last match of the previous chunk, which may be later.
+    # Matches after that point are found again in this process, until one
+    # is the same as a match of the chunk, after which the two searches agree.
+    candidates = _scan_candidates(searcher)
+    matches = []
+    position = 0
+    for (start, end), found in zip(bounds, results):
+        if position > start:
+            known = dict((x[0], x) for x in found)
+            rescanned = _scan_path(path, searcher, position, end,
+                                   overlap or 0, known)
+            if rescanned and known.get(rescanned[-1][0]) == rescanned[-1]:
+                rescanned += [x for x in found if x[0] > rescanned[-1][0]]
+            found = rescanned
+        for first, last, index, groups, data in found:
+            if groups is None:
+                match = SequenceMatch(candidates[index], data, first, last)
+            else:
+                match = RegexMatch(candidates[index], data, first, last,
+                                   groups)
+            matches.append(match)
+            position = last
+    return matches
+
+
+def _chunk_overlap(searcher):
+    """Return how far chunks searched separately by :func:`scan_file` must
+    overlap, or ``None`` if the file cannot be split into chunks.
+    """
+    widths = []
+    for x in _scan_candidates(searcher):
+        if x is searcher and isinstance(x, SearcherCollection):
+            continue
+        if type(x) not in (BytesSearcher, RegexSearcher):
+            return None
+        if type(x) is RegexSearcher and x._anchored:
+            return None
+        width = x.max_match_length
+        if width is None:
+            return None
+        widths.append(width)
+    return max(max(widths) - 1, 0)
+
+
+def _scan_candidates(searcher):
+    """List the searchers that matches of *searcher* may come from"""
+    if isinstance(searcher, SearcherCollection):
+        return [searcher] + list(searcher)
+    return [searcher]
+
+
+def _scan_chunk(task):
+    """Search one chunk of a file in a :func:`scan_file` worker process"""
+    path, searcher, start, end, overlap = task
+    return _scan_path(path, searcher, start, end, overlap)
+
+
+def _scan_path(path, searcher, start, end, overlap, known=None):
+    """Find the matches of *searcher* in a file that start from *start* up
+    to *end*, searching the file up to *overlap* bytes past *end*.
+
+    Each match is returned as a tuple of its start, end, index in
+    :func:`_scan_candidates`, groups and matched bytes. If *known* is given,
+    the search stops after the first match that is the value of *known* for
+    its start.
+    """
+    if start >= end:
+        return []
+    with open(path, 'rb') as stream:
+        mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Slices of a memoryview, unlike those of the mmap, are not copies
+            return _scan_view(memoryview(mapped), searcher, start, end,
+                              min(end + overlap, len(mapped)), known or {})
+        finally:
+            mapped.close()
+
+
+def _scan_view(view, searcher, position, end, limit, known):
+    """Search *view* for :func:`_scan_path`"""
+    candidates = _scan_candidates(searcher)
+    found = []
+    # Matches starting at the end of a chunk belong to the next chunk, unless
+    # it is the last one, where an empty match may be found at the end
+    if end >= len(view):
+        end += 1
+    while position < end:
+        # Anchors see the items before the position, as they would when
+        # searching the whole file
+        match = _resume(searcher, view, _search_state(searcher), 0, limit,
+                        position)
+        if match is None or position + match.start >= end:
+            break
+        first, last = position + match.start, position + match.end
+        index = next(i for i, x in enumerate(candidates)
+                     if x is match.searcher)
+        found.append((first, last, index, getattr(match, 'groups', None),
+                      _to_bytes(match.match)))
+        if known.get(first) == found[-1]:
+            break
+        # An empty match would be found again at the same position
+        position = last if last > first else last + 1
+    return found
+
+
+def wrap_async(reader, writer=None, unicode=False, window=1024, echo=False,
+               close_stream=True, encoding='utf-8', transcript=None):
+    """Wrap an :mod:`asyncio` stream to implement expect functionality.
+
+    The :mod:`asyncio` counterpart of :func:`wrap`, returning an
+    :class:`AsyncBytesExpecter` or :class:`AsyncTextExpecter` whose *expect*
+    methods are awaited. Attributes of the *reader* and *writer*, such as
+    *write* and *drain*, are available through the returned object.
+
+    Here's an example of connecting to a server::
+
+        import asyncio
+        import streamexpect
+
+        async def login(host, port):
+            reader, writer = await asyncio.open_connection(host, port)
+            expecter = streamexpect.wrap_async(reader, writer)
+            await expecter.expect_bytes(b'login: ', timeout=5)
+            writer.write(b'root\n')
+
+    :param asyncio.StreamReader reader: The reader to wrap.
+    :param asyncio.StreamWriter writer: Optional writer to send data with.
+    :param bool unicode: If ``True``, the wrapper will be configured for
+        Unicode matching, otherwise matching will be done on binary.
+    :param int window: Historical characters to buffer.
+    :param bool echo: If ``True``, echoes received characters to stdout.
+    :param bool close_stream: If ``True``, and the wrapper is used as a context
+        manager, closes the writer at the end of the context manager.
+    :param str encoding: Encoding used to decode received data if *unicode*
+        is ``True``.
+    :param TranscriptSink transcript: Optional :class:`TranscriptSink`, or
+        other function with one parameter, that received data is passed to.
+    """
+    callback = _input_callback(unicode, echo, transcript)
+    if unicode:
+        proxy = AsyncStreamAdapter(reader, writer, encoding=encoding)
+        return AsyncTextExpecter(proxy, input_callback=callback, window=window,
+                                 close_adapter=close_stream)
+    else:
+        proxy = AsyncStreamAdapter(reader, writer)
+        return AsyncBytesExpecter(proxy, input_callback=callback,
+                                  window=window, close_adapter=close_stream)
+
+
 __all__ = [
     # Functions
     'wrap',
+    'wrap_fd',
+    'spawn',
+    'wrap_async',
+    'scan_file',
+
+    # Transcripts
+    'TranscriptSink',
 
     # Expecter types
+    'ExpectMultiplexer',
     'Expecter',
     'BytesExpecter',
     'TextExpecter',
+    'AsyncBytesExpecter',
+    'AsyncTextExpecter',
+    'SpillHistory',
+    'ExpectStats',
+
+    # Objects
+    'default_searcher_cache',
 
     # Searcher types
     'Searcher',
+    'SearchState',
     'BytesSearcher',
     'TextSearcher',
     'RegexSearcher',
     'SearcherCollection',
+    'SearcherCache',
 
     # Match types
     'SequenceMatch',
@@ -819,7 +4082,14 @@ __all__ = [
     'PollingStreamAdapter',
     'PollingSocketStreamAdapter',
     'PollingStreamAdapterMixin',
+    'SelectorStreamAdapter',
+    'FdStreamAdapter',
+    'PtyStreamAdapter',
+    'MmapReplayAdapter',
+    'ThreadedStreamAdapter',
+    'AsyncStreamAdapter',
 
     # Exceptions
     'ExpectTimeout',
+    'ExpectEOF',
 ]
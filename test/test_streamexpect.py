@@ -6,28 +6,52 @@
 # Copyright (c) 2015 Digi International Inc. All Rights Reserved.
 
 import io
+import mmap
+import os
 import re
+import shutil
+import signal
 import six
 import streamexpect
 import socket
 import sys
+import tempfile
 import testfixtures
+import threading
+import time
 import unittest
 
 from six import u
 
+try:
+    import asyncio
+except ImportError:
+    # For backward compatibility with Python 2
+    asyncio = None
+
+from streamexpect import AsyncStreamAdapter
 from streamexpect import BytesSearcher
 from streamexpect import Expecter
+from streamexpect import ExpectMultiplexer
+from streamexpect import ExpectEOF
 from streamexpect import ExpectTimeout
+from streamexpect import FdStreamAdapter
+from streamexpect import MmapReplayAdapter
 from streamexpect import PollingSocketStreamAdapter
 from streamexpect import PollingStreamAdapter
 from streamexpect import RegexMatch
 from streamexpect import RegexSearcher
 from streamexpect import Searcher
+from streamexpect import SearcherCache
 from streamexpect import SearcherCollection
+from streamexpect import SearchState
+from streamexpect import SelectorStreamAdapter
 from streamexpect import SequenceMatch
+from streamexpect import SpillHistory
 from streamexpect import StreamAdapter
 from streamexpect import TextSearcher
+from streamexpect import ThreadedStreamAdapter
+from streamexpect import TranscriptSink
 
 
 class TestSequenceMatch(unittest.TestCase):
@@ -69,6 +93,28 @@ class EmptyStream(io.RawIOBase):
         return ''
 
 
+class ChunkedStream(io.RawIOBase):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read(self, n):
+        if not self.chunks:
+            return self.chunks
+        return self.chunks.pop(0)
+
+
+def resume_chunks(searcher, chunks):
+    """Resume *searcher* over a buffer grown one chunk at a time"""
+    state = searcher.search_state()
+    buf = chunks[0][:0]
+    for chunk in chunks:
+        buf += chunk
+        match = searcher.resume(buf, state)
+        if match:
+            return match
+
+
 class SearcherTest(unittest.TestCase):
 
     def setUp(self):
@@ -90,6 +136,31 @@ class SearcherTest(unittest.TestCase):
         with self.assertRaises(AttributeError):
             self.searcher.match_type = 'foobar'
 
+    def test_resume(self):
+        with self.assertRaises(NotImplementedError):
+            self.searcher.resume('', self.searcher.search_state())
+
+
+class TestSearchState(unittest.TestCase):
+
+    def test_discard(self):
+        state = SearchState()
+        state.scanned = 10
+        state.discard(4)
+        self.assertEqual(6, state.scanned)
+        state.discard(20)
+        self.assertEqual(0, state.scanned)
+
+    def test_reset_on_discard(self):
+        state = SearchState(reset_on_discard=True)
+        state.scanned = 10
+        state.discard(4)
+        self.assertEqual(0, state.scanned)
+
+    def test_repr(self):
+        # Only check no exceptions thrown
+        repr(SearchState())
+
 
 class TestTextSearcher(unittest.TestCase):
 
@@ -142,6 +213,91 @@ class TestTextSearcher(unittest.TestCase):
             self.assertIsNotNone(searcher.search(composite))
             self.assertIsNotNone(searcher.search(combining))
 
+    def test_resume_split_match(self):
+        uut = TextSearcher(u('epsilon'))
+        match = resume_chunks(uut, [u('pi eps'), u('il'), u('on mu')])
+        self.assertIsNotNone(match)
+        self.assertEqual(3, match.start)
+        self.assertEqual(10, match.end)
+
+    def test_resume_combining_characters(self):
+        # The composite form only appears once the combining character arrives
+        composite = six.unichr(0xC7)
+        uut = TextSearcher(u('a') + composite)
+        chunks = [u('xyza'), six.unichr(0x43), six.unichr(0x0327)]
+        match = resume_chunks(uut, chunks)
+        self.assertIsNotNone(match)
+        self.assertEqual(3, match.start)
+
+    def test_offsets_into_original_text(self):
+        # NFKC expands the ligature into two characters
+        ligature = six.unichr(0xFB01)
+        uut = TextSearcher(u('omega'))
+        buf = ligature + u('ne omega')
+        match = uut.search(buf)
+        self.assertEqual(4, match.start)
+        self.assertEqual(9, match.end)
+        self.assertEqual(u('omega'), match.match)
+
+    def test_offsets_of_combining_characters(self):
+        composite = six.unichr(0xC7)
+        combining = six.unichr(0x43) + six.unichr(0x0327)
+        uut = TextSearcher(u('a') + composite)
+        buf = u('xa') + combining + u('y')
+        match = uut.search(buf)
+        self.assertEqual(1, match.start)
+        self.assertEqual(4, match.end)
+        self.assertEqual(buf[1:4], match.match)
+        match = TextSearcher(u('y')).search(buf)
+        self.assertEqual(4, match.start)
+
+    def test_resume_normalizes_new_text(self):
+        uut = TextSearcher(u('omega'))
+        state = uut.search_state()
+        self.assertIsNone(uut.resume(u('alpha beta'), state))
+        self.assertEqual((10, 5), (state.scanned, state.resume_from))
+        # Searches resume from the last stable characters, as the "a" could
+        # combine with the new text
+        self.assertIsNone(uut.resume(u('alpha beta') + six.unichr(0xC7),
+                                     state))
+        self.assertEqual((11, 5), (state.scanned, state.resume_from))
+
+    def test_resume_non_ascii_text(self):
+        # Searches of CJK text only examine the text received since the last
+        # search, and a few characters before it
+        uut = TextSearcher(u('\u4e8c\u4e09'))
+        state = uut.search_state()
+        text = u('\u4e00') * 1000
+        self.assertIsNone(uut.resume(text, state))
+        self.assertEqual(998, state.resume_from)
+        text += u('\u4e8c')
+        self.assertIsNone(uut.resume(text, state))
+        self.assertEqual(999, state.resume_from)
+        match = uut.resume(text + u('\u4e09'), state)
+        self.assertEqual((1000, 1002), (match.start, match.end))
+
+    def test_resume_after_discard(self):
+        uut = TextSearcher(u('mu'))
+        state = uut.search_state()
+        self.assertIsNone(uut.resume(u('alpha beta'), state))
+        state.discard(6)
+        match = uut.resume(u('beta mu'), state)
+        self.assertIsNotNone(match)
+        self.assertEqual(5, match.start)
+
+    def test_search_offsets(self):
+        combining = six.unichr(0x43) + six.unichr(0x0327)
+        uut = TextSearcher(six.unichr(0x0327) + u('x'))
+        buf = u('a') + combining + u('x') + combining
+        self.assertIsNone(uut.search(buf))
+        # The combining character is not preceded by anything at start
+        match = uut.search(buf, 2)
+        self.assertEqual(0, match.start)
+        self.assertEqual(2, match.end)
+        self.assertEqual(buf[2:4], match.match)
+        self.assertIsNone(uut.search(buf, 2, 3))
+        self.assertIsNone(TextSearcher(u('a')).search(buf, 1))
+
     def test_repr(self):
         # Only check no exceptions thrown
         searcher = TextSearcher(u('rho'))
@@ -182,6 +338,80 @@ class TestBytesSearcher(unittest.TestCase):
         self.assertEqual(0, match.start)
         self.assertEqual(3, match.end)
 
+    def test_resume_split_match(self):
+        uut = BytesSearcher(b'epsilon')
+        match = resume_chunks(uut, [b'pi eps', b'il', b'on mu'])
+        self.assertIsNotNone(match)
+        self.assertEqual(3, match.start)
+        self.assertEqual(10, match.end)
+        self.assertEqual(b'epsilon', match.match)
+
+    def test_resume_skips_scanned_data(self):
+        uut = BytesSearcher(b'one')
+        state = uut.search_state()
+        self.assertIsNone(uut.resume(b'two three', state))
+        self.assertEqual(9, state.scanned)
+        # Data before the overlap is not searched again
+        self.assertIsNone(uut.resume(b'one three', state))
+        match = uut.resume(b'one threeone', state)
+        self.assertEqual(9, match.start)
+
+    def test_resume_empty_pattern(self):
+        uut = BytesSearcher(b'')
+        match = uut.resume(b'', uut.search_state())
+        self.assertIsNotNone(match)
+        self.assertEqual(0, match.start)
+
+    def test_resume_after_discard(self):
+        uut = BytesSearcher(b'gamma')
+        state = uut.search_state()
+        self.assertIsNone(uut.resume(b'alpha gam', state))
+        state.discard(6)
+        match = uut.resume(b'gamma', state)
+        self.assertIsNotNone(match)
+        self.assertEqual(0, match.start)
+
+    def test_search_offsets(self):
+        uut = BytesSearcher(b'mu')
+        buf = b'mu nu mu xi'
+        match = uut.search(buf, 1)
+        self.assertEqual(5, match.start)
+        self.assertEqual(7, match.end)
+        self.assertEqual(b'mu', match.match)
+        self.assertIsNone(uut.search(buf, 1, 7))
+        self.assertEqual(2, uut.search(buf, -7).start)
+
+    def test_buffer_types(self):
+        uut = BytesSearcher(b'mu')
+        buf = b'nu mu xi'
+        mapped = mmap.mmap(-1, len(buf))
+        mapped.write(buf)
+        for value in (bytearray(buf), memoryview(buf), mapped):
+            match = uut.search(value, 1)
+            self.assertEqual(2, match.start)
+            self.assertEqual(4, match.end)
+            self.assertEqual(b'mu', match.match)
+        self.assertTrue(isinstance(uut.search(memoryview(buf)).match,
+                                   memoryview))
+        self.assertIsNone(uut.search(memoryview(buf), 4))
+        mapped.close()
+
+    def test_buffer_pattern(self):
+        uut = BytesSearcher(bytearray(b'mu'))
+        self.assertEqual(3, uut.search(memoryview(b'nu mu')).start)
+
+    def test_resume_offsets(self):
+        uut = BytesSearcher(b'mu')
+        state = uut.search_state()
+        self.assertIsNone(uut.resume(b'mu nu m', state, 2))
+        self.assertEqual(5, state.scanned)
+        match = uut.resume(b'mu nu mu', state, 2)
+        self.assertEqual(4, match.start)
+
+    def test_max_match_length(self):
+        self.assertEqual(2, BytesSearcher(b'mu').max_match_length)
+        self.assertEqual(0, BytesSearcher(b'').max_match_length)
+
     def test_repr(self):
         # Only check no exceptions thrown
         searcher = BytesSearcher(b'\x00\x00')
@@ -235,6 +465,78 @@ class TestRegexSearcher(unittest.TestCase):
         self.assertEqual(9, match.start)
         self.assertEqual(16, match.end)
 
+    def test_resume_bounded(self):
+        uut = RegexSearcher(b'[eu]psilon')
+        state = uut.search_state()
+        self.assertIsNone(uut.resume(b'epsilo', state))
+        self.assertEqual(6, state.scanned)
+        match = uut.resume(b'epsilon', state)
+        self.assertIsNotNone(match)
+        self.assertEqual(0, match.start)
+        self.assertEqual(7, match.end)
+
+    def test_resume_unbounded(self):
+        uut = RegexSearcher(b'a.*z')
+        match = resume_chunks(uut, [b'a' + b'x' * 20, b'x' * 20, b'z'])
+        self.assertIsNotNone(match)
+        self.assertEqual(0, match.start)
+        self.assertEqual(42, match.end)
+
+    def test_max_match_length(self):
+        self.assertEqual(7, RegexSearcher(b'[eu]psilon').max_match_length)
+        self.assertEqual(5, RegexSearcher(b'a(bc){1,2}|d').max_match_length)
+        self.assertIsNone(RegexSearcher(b'a.*z').max_match_length)
+        self.assertIsNone(RegexSearcher(b'a(?=z)').max_match_length)
+
+    def test_resume_word_boundary(self):
+        uut = RegexSearcher(br'\bmu\b')
+        match = resume_chunks(uut, [b'alpha m', b'ux m', b'u'])
+        self.assertIsNotNone(match)
+        self.assertEqual(10, match.start)
+
+    def test_resume_lookahead(self):
+        uut = RegexSearcher(br'mu(?=.*omega)')
+        match = resume_chunks(uut, [b'mu nu', b' xi', b' omega'])
+        self.assertIsNotNone(match)
+        self.assertEqual(0, match.start)
+
+    def test_resume_anchored_after_discard(self):
+        uut = RegexSearcher(b'^beta')
+        state = uut.search_state()
+        self.assertIsNone(uut.resume(b'alpha beta', state))
+        state.discard(6)
+        match = uut.resume(b'beta', state)
+        self.assertIsNotNone(match)
+        self.assertEqual(0, match.start)
+
+    def test_search_offsets(self):
+        uut = RegexSearcher(b'(m|n)u')
+        buf = b'mu nu mu xi'
+        match = uut.search(buf, 1)
+        self.assertEqual(2, match.start)
+        self.assertEqual(4, match.end)
+        self.assertEqual(b'nu', match.match)
+        self.assertEqual((b'n',), match.groups)
+        self.assertIsNone(uut.search(buf, 6, 7))
+
+    def test_search_offsets_anchored(self):
+        # Anchors and lookbehind assertions do not see data before start
+        buf = b'alpha beta'
+        self.assertEqual(0, RegexSearcher(b'^beta').search(buf, 6).start)
+        self.assertEqual(0, RegexSearcher(br'\bet').search(buf, 7).start)
+        self.assertIsNone(RegexSearcher(b'(?<= )beta').search(buf, 6))
+        self.assertIsNone(RegexSearcher(b'beta$').search(buf, 0, 9))
+
+    def test_buffer_types(self):
+        uut = RegexSearcher(b'(m|n)u')
+        for value in (bytearray(b'xi nu'), memoryview(b'xi nu')):
+            match = uut.resume(value, uut.search_state())
+            self.assertEqual(3, match.start)
+            self.assertEqual(b'nu', match.match)
+            self.assertEqual((b'n',), match.groups)
+        with self.assertRaises(TypeError):
+            RegexSearcher(u('nu')).search(bytearray(b'nu'))
+
     def test_repr(self):
         # Only check no exceptions thrown
         searcher = RegexSearcher('[eu]psilon')
@@ -305,6 +607,230 @@ class TestSearcherCollection(unittest.TestCase):
         with self.assertRaises(TypeError):
             uut.search(u('pi omicron mu'))
 
+    def test_resume(self):
+        uut = SearcherCollection([
+            BytesSearcher(b'omicron'),
+            RegexSearcher(b'[eu]psilon'),
+        ])
+        match = resume_chunks(uut, [b'pi omi', b'cron upsil', b'on'])
+        self.assertIsNotNone(match)
+        self.assertEqual(0, uut.index(match.searcher))
+        self.assertEqual(3, match.start)
+
+    def test_literal_bytes_earliest_match(self):
+        searchers = [BytesSearcher(('error %d' % i).encode('ascii'))
+                     for i in range(200)]
+        uut = SearcherCollection(searchers)
+        match = uut.search(b'ok; error 150; error 16; error 1')
+        self.assertIsNotNone(match)
+        # "error 1" is listed first and also matches at the same index
+        self.assertTrue(match.searcher is searchers[1])
+        self.assertEqual(4, match.start)
+        self.assertEqual(b'error 1', match.match)
+        self.assertIsNone(uut.search(b'no errors here'))
+
+    def test_fuse_literals(self):
+        unrelated = [BytesSearcher(b'omicron'), BytesSearcher(b'upsilon')]
+        prefixed = [BytesSearcher(b'ERR 1'), BytesSearcher(b'ERR 22')]
+        # Only literals sharing a prefix are combined by default
+        self.assertIsNone(SearcherCollection(unrelated)._get_alternation())
+        uut = SearcherCollection(prefixed)
+        self.assertIsNotNone(uut._get_alternation())
+        uut.fuse_literals = False
+        self.assertIsNone(uut._get_alternation())
+        self.assertEqual(b'ERR 22', uut.search(b'ok ERR 22').match)
+        uut = SearcherCollection(unrelated, fuse_literals=True)
+        self.assertIsNotNone(uut._get_alternation())
+        self.assertEqual(1, uut.index(uut.search(b'pi upsilon').searcher))
+        uut = SearcherCollection(TextSearcher(u('omega')),
+                                 TextSearcher(u('omicron')))
+        self.assertIsNotNone(uut._get_alternation())
+
+    def test_literal_bytes_tie_uses_first_searcher(self):
+        uut = SearcherCollection(BytesSearcher(b'beta gamma'),
+                                 BytesSearcher(b'beta'))
+        match = uut.search(b'alpha beta gamma')
+        self.assertEqual(0, uut.index(match.searcher))
+        self.assertEqual(16, match.end)
+
+    def test_literal_text_normalized(self):
+        composite = six.unichr(0xC7)
+        combining = six.unichr(0x43) + six.unichr(0x0327)
+        uut = SearcherCollection(TextSearcher(u('omega')),
+                                 TextSearcher(combining))
+        match = uut.search(u('pi ') + composite + u(' omega'))
+        self.assertEqual(1, uut.index(match.searcher))
+        self.assertEqual(3, match.start)
+
+    def test_literal_resume(self):
+        uut = SearcherCollection(BytesSearcher(b'omicron'),
+                                 BytesSearcher(b'upsilon'))
+        match = resume_chunks(uut, [b'pi omi', b'cron upsil', b'on'])
+        self.assertIsNotNone(match)
+        self.assertEqual(0, uut.index(match.searcher))
+        self.assertEqual(3, match.start)
+        match = resume_chunks(uut, [b'pi up', b'silo', b'n'])
+        self.assertEqual(1, uut.index(match.searcher))
+
+    def test_literal_text_resume(self):
+        uut = SearcherCollection(TextSearcher(u('omicron')),
+                                 TextSearcher(u('upsilon')))
+        match = resume_chunks(uut, [u('pi upsi'), u('lon omi'), u('cron')])
+        self.assertEqual(1, uut.index(match.searcher))
+        self.assertEqual(3, match.start)
+
+    def test_modified_after_search(self):
+        uut = SearcherCollection(BytesSearcher(b'omicron'),
+                                 BytesSearcher(b'upsilon'))
+        self.assertIsNone(uut.search(b'pi rho'))
+        uut.append(BytesSearcher(b'rho'))
+        match = uut.search(b'pi rho')
+        self.assertEqual(2, uut.index(match.searcher))
+
+    def test_fuse_regex(self):
+        searchers = [
+            RegexSearcher(u('(o)micron')),
+            RegexSearcher(u('([eu])(psilon)')),
+            RegexSearcher(u('pi')),
+        ]
+        uut = SearcherCollection(searchers, fuse_regex=True)
+        self.assertIsNotNone(uut._get_alternation())
+        match = uut.search(u('rho upsilon omicron pi'))
+        self.assertTrue(match.searcher is searchers[1])
+        self.assertEqual(4, match.start)
+        self.assertEqual(11, match.end)
+        self.assertEqual((u('u'), u('psilon')), match.groups)
+        match = uut.search(u('rho omicron pi'))
+        self.assertTrue(match.searcher is searchers[0])
+        self.assertEqual((u('o'),), match.groups)
+        match = uut.search(u('rho pi'))
+        self.assertTrue(match.searcher is searchers[2])
+        self.assertEqual((), match.groups)
+        self.assertIsNone(uut.search(u('rho')))
+
+    def test_fuse_regex_matches_unfused(self):
+        searchers = [
+            RegexSearcher(b'ab+'),
+            BytesSearcher(b'abbb'),
+            RegexSearcher(br'^x|b(?=c)'),
+            RegexSearcher(b'(?P<name>c+)d?'),
+        ]
+        fused = SearcherCollection(searchers, fuse_regex=True)
+        unfused = SearcherCollection(searchers)
+        self.assertIsNotNone(fused._get_alternation())
+        self.assertIsNone(unfused._get_alternation())
+        for buf in (b'xab', b'abbbc', b'zabbbc', b'cccd', b'zbc', b'zzz'):
+            expected = unfused.search(buf)
+            match = fused.search(buf)
+            if expected is None:
+                self.assertIsNone(match)
+                continue
+            self.assertTrue(match.searcher is expected.searcher)
+            self.assertEqual(expected.match, match.match)
+            self.assertEqual(expected.start, match.start)
+            self.assertEqual(expected.end, match.end)
+            self.assertEqual(getattr(expected, 'groups', None),
+                             getattr(match, 'groups', None))
+
+    def test_fuse_regex_incompatible(self):
+        incompatible = [
+            [RegexSearcher('alpha', re.IGNORECASE), RegexSearcher('beta')],
+            [RegexSearcher(b'alpha', re.IGNORECASE), BytesSearcher(b'beta')],
+            [RegexSearcher(r'(a)\1'), RegexSearcher('beta')],
+            [RegexSearcher('(?P<x>a)'), RegexSearcher('(?P<x>b)')],
+            [RegexSearcher(u('alpha')), TextSearcher(u('beta'))],
+        ]
+        for searchers in incompatible:
+            uut = SearcherCollection(searchers, fuse_regex=True)
+            self.assertIsNone(uut._get_alternation())
+        # Still searches correctly without fusing
+        match = uut.search(u('alpha beta'))
+        self.assertEqual(0, uut.index(match.searcher))
+
+    def test_fuse_regex_resume(self):
+        uut = SearcherCollection(RegexSearcher(b'om[i]cron'),
+                                 RegexSearcher(b'[eu]psilon'),
+                                 fuse_regex=True)
+        match = resume_chunks(uut, [b'pi ups', b'ilo', b'n omicron'])
+        self.assertEqual(1, uut.index(match.searcher))
+        self.assertEqual(3, match.start)
+        uut = SearcherCollection(RegexSearcher(b'a.*z'),
+                                 RegexSearcher(b'[eu]psilon'),
+                                 fuse_regex=True)
+        match = resume_chunks(uut, [b'a' + b'x' * 20, b'x' * 20, b'z'])
+        self.assertEqual(0, uut.index(match.searcher))
+        self.assertEqual(42, match.end)
+
+    def test_constructor_unknown_keyword(self):
+        with self.assertRaises(TypeError):
+            SearcherCollection(BytesSearcher(b'alpha'), fuse=True)
+
+    def test_resume_minimal_searcher(self):
+        # Sub-searchers only need to implement search and match_type
+        MinimalSearcher = type('MinimalSearcher', (object,), {
+            'match_type': six.binary_type,
+            'search': lambda self, buf: BytesSearcher(b'mu').search(buf),
+        })
+        uut = SearcherCollection(MinimalSearcher())
+        match = resume_chunks(uut, [b'pi m', b'u'])
+        self.assertIsNotNone(match)
+        self.assertEqual(3, match.start)
+
+    def test_max_match_length(self):
+        uut = SearcherCollection(BytesSearcher(b'alpha'),
+                                 RegexSearcher(b'be(ta)?'))
+        self.assertEqual(5, uut.max_match_length)
+        uut.append(RegexSearcher(b'gamma+'))
+        self.assertIsNone(uut.max_match_length)
+
+    def test_search_offsets(self):
+        MinimalSearcher = type('MinimalSearcher', (object,), {
+            'match_type': six.binary_type,
+            'search': lambda self, buf: BytesSearcher(b'rho').search(buf),
+        })
+        buf = b'pi xi rho pi'
+        for uut in (SearcherCollection(BytesSearcher(b'pi'),
+                                       BytesSearcher(b'rho')),
+                    SearcherCollection(RegexSearcher(b'^pi'),
+                                       RegexSearcher(b'r.o'),
+                                       fuse_regex=True),
+                    SearcherCollection(RegexSearcher(b'^pi'),
+                                       MinimalSearcher())):
+            match = uut.search(buf, 3)
+            self.assertEqual(3, match.start)
+            self.assertEqual(buf[6:9], match.match)
+            match = uut.search(buf, 10)
+            self.assertEqual(0, match.start)
+            self.assertEqual(b'pi', match.match)
+            self.assertIsNone(uut.search(buf, 7, 10))
+
+    def test_buffer_types(self):
+        # Sub-searchers without resume are given a copy of the binary type
+        searched = []
+
+        def minimal_search(self, buf):
+            searched.append(type(buf))
+            return BytesSearcher(b'rho').search(buf)
+        MinimalSearcher = type('MinimalSearcher', (object,), {
+            'match_type': six.binary_type,
+            'search': minimal_search,
+        })
+        buf = b'pi xi rho pi'
+        for uut in (SearcherCollection(BytesSearcher(b'xi'),
+                                       BytesSearcher(b'rho')),
+                    SearcherCollection(RegexSearcher(b'x.'),
+                                       BytesSearcher(b'rho'),
+                                       fuse_regex=True),
+                    SearcherCollection(RegexSearcher(b'x.'),
+                                       MinimalSearcher())):
+            for value in (bytearray(buf), memoryview(buf)):
+                match = uut.search(value, 4)
+                self.assertEqual(2, match.start)
+                self.assertEqual(b'rho', match.match)
+        self.assertEqual([six.binary_type] * 2, searched)
+        with self.assertRaises(TypeError):
+            SearcherCollection(TextSearcher(u('xi'))).search(bytearray(buf))
+
     def test_repr(self):
         # Only check no exceptions thrown
         searcher = SearcherCollection([TextSearcher(u('epsilon')),
@@ -312,6 +838,74 @@ class TestSearcherCollection(unittest.TestCase):
         repr(searcher)
 
 
+class TestSearcherCache(unittest.TestCase):
+
+    def test_reuse(self):
+        cache = SearcherCache()
+        first = cache.get(BytesSearcher, b'iota')
+        self.assertTrue(first is cache.get(BytesSearcher, b'iota'))
+        self.assertFalse(first is cache.get(BytesSearcher, b'mu'))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(2, len(cache))
+
+    def test_key_includes_type_and_options(self):
+        cache = SearcherCache()
+        regex = cache.get(RegexSearcher, b'iota', 0)
+        self.assertFalse(regex is cache.get(RegexSearcher, u('iota'), 0))
+        self.assertFalse(regex is cache.get(RegexSearcher, b'iota',
+                                            re.IGNORECASE))
+        self.assertFalse(regex is cache.get(BytesSearcher, b'iota'))
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(4, cache.misses)
+
+    def test_eviction(self):
+        cache = SearcherCache(maxsize=2)
+        alpha = cache.get(TextSearcher, u('alpha'))
+        cache.get(TextSearcher, u('beta'))
+        cache.get(TextSearcher, u('alpha'))
+        cache.get(TextSearcher, u('gamma'))
+        self.assertEqual(2, len(cache))
+        self.assertTrue(alpha is cache.get(TextSearcher, u('alpha')))
+        cache.get(TextSearcher, u('beta'))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(4, cache.misses)
+        cache.maxsize = 1
+        self.assertEqual(1, len(cache))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(0, cache.misses)
+
+    def test_disabled(self):
+        cache = SearcherCache(maxsize=0)
+        first = cache.get(BytesSearcher, b'iota')
+        self.assertFalse(first is cache.get(BytesSearcher, b'iota'))
+        self.assertEqual(0, len(cache))
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            SearcherCache(maxsize=-1)
+        cache = SearcherCache()
+        with self.assertRaises(TypeError):
+            cache.get(BytesSearcher, u('iota'))
+        self.assertEqual(0, len(cache))
+
+    def test_expecter(self):
+        cache = SearcherCache()
+        stream = PiecewiseStream(u('tau iota mu iota'), max_chunk=3)
+        wrapper = streamexpect.TextExpecter(PollingStreamAdapter(stream),
+                                            searcher_cache=cache)
+        self.assertTrue(wrapper.searcher_cache is cache)
+        self.assertEqual(u('iota'), wrapper.expect_text(u('iota')).match)
+        self.assertEqual(u('iota'), wrapper.expect_text(u('iota')).match)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+        adapter = PollingStreamAdapter(PiecewiseStream(u('')))
+        self.assertTrue(streamexpect.TextExpecter(adapter).searcher_cache is
+                        streamexpect.default_searcher_cache)
+
+
 class TestStreamAdapter(unittest.TestCase):
 
     def test_constructor(self):
@@ -364,6 +958,58 @@ class TestPollingStreamAdapter(unittest.TestCase):
             with self.assertRaises(ExpectTimeout):
                 adapter.poll(1)
 
+    def test_adaptive_poll_period(self):
+        stream = ChunkedStream([b'alpha', b'', b'', b'', b'', b'', b'beta'])
+        with testfixtures.Replacer() as r:
+            mock_time = testfixtures.test_time(delta=0.01,
+                                               delta_type='seconds')
+            r.replace('streamexpect.time.time', mock_time)
+            sleeps = []
+            r.replace('streamexpect.time.sleep', sleeps.append)
+            adapter = PollingStreamAdapter(stream, poll_period=0.1,
+                                           min_poll_period=0.01,
+                                           poll_backoff=3)
+            self.assertEqual(b'alpha', adapter.poll(10))
+            self.assertEqual(b'beta', adapter.poll(10))
+            self.assertEqual([0.01, 0.03, 0.09, 0.1, 0.1],
+                             [round(x, 6) for x in sleeps])
+            # Polling speeds up again after data is received
+            del sleeps[:]
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0.035)
+            self.assertEqual([0.01, 0.015, 0.005],
+                             [round(x, 6) for x in sleeps])
+
+    def test_bad_adaptive_values(self):
+        adapter = PollingStreamAdapter(EmptyStream(), min_poll_period=0.01)
+        with self.assertRaises(ValueError):
+            adapter.min_poll_period = 0
+        with self.assertRaises(ValueError):
+            adapter.poll_backoff = 0.5
+        adapter.min_poll_period = None
+        self.assertEqual(adapter.poll_period, adapter._poll_wait())
+
+    def test_poll_binary(self):
+        stream = io.BytesIO(b'alpha beta')
+        adapter = PollingStreamAdapter(stream, max_read=6)
+        chunk = adapter.poll(1)
+        self.assertEqual(b'alpha ', chunk)
+        self.assertTrue(type(chunk) is six.binary_type)
+        self.assertEqual(b'beta', adapter.poll(1))
+
+    def test_max_read_limit(self):
+        stream = io.BytesIO(b'x' * 100)
+        adapter = PollingStreamAdapter(stream, max_read=4, max_read_limit=32)
+        sizes = [len(adapter.poll(1)) for _ in range(6)]
+        self.assertEqual([4, 8, 16, 32, 32, 8], sizes)
+        # Short reads shrink the read size back towards max_read
+        stream.write(b'y')
+        stream.seek(-1, io.SEEK_CUR)
+        self.assertEqual(b'y', adapter.poll(1))
+        self.assertEqual(16, adapter._reader.read_size)
+        with self.assertRaises(ValueError):
+            adapter.max_read_limit = 0
+
 
 class TestPollingSocketStreamAdapter(unittest.TestCase):
 
@@ -415,6 +1061,458 @@ class TestPollingSocketStreamAdapter(unittest.TestCase):
             source.close()
             drain.close()
 
+    def test_adaptive_poll_period(self):
+        class Socket(object):
+            def __init__(self, chunks):
+                self.chunks = chunks
+                self.timeouts = []
+
+            def gettimeout(self):
+                return None
+
+            def settimeout(self, value):
+                self.timeouts.append(value)
+
+            def recv(self, size):
+                if self.chunks:
+                    chunk = self.chunks.pop(0)
+                    if chunk:
+                        return chunk
+                raise socket.timeout()
+
+        sock = Socket([b'', b'', b'', b'alpha'])
+        with testfixtures.Replacer() as r:
+            mock_time = testfixtures.test_time(delta=0.01,
+                                               delta_type='seconds')
+            r.replace('streamexpect.time.time', mock_time)
+            adapter = PollingSocketStreamAdapter(sock, poll_period=0.1,
+                                                 min_poll_period=0.02)
+            self.assertEqual(b'alpha', adapter.poll(10))
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0.03)
+        self.assertEqual([0.02, 0.04, 0.08, 0.1, None, 0.02, 0.02, 0.01,
+                          None], [x if x is None else round(x, 6)
+                                  for x in sock.timeouts])
+
+    def test_timeout_does_not_wait_past_deadline(self):
+        source, drain = socket.socketpair()
+        try:
+            adapter = PollingSocketStreamAdapter(drain, poll_period=10)
+            start = time.time()
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0.01)
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            source.close()
+            drain.close()
+
+    def test_restores_timeout(self):
+        source, drain = socket.socketpair()
+        try:
+            drain.settimeout(5)
+            adapter = PollingSocketStreamAdapter(drain, poll_period=1)
+            source.send(b'alpha')
+            self.assertEqual(b'alpha', adapter.poll(2))
+            self.assertEqual(5, drain.gettimeout())
+        finally:
+            source.close()
+            drain.close()
+
+    def test_own_timeout(self):
+        class Socket(object):
+            def __init__(self):
+                self.calls = []
+
+            def gettimeout(self):
+                self.calls.append('gettimeout')
+
+            def settimeout(self, value):
+                self.calls.append(value)
+
+            def recv(self, size):
+                self.calls.append('recv')
+                return b'alpha'
+
+        sock = Socket()
+        adapter = PollingSocketStreamAdapter(sock, poll_period=1,
+                                             own_timeout=True)
+        for _ in range(3):
+            self.assertEqual(b'alpha', adapter.poll(10))
+        self.assertEqual([1, 'recv', 'recv', 'recv'], sock.calls)
+
+
+class TestSelectorStreamAdapter(unittest.TestCase):
+
+    def test_constructor(self):
+        sock = socket.socket()
+        try:
+            adapter = SelectorStreamAdapter(sock, max_read=32)
+            self.assertEqual(32, adapter.max_read)
+            with self.assertRaises(ValueError):
+                adapter.max_read = -1
+        finally:
+            sock.close()
+
+    def test_poll_socket(self):
+        source, drain = socket.socketpair()
+        try:
+            adapter = SelectorStreamAdapter(drain)
+            for chunk in (b'alpha', b' beta', b' gamm', b'a ome'):
+                source.send(chunk)
+                self.assertEqual(chunk, adapter.poll(1.0))
+        finally:
+            source.close()
+            drain.close()
+
+    def test_poll_max_read(self):
+        source, drain = socket.socketpair()
+        try:
+            adapter = SelectorStreamAdapter(drain, max_read=5)
+            source.send(b'alpha beta')
+            self.assertEqual(b'alpha', adapter.poll(1.0))
+            self.assertEqual(b' beta', adapter.poll(1.0))
+        finally:
+            source.close()
+            drain.close()
+
+    def test_poll_max_read_limit(self):
+        source, drain = socket.socketpair()
+        try:
+            adapter = SelectorStreamAdapter(drain, max_read=2,
+                                            max_read_limit=8)
+            source.send(b'alpha beta gamma omega')
+            for chunk in (b'al', b'pha ', b'beta gam', b'ma omega'):
+                self.assertEqual(chunk, adapter.poll(1.0))
+            with self.assertRaises(ValueError):
+                adapter.max_read_limit = -1
+        finally:
+            source.close()
+            drain.close()
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires selectable pipes')
+    def test_poll_pipe(self):
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'rb') as stream:
+            try:
+                adapter = SelectorStreamAdapter(stream)
+                os.write(write_fd, b'alpha')
+                self.assertEqual(b'alpha', adapter.poll(1.0))
+                with self.assertRaises(ExpectTimeout):
+                    adapter.poll(0.01)
+            finally:
+                os.close(write_fd)
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires selectable pipes')
+    def test_poll_buffered_pipe(self):
+        # More than max_read bytes arrive at once, and none of them may be
+        # left in the buffer of the stream
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'rb') as stream:
+            try:
+                adapter = SelectorStreamAdapter(stream, max_read=1000)
+                os.write(write_fd, b'x' * 3000)
+                for _ in range(3):
+                    self.assertEqual(b'x' * 1000, adapter.poll(1.0))
+                with self.assertRaises(ExpectTimeout):
+                    adapter.poll(0.01)
+            finally:
+                os.close(write_fd)
+
+    class HoldingSocket(object):
+        """Socket that holds received data, as an SSL socket does"""
+        def __init__(self, sock, held):
+            self.sock = sock
+            self.held = held
+
+        def fileno(self):
+            return self.sock.fileno()
+
+        def pending(self):
+            return len(self.held)
+
+        def recv(self, size):
+            data, self.held = self.held[:size], self.held[size:]
+            return data
+
+    def test_poll_held_data(self):
+        source, drain = socket.socketpair()
+        try:
+            sock = TestSelectorStreamAdapter.HoldingSocket(drain,
+                                                           b'alpha beta')
+            adapter = SelectorStreamAdapter(sock, max_read=5)
+            self.assertEqual(b'alpha', adapter.poll(0.01))
+            self.assertEqual(b' beta', adapter.poll(0.01))
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0.01)
+            self.assertFalse(streamexpect._selectable(sock))
+        finally:
+            source.close()
+            drain.close()
+
+    def test_timeout(self):
+        source, drain = socket.socketpair()
+        try:
+            adapter = SelectorStreamAdapter(drain)
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0.01)
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0)
+        finally:
+            source.close()
+            drain.close()
+
+    def test_end_of_stream(self):
+        source, drain = socket.socketpair()
+        source.close()
+        try:
+            with testfixtures.Replacer() as r:
+                sleeps = []
+                r.replace('streamexpect.time.sleep', sleeps.append)
+                adapter = SelectorStreamAdapter(drain)
+                with self.assertRaises(ExpectTimeout):
+                    adapter.poll(10)
+                # Waits out the timeout rather than returning immediately
+                self.assertEqual(1, len(sleeps))
+                self.assertTrue(sleeps[0] > 9)
+        finally:
+            drain.close()
+
+    def test_close(self):
+        source, drain = socket.socketpair()
+        try:
+            adapter = SelectorStreamAdapter(drain)
+            source.send(b'alpha')
+            adapter.poll(1.0)
+            adapter.close()
+            self.assertEqual(-1, drain.fileno())
+        finally:
+            source.close()
+            drain.close()
+
+
+@unittest.skipIf(sys.platform == 'win32', 'requires selectable pipes')
+class TestFdStreamAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.open_fds = set([self.read_fd, self.write_fd])
+        self.addCleanup(lambda: [os.close(x) for x in self.open_fds])
+
+    def test_poll(self):
+        adapter = FdStreamAdapter(self.read_fd, max_read=5)
+        os.write(self.write_fd, b'alpha beta')
+        self.assertEqual(b'alpha', adapter.poll(1.0))
+        self.assertEqual(b' beta', adapter.poll(1.0))
+        with self.assertRaises(ExpectTimeout):
+            adapter.poll(0.01)
+
+    def test_end_of_stream(self):
+        adapter = FdStreamAdapter(self.read_fd)
+        os.write(self.write_fd, b'alpha')
+        os.close(self.write_fd)
+        self.open_fds.remove(self.write_fd)
+        self.assertEqual(b'alpha', adapter.poll(1.0))
+        with self.assertRaises(ExpectEOF):
+            adapter.poll(0.01)
+
+    def test_decode(self):
+        adapter = FdStreamAdapter(self.read_fd, encoding='utf-8')
+        data = u('caf\u00e9').encode('utf-8')
+        os.write(self.write_fd, data[:-1])
+        threading.Timer(0.02, os.write, [self.write_fd, data[-1:]]).start()
+        self.assertEqual(u('caf'), adapter.poll(1.0))
+        self.assertEqual(u('\u00e9'), adapter.poll(1.0))
+
+    def test_write_and_close(self):
+        adapter = FdStreamAdapter(self.read_fd, write_fd=self.write_fd)
+        self.assertEqual(5, adapter.write(u('alpha')))
+        self.assertEqual(b'alpha', adapter.poll(1.0))
+        adapter.close()
+        self.open_fds.clear()
+        for fd in (self.read_fd, self.write_fd):
+            with self.assertRaises(OSError):
+                os.fstat(fd)
+
+    def test_multiplexer(self):
+        other_read_fd, other_write_fd = os.pipe()
+        expecters = [streamexpect.wrap_fd(self.read_fd),
+                     streamexpect.wrap_fd(other_read_fd)]
+        try:
+            uut = ExpectMultiplexer((x, BytesSearcher(b'boot'))
+                                    for x in expecters)
+            threading.Timer(0.02, os.write, [other_write_fd, b'boot']).start()
+            expecter, match = uut.expect_any(timeout=1)
+            self.assertTrue(expecter is expecters[1])
+        finally:
+            expecters[1].close()
+            os.close(other_write_fd)
+
+
+class TestMmapReplayAdapter(unittest.TestCase):
+
+    def capture(self, data):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_poll(self):
+        adapter = MmapReplayAdapter(self.capture(b'alpha beta'), max_read=6)
+        try:
+            self.assertEqual(10, len(adapter))
+            chunk = adapter.poll(0)
+            self.assertTrue(isinstance(chunk, memoryview))
+            self.assertEqual(b'alpha ', chunk.tobytes())
+            self.assertEqual(b'beta', adapter.poll(0).tobytes())
+            self.assertEqual(10, adapter.position)
+            with self.assertRaises(ExpectEOF):
+                adapter.poll(10)
+        finally:
+            del chunk
+            adapter.close()
+
+    def test_empty_file(self):
+        with open(self.capture(b''), 'rb') as stream:
+            adapter = MmapReplayAdapter(stream)
+            with self.assertRaises(ExpectEOF):
+                adapter.poll(0)
+
+    def test_expect(self):
+        path = self.capture(b'x' * 100 + b'login: ')
+        adapter = MmapReplayAdapter(path, max_read=32)
+        with streamexpect.BytesExpecter(adapter, window=16) as expecter:
+            match = expecter.expect_bytes(b'login: ')
+            self.assertEqual(b'login: ', match.match)
+            with self.assertRaises(ExpectEOF):
+                expecter.expect_bytes(b'password: ')
+        self.assertTrue(adapter.stream.closed)
+
+    def test_decode(self):
+        path = self.capture(u('caf\u00e9 au lait').encode('utf-8'))
+        adapter = MmapReplayAdapter(path, max_read=4, encoding='utf-8')
+        with streamexpect.TextExpecter(adapter) as expecter:
+            match = expecter.expect_text(u('\u00e9 au'))
+            self.assertEqual(3, match.start)
+
+    def test_echo(self):
+        path = self.capture(b'pi epsilon mu')
+        adapter = MmapReplayAdapter(path, max_read=4)
+        with testfixtures.OutputCapture() as output:
+            with streamexpect.BytesExpecter(
+                    adapter, input_callback=streamexpect._echo_bytes) as uut:
+                uut.expect_bytes(b'epsilon')
+            output.compare('pi epsilon m')
+
+
+class TestThreadedStreamAdapter(unittest.TestCase):
+
+    class FailingAdapter(StreamAdapter):
+        def __init__(self, chunks):
+            super(TestThreadedStreamAdapter.FailingAdapter, self).__init__(
+                None)
+            self.chunks = chunks
+
+        def poll(self, timeout):
+            if self.chunks:
+                return self.chunks.pop(0)
+            raise IOError('device unplugged')
+
+    def setUp(self):
+        self.source, self.drain = socket.socketpair()
+
+    def tearDown(self):
+        self.source.close()
+        self.drain.close()
+
+    def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            time.sleep(0.005)
+        self.fail('condition not met')
+
+    def test_constructor(self):
+        adapter = ThreadedStreamAdapter(self.drain, poll_period=0.01)
+        try:
+            self.assertTrue(isinstance(adapter.adapter, SelectorStreamAdapter))
+            self.assertTrue(adapter.stream is self.drain)
+            with self.assertRaises(ValueError):
+                adapter.poll_period = 0
+            with self.assertRaises(ValueError):
+                ThreadedStreamAdapter(adapter.adapter, max_queued=0)
+        finally:
+            adapter.close()
+
+    def test_poll_coalesces(self):
+        adapter = ThreadedStreamAdapter(
+            SelectorStreamAdapter(self.drain, max_read=5), poll_period=0.01)
+        try:
+            self.source.sendall(b'alpha beta gamma')
+            self.wait_for(lambda: adapter._queue.qsize() == 4)
+            self.assertEqual(b'alpha beta gamma', adapter.poll(1.0))
+            with self.assertRaises(ExpectTimeout):
+                adapter.poll(0.01)
+        finally:
+            adapter.close()
+
+    def test_bounded_queue(self):
+        adapter = ThreadedStreamAdapter(
+            SelectorStreamAdapter(self.drain, max_read=1), max_queued=2,
+            poll_period=0.01)
+        try:
+            self.source.sendall(b'0123456789')
+            self.wait_for(lambda: adapter._queue.full())
+            time.sleep(0.05)
+            self.assertEqual(2, adapter._queue.qsize())
+            received = b''
+            while len(received) < 10:
+                received += adapter.poll(1.0)
+            self.assertEqual(b'0123456789', received)
+        finally:
+            adapter.close()
+
+    def test_memoryview_chunks(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'alpha beta')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        adapter = ThreadedStreamAdapter(MmapReplayAdapter(path, max_read=4),
+                                        poll_period=0.01)
+        try:
+            self.wait_for(lambda: adapter._error is not None)
+            self.assertEqual(b'alpha beta', adapter.poll(1.0))
+            with self.assertRaises(ExpectEOF):
+                adapter.poll(1.0)
+        finally:
+            adapter.close()
+
+    def test_error(self):
+        failing = TestThreadedStreamAdapter.FailingAdapter([b'alpha'])
+        adapter = ThreadedStreamAdapter(failing, poll_period=0.01)
+        self.wait_for(lambda: adapter._error is not None)
+        self.assertEqual(b'alpha', adapter.poll(1.0))
+        with self.assertRaises(IOError):
+            adapter.poll(1.0)
+        with self.assertRaises(IOError):
+            adapter.poll(1.0)
+
+    def test_close(self):
+        adapter = ThreadedStreamAdapter(self.drain, poll_period=0.01)
+        adapter.close()
+        self.assertFalse(adapter._thread.is_alive())
+        self.assertEqual(-1, self.drain.fileno())
+
+    def test_wrap(self):
+        with streamexpect.wrap(self.drain, threaded=True) as wrapper:
+            self.assertTrue(isinstance(wrapper.stream_adapter,
+                                       ThreadedStreamAdapter))
+            self.source.sendall(b'tau iota mu')
+            self.assertEqual(b'iota', wrapper.expect_bytes(b'iota').match)
+            self.assertEqual(b'mu', wrapper.expect_bytes(b'mu').match)
+
 
 class TestExpecter(unittest.TestCase):
 
@@ -445,6 +1543,604 @@ class TestExpecter(unittest.TestCase):
             Expecter(TestExpecter.NoPollMethod(), input_callback=None,
                      window=1024, close_adapter=False)
 
+    def test_iter_matches(self):
+        stream = PiecewiseStream(b'id=1 id=22 junk id=333 id=4', max_chunk=9)
+        expecter = streamexpect.wrap(stream, window=4)
+        matches = expecter.iter_matches(RegexSearcher(br'id=(\d+) '),
+                                        idle_timeout=0.01)
+        self.assertEqual([(b'1',), (b'22',), (b'333',)],
+                         [x.groups for x in matches])
+        # Data after the last match is kept for the next search
+        self.assertEqual(b'id=4', expecter.expect_bytes(b'id=4').match)
+
+    def chunked_adapter(self, chunks):
+        adapter = StreamAdapter(None)
+        chunks = list(reversed(chunks))
+
+        def poll(timeout):
+            if not chunks:
+                raise ExpectTimeout()
+            return chunks.pop()
+
+        adapter.poll = poll
+        return adapter
+
+    def test_trim_history(self):
+        adapter = self.chunked_adapter([b'xxxxxxxxal', b'x' * 20])
+        expecter = streamexpect.BytesExpecter(adapter, window=1024,
+                                              trim_history=True)
+        # Only the tail that could be part of a match is kept
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect(BytesSearcher(b'beta'), timeout=0)
+        self.assertEqual(b'xxxx', bytes(expecter._history))
+        # Searchers without a maximum length keep the window
+        adapter = self.chunked_adapter([b'a' * 30])
+        expecter = streamexpect.BytesExpecter(adapter, window=16,
+                                              trim_history=True)
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect(RegexSearcher(b'a+z'), timeout=0)
+        self.assertEqual(16, len(expecter._history))
+
+    def test_trim_history_anchors(self):
+        # Trimming must not create a buffer start for anchors to match
+        for chunks, pattern in (([b'xfoo', b' '], br'\bfoo\b'),
+                                ([b'abcfoo', b'x'], br'^foo')):
+            expecter = streamexpect.BytesExpecter(self.chunked_adapter(chunks),
+                                                  trim_history=True)
+            with self.assertRaises(ExpectTimeout):
+                expecter.expect_regex(pattern, timeout=0)
+        expecter = streamexpect.TextExpecter(
+            self.chunked_adapter([u('xfoo'), u(' ')]), trim_history=True)
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect_regex(u(r'\bfoo\b'), timeout=0)
+
+    def test_trim_history_straddling_match(self):
+        adapter = self.chunked_adapter([b'xxxxxxxxal', b'pha'])
+        expecter = streamexpect.BytesExpecter(adapter, window=1024,
+                                              trim_history=True)
+        self.assertEqual(b'alpha', expecter.expect_bytes(b'alpha').match)
+
+    def test_trim_history_text(self):
+        # Text is trimmed by ASCII characters, as "e" and the combining
+        # accents after it normalize to fewer characters
+        adapter = self.chunked_adapter([u('xxxxxe\u0301\u0301 '), u('caf')])
+        expecter = streamexpect.TextExpecter(adapter, window=1024,
+                                             trim_history=True)
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect(TextSearcher(u('\u00e9\u0301 cafe')), timeout=0)
+        self.assertEqual(u('xxe\u0301\u0301 caf'), expecter._history.text())
+
+    def test_collect_stats(self):
+        adapter = self.chunked_adapter([b'xxal', b'pha', b'yy'])
+        expecter = streamexpect.BytesExpecter(adapter, collect_stats=True)
+        self.assertTrue(expecter.last_stats is None)
+        expecter.expect_bytes(b'alpha')
+        stats = expecter.last_stats
+        # The second search examines "xxal" again, as it could start a match
+        self.assertEqual((2, 7, 11, True), (stats.polls, stats.received,
+                                            stats.scanned, stats.matched))
+        self.assertTrue(stats.wall_time >= stats.poll_time + stats.search_time)
+        # Stats are recorded for calls that time out
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect_bytes(b'beta', timeout=0)
+        stats = expecter.last_stats
+        self.assertEqual((2, 2, 2, False), (stats.polls, stats.received,
+                                            stats.scanned, stats.matched))
+        repr(stats)
+
+    def test_collect_stats_rescans(self):
+        chunks = [b'x' * 100] * 50
+        # A regex with an unbounded match length searches the whole history
+        # each time
+        expecter = streamexpect.BytesExpecter(
+            self.chunked_adapter(list(chunks)), window=10 ** 6,
+            collect_stats=True)
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect_regex(br'z.*q', timeout=0)
+        self.assertEqual(sum(range(100, 5001, 100)),
+                         expecter.last_stats.scanned)
+        # A collection examines each item once, apart from the overlaps
+        expecter = streamexpect.BytesExpecter(
+            self.chunked_adapter(list(chunks)), window=10 ** 6,
+            collect_stats=True)
+        searcher = SearcherCollection(BytesSearcher(b'zq'),
+                                      RegexSearcher(br'z\d{2}q'))
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect(searcher, timeout=0)
+        self.assertEqual(5000 + 49 * 5, expecter.last_stats.scanned)
+
+    def test_text_search_joins_only_new_text(self):
+        chunks = [u('x') * 1000 for _ in range(5)] + [u('al'), u('pha')]
+        expecter = streamexpect.TextExpecter(self.chunked_adapter(chunks),
+                                             window=10 ** 6)
+        with self.assertRaises(ExpectTimeout):
+            expecter.expect_text(u('alphabet'), timeout=0)
+        # The old text is left in separate chunks
+        self.assertTrue(len(expecter._history._chunks) > 1)
+        self.assertEqual(5005, len(expecter._history))
+        match = expecter.expect_regex(u('x(al)p'))
+        self.assertEqual((4999, 5003), (match.start, match.end))
+
+    def test_iter_matches_text(self):
+        stream = PiecewiseStream(u('a,b,,c,'))
+        expecter = streamexpect.wrap(stream, unicode=True, window=1)
+        matches = expecter.iter_matches(TextSearcher(u(',')), timeout=0.01,
+                                        idle_timeout=None)
+        self.assertEqual([1, 1, 0, 1], [x.start for x in matches])
+
+    def test_iter_matches_end_of_stream(self):
+        adapter = StreamAdapter(None)
+        chunks = [b'ab' * 1000]
+
+        def poll(timeout):
+            if not chunks:
+                raise ExpectEOF()
+            return chunks.pop()
+
+        adapter.poll = poll
+        expecter = streamexpect.BytesExpecter(adapter, window=2)
+        self.assertEqual(1000, len(list(
+            expecter.iter_matches(BytesSearcher(b'ab'), idle_timeout=10))))
+        with self.assertRaises(ValueError):
+            next(expecter.iter_matches(BytesSearcher(b'ab'), timeout=None,
+                                       idle_timeout=None))
+
+    def test_iter_matches_empty(self):
+        # Patterns matching the empty string resume one item past each
+        # empty match, as re.finditer does
+        expecter = streamexpect.BytesExpecter(
+            self.chunked_adapter([b'a12', b'b\n3']))
+        matches = expecter.iter_matches(RegexSearcher(br'[0-9]*'),
+                                        idle_timeout=0)
+        self.assertEqual([(0, b''), (1, b'12'), (0, b''), (1, b''),
+                          (1, b'3'), (0, b'')],
+                         [(x.start, x.match) for x in matches])
+        expecter = streamexpect.TextExpecter(
+            self.chunked_adapter([u('axx'), u('b')]))
+        matches = expecter.iter_matches(RegexSearcher(u('x*')),
+                                        idle_timeout=0)
+        self.assertEqual([u(''), u('xx'), u(''), u('')],
+                         [x.match for x in matches])
+
+    def test_iter_matches_anchored(self):
+        # Anchors see the item before an empty match, as with re.finditer
+        expecter = streamexpect.BytesExpecter(
+            self.chunked_adapter([b'hello world']))
+        matches = expecter.iter_matches(RegexSearcher(br'\b'),
+                                        idle_timeout=0)
+        self.assertEqual([0, 5, 1, 5], [x.start for x in matches])
+
+    def test_iter_matches_empty_trim(self):
+        # The history is trimmed to the window after an empty match
+        expecter = streamexpect.BytesExpecter(
+            self.chunked_adapter([b'foo'] + [b'x' * 1000] * 200), window=16)
+        matches = expecter.iter_matches(RegexSearcher(br'(?=foo)'),
+                                        idle_timeout=0)
+        self.assertEqual(1, len(list(matches)))
+        self.assertEqual(16, len(expecter._history))
+
+
+class TestExpectMultiplexer(unittest.TestCase):
+
+    def setUp(self):
+        self.pairs = [socket.socketpair() for _ in range(3)]
+        self.expecters = [streamexpect.wrap(drain) for _, drain in self.pairs]
+
+    def tearDown(self):
+        for source, drain in self.pairs:
+            source.close()
+            drain.close()
+
+    def send_later(self, index, data, delay=0.02):
+        timer = threading.Timer(delay, self.pairs[index][0].sendall, [data])
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_expect_any(self):
+        uut = ExpectMultiplexer((x, BytesSearcher(b'boot')) for x in
+                                self.expecters)
+        self.assertEqual(3, len(uut))
+        self.pairs[0][0].sendall(b'bo')
+        self.send_later(1, b'booting')
+        expecter, match = uut.expect_any(timeout=1)
+        self.assertTrue(expecter is self.expecters[1])
+        self.assertEqual(b'boot', match.match)
+        self.assertEqual(b'ing', expecter.expect_regex(b'.+').match)
+        # Data read from other streams is kept in their expecters
+        self.pairs[0][0].sendall(b'ot')
+        self.assertEqual(0, self.expecters[0].expect_bytes(b'boot').start)
+
+    def test_expect_all(self):
+        uut = ExpectMultiplexer()
+        for expecter in self.expecters:
+            uut.add(expecter, RegexSearcher(br'up (\d+)'))
+        self.pairs[0][0].sendall(b'up 0')
+        self.send_later(1, b'up 1')
+        self.send_later(2, b'up 2', delay=0.04)
+        matches = uut.expect_all(timeout=1)
+        self.assertEqual([(b'0',), (b'1',), (b'2',)],
+                         [x.groups for x in matches])
+
+    def test_expect_all_timeout(self):
+        uut = ExpectMultiplexer((x, BytesSearcher(b'up')) for x in
+                                self.expecters)
+        self.pairs[0][0].sendall(b'up')
+        self.pairs[2][0].close()
+        with self.assertRaises(ExpectTimeout) as cm:
+            uut.expect_all(timeout=0.05)
+        self.assertEqual(b'up', cm.exception.matches[0].match)
+        self.assertEqual([None, None], cm.exception.matches[1:])
+
+    def test_expect_any_timeout(self):
+        uut = ExpectMultiplexer([(self.expecters[0], BytesSearcher(b'up'))])
+        with self.assertRaises(ExpectTimeout):
+            uut.expect_any(timeout=0)
+
+    def test_history_already_matches(self):
+        self.pairs[1][0].sendall(b'alpha up')
+        self.expecters[1].expect_bytes(b'alpha')
+        uut = ExpectMultiplexer((x, BytesSearcher(b'up')) for x in
+                                self.expecters)
+        expecter, match = uut.expect_any(timeout=0)
+        self.assertTrue(expecter is self.expecters[1])
+        self.assertEqual(1, match.start)
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires selectable pipes')
+    def test_fd_expecters(self):
+        # File descriptor adapters of file objects match and reach the end
+        # of the stream without waiting for them again
+        expecters = []
+        for data in (b'up', b'down'):
+            read_fd, write_fd = os.pipe()
+            os.write(write_fd, data)
+            os.close(write_fd)
+            expecters.append(streamexpect.wrap_fd(os.fdopen(read_fd, 'rb')))
+            self.addCleanup(expecters[-1].close)
+        uut = ExpectMultiplexer((x, BytesSearcher(b'up')) for x in expecters)
+        with self.assertRaises(ExpectTimeout) as cm:
+            uut.expect_all(timeout=0.05)
+        self.assertEqual(b'up', cm.exception.matches[0].match)
+        self.assertTrue(cm.exception.matches[1] is None)
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires selectable pipes')
+    def test_split_character(self):
+        # Part of a character makes the descriptor readable without giving
+        # any text, which must not be taken for the end of the stream
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+        expecter = streamexpect.wrap_fd(os.fdopen(read_fd, 'rb'),
+                                        unicode=True)
+        self.addCleanup(expecter.close)
+        data = u('\u00e9 ok').encode('utf-8')
+        os.write(write_fd, data[:1])
+        timer = threading.Timer(0.05, os.write, [write_fd, data[1:]])
+        timer.start()
+        self.addCleanup(timer.join)
+        uut = ExpectMultiplexer([(expecter, TextSearcher(u('\u00e9 ok')))])
+        found, match = uut.expect_any(timeout=1)
+        self.assertTrue(found is expecter)
+        self.assertEqual(u('\u00e9 ok'), match.match)
+
+    def test_polled_expecter(self):
+        stream = PiecewiseStream(u('tau iota mu'), max_chunk=3)
+        text_expecter = streamexpect.wrap(stream, unicode=True)
+        text_expecter.stream_adapter.poll_period = 0.01
+        uut = ExpectMultiplexer([(self.expecters[0], BytesSearcher(b'mu')),
+                                 (text_expecter, TextSearcher(u('mu')))],
+                                poll_period=0.01)
+        expecter, match = uut.expect_any(timeout=1)
+        self.assertTrue(expecter is text_expecter)
+        self.assertEqual(u('mu'), match.match)
+
+    def test_bad_arguments(self):
+        uut = ExpectMultiplexer()
+        with self.assertRaises(TypeError):
+            uut.add(object(), BytesSearcher(b'up'))
+        uut.add(self.expecters[0], BytesSearcher(b'up'))
+        with self.assertRaises(ValueError):
+            uut.add(self.expecters[0], BytesSearcher(b'down'))
+        with self.assertRaises(ValueError):
+            uut.poll_period = 0
+        self.assertEqual(1, len(uut.pairs))
+
+
+class TestTextHistory(unittest.TestCase):
+
+    def test_append(self):
+        history = streamexpect._TextHistory()
+        self.assertEqual(u(''), history.text())
+        for chunk in (u('alpha '), u(''), u('beta '), u('gamma')):
+            history.append(chunk)
+        self.assertEqual(16, len(history))
+        self.assertEqual(u('alpha beta gamma'), history.text())
+        self.assertEqual(u('alpha beta gamma'), history.text())
+
+    def test_discard(self):
+        history = streamexpect._TextHistory()
+        for chunk in (u('alpha '), u('beta '), u('gamma')):
+            history.append(chunk)
+        history.discard(8)
+        self.assertEqual(8, len(history))
+        self.assertEqual(u('ta gamma'), history.text())
+        history.append(u(' delta'))
+        history.discard(3)
+        self.assertEqual(u('gamma delta'), history.text())
+        history.discard(100)
+        self.assertEqual(0, len(history))
+        self.assertEqual(u(''), history.text())
+
+    def test_contents(self):
+        history = streamexpect._TextHistory()
+        for chunk in (u('alpha '), u('beta '), u('gamma')):
+            history.append(chunk)
+        history.discard(3)
+        text, start = history.contents()
+        self.assertEqual(u('alpha beta gamma'), text)
+        self.assertEqual(3, start)
+        # Discarded text is dropped once it outweighs the rest of the buffer
+        history.discard(5)
+        text, start = history.contents()
+        self.assertEqual(u('alpha beta gamma'), text)
+        self.assertEqual(8, start)
+        history.discard(1)
+        text, start = history.contents()
+        self.assertEqual(u('a gamma'), text)
+        self.assertEqual(0, start)
+
+    def test_region(self):
+        history = streamexpect._TextHistory()
+        for chunk in (u('alpha '), u('beta '), u('gamma')):
+            history.append(chunk)
+        history.discard(2)
+        # Only the chunks after the skipped text are joined
+        self.assertEqual((u('ta gamma'), 0, 6), history.region(6))
+        self.assertEqual(14, len(history))
+        self.assertEqual(u('pha beta gamma'), history.text())
+        self.assertEqual((u(''), 0, 14), history.region(20))
+        text, start, skipped = history.region(0)
+        self.assertEqual(u('pha beta gamma'), text[start:])
+        self.assertEqual(0, skipped)
+
+
+class TestSpillHistory(unittest.TestCase):
+
+    def contents(self, history):
+        buf, start = history.contents()
+        return bytes(buf[start:])
+
+    def test_spill(self):
+        history = SpillHistory(memory_limit=8)
+        history += b'alpha '
+        self.assertFalse(history.spilled)
+        self.assertEqual(b'alpha ', self.contents(history))
+        history += b'beta '
+        self.assertTrue(history.spilled)
+        history += b'gamma'
+        self.assertEqual(16, len(history))
+        self.assertEqual(b'alpha beta gamma', self.contents(history))
+        with self.assertRaises(ValueError):
+            SpillHistory(memory_limit=0)
+
+    def test_discard(self):
+        history = SpillHistory(memory_limit=8)
+        history += b'alpha beta gamma'
+        del history[:2]
+        self.assertEqual(b'pha beta gamma', self.contents(history))
+        # The file is compacted once most of it has been discarded
+        history.discard(7)
+        self.assertTrue(history.spilled)
+        self.assertEqual((b'a gamma', 0), (self.contents(history),
+                                           history.contents()[1]))
+        # Under half of the memory limit, the history is moved back
+        history += b' delta'
+        history.discard(9)
+        self.assertFalse(history.spilled)
+        self.assertEqual(b'elta', self.contents(history))
+        with self.assertRaises(TypeError):
+            del history[1:]
+
+    def test_expecter(self):
+        stream = PiecewiseStream(b'x' * 1000 + b'alpha' + b'x' * 1000 +
+                                 b'beta', max_chunk=64)
+        expecter = streamexpect.BytesExpecter(
+            PollingStreamAdapter(stream), window=4096,
+            history=SpillHistory(memory_limit=100))
+        match = expecter.expect_regex(br'alpha(x+)beta')
+        self.assertEqual(1000, len(match.groups[0]))
+        self.assertFalse(expecter._history.spilled)
+        with self.assertRaises(ValueError):
+            history = SpillHistory()
+            history += b'x'
+            streamexpect.BytesExpecter(PollingStreamAdapter(stream),
+                                       history=history)
+
+
+@unittest.skipIf(asyncio is None, 'requires asyncio')
+class TestAsyncExpecter(unittest.TestCase):
+
+    class Writer(object):
+        def __init__(self):
+            self.written = []
+            self.closed = False
+
+        def write(self, data):
+            self.written.append(data)
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, func, *args):
+        """Call *func* in the event loop and wait for the future it returns"""
+        result = self.loop.create_future()
+
+        def finish(future):
+            if future.cancelled():
+                result.cancel()
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        self.loop.call_soon(lambda: func(*args).add_done_callback(finish))
+        return self.loop.run_until_complete(result)
+
+    def feed_later(self, reader, *chunks):
+        for i, chunk in enumerate(chunks):
+            self.loop.call_later(0.01 * (i + 1), reader.feed_data, chunk)
+
+    def test_expect_bytes(self):
+        reader = asyncio.StreamReader()
+        expecter = streamexpect.wrap_async(reader)
+        self.assertTrue(isinstance(expecter, streamexpect.AsyncBytesExpecter))
+        self.feed_later(reader, b'tau io', b'ta mu')
+        match = self.run_async(expecter.expect_bytes, b'iota', 1)
+        self.assertEqual(b'iota', match.match)
+        self.assertEqual(4, match.start)
+        match = self.run_async(expecter.expect_regex, b'(m|n)u', 1)
+        self.assertEqual(1, match.start)
+        self.assertEqual((b'm',), match.groups)
+
+    def test_expect_text(self):
+        reader = asyncio.StreamReader()
+        expecter = streamexpect.wrap_async(reader, unicode=True)
+        self.assertTrue(isinstance(expecter, streamexpect.AsyncTextExpecter))
+        # The encoded character is split across reads
+        self.feed_later(reader, b'caf\xc3', b'\xa9 mu')
+        match = self.run_async(expecter.expect_text, u('caf\xe9'), 1)
+        self.assertEqual(u('caf\xe9'), match.match)
+
+    def test_timeout(self):
+        reader = asyncio.StreamReader()
+        expecter = streamexpect.wrap_async(reader)
+        with self.assertRaises(ExpectTimeout):
+            self.run_async(expecter.expect_bytes, b'mu', 0.01)
+
+    def test_end_of_stream(self):
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'alpha')
+        reader.feed_eof()
+        expecter = streamexpect.wrap_async(reader)
+        start = self.loop.time()
+        with self.assertRaises(ExpectTimeout):
+            self.run_async(expecter.expect_bytes, b'beta', 0.05)
+        self.assertTrue(self.loop.time() - start >= 0.04)
+
+    def test_cancel_keeps_data(self):
+        reader = asyncio.StreamReader()
+        expecter = streamexpect.wrap_async(reader)
+
+        def expect_and_cancel():
+            future = expecter.expect_bytes(b'beta')
+            self.loop.call_soon(future.cancel)
+            return future
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_async(expect_and_cancel)
+        reader.feed_data(b'alpha beta')
+        match = self.run_async(expecter.expect_bytes, b'beta', 1)
+        self.assertEqual(6, match.start)
+
+    def test_cancel_keeps_read_data(self):
+        reader = asyncio.StreamReader()
+        expecter = streamexpect.wrap_async(reader)
+
+        def expect_and_cancel():
+            # The data is read before the cancellation reaches the read
+            future = expecter.expect_bytes(b'abczz')
+            reader.feed_data(b'abc')
+            future.cancel()
+            return future
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_async(expect_and_cancel)
+        reader.feed_data(b'zz')
+        match = self.run_async(expecter.expect_bytes, b'abczz', 1)
+        self.assertEqual(0, match.start)
+
+    def test_collect_stats(self):
+        reader = asyncio.StreamReader()
+        expecter = streamexpect.wrap_async(reader)
+        expecter.collect_stats = True
+        self.feed_later(reader, b'xxal', b'pha')
+        self.run_async(expecter.expect_bytes, b'alpha', 1)
+        stats = expecter.last_stats
+        self.assertEqual((2, 7, 11, True), (stats.polls, stats.received,
+                                            stats.scanned, stats.matched))
+        self.assertTrue(stats.wall_time >= stats.poll_time + stats.search_time)
+        # Stats are recorded for calls that time out
+        with self.assertRaises(ExpectTimeout):
+            self.run_async(expecter.expect_bytes, b'beta', 0.01)
+        stats = expecter.last_stats
+        self.assertEqual((1, 0, False), (stats.polls, stats.received,
+                                         stats.matched))
+
+    def collect(self, matches):
+        """Return a future resolving to the list of items of *matches*"""
+        result = self.loop.create_future()
+        found = []
+
+        def step(future=None):
+            if future is not None:
+                if isinstance(future.exception(), StopAsyncIteration):
+                    result.set_result(found)
+                    return
+                found.append(future.result())
+            matches.__anext__().add_done_callback(step)
+        step()
+        return result
+
+    def test_iter_matches(self):
+        reader = asyncio.StreamReader()
+        expecter = streamexpect.wrap_async(reader)
+        self.feed_later(reader, b'id=1 id=', b'22 junk', b' id=333 id=4')
+        matches = expecter.iter_matches(RegexSearcher(br'id=(\d+) '),
+                                        idle_timeout=0.05)
+        self.assertTrue(matches.__aiter__() is matches)
+        found = self.run_async(self.collect, matches)
+        self.assertEqual([(b'1',), (b'22',), (b'333',)],
+                         [x.groups for x in found])
+        # Data after the last match is kept for the next search
+        match = self.run_async(expecter.expect_bytes, b'id=4', 0)
+        self.assertEqual(0, match.start)
+        # Empty matches don't stop the iteration from moving on
+        reader.feed_data(b'a12')
+        matches = expecter.iter_matches(RegexSearcher(br'[0-9]*'),
+                                        timeout=0.05, idle_timeout=None)
+        self.assertEqual([b'', b'12', b''],
+                         [x.match for x in self.run_async(self.collect,
+                                                          matches)])
+        with self.assertRaises(ValueError):
+            expecter.iter_matches(RegexSearcher(b'a'), idle_timeout=None)
+
+    def test_concurrent(self):
+        readers = [asyncio.StreamReader() for _ in range(100)]
+        expecters = [streamexpect.wrap_async(x) for x in readers]
+        for i, reader in enumerate(readers):
+            self.feed_later(reader, b'session ', str(i).encode('ascii'))
+        matches = self.run_async(lambda: asyncio.gather(*[
+            x.expect_regex(br'session (\d+)', 1) for x in expecters]))
+        self.assertEqual([str(i).encode('ascii') for i in range(100)],
+                         [x.groups[0] for x in matches])
+
+    def test_writer(self):
+        writer = TestAsyncExpecter.Writer()
+        expecter = streamexpect.wrap_async(asyncio.StreamReader(), writer)
+        expecter.write(b'alpha')
+        self.assertEqual([b'alpha'], writer.written)
+        self.assertTrue(self.run_async(expecter.__aenter__) is expecter)
+        self.run_async(expecter.__aexit__, None, None, None)
+        self.assertTrue(writer.closed)
+
+    def test_bad_max_read(self):
+        with self.assertRaises(ValueError):
+            AsyncStreamAdapter(asyncio.StreamReader(), max_read=0)
+
 
 class TestWrapper(unittest.TestCase):
 
@@ -456,9 +2152,48 @@ class TestWrapper(unittest.TestCase):
             match = wrapper.expect_bytes(b'iota')
             self.assertTrue(match is not None)
             self.assertEqual(b'iota', match.match)
+            self.assertTrue(type(match.match) is six.binary_type)
+        finally:
+            source.close()
+            drain.close()
+
+    def test_adapter_selection(self):
+        source, drain = socket.socketpair()
+        try:
+            wrapper = streamexpect.wrap(drain)
+            self.assertTrue(isinstance(wrapper.stream_adapter,
+                                       SelectorStreamAdapter))
         finally:
             source.close()
             drain.close()
+        wrapper = streamexpect.wrap(PiecewiseStream(b'tau'))
+        self.assertTrue(isinstance(wrapper.stream_adapter,
+                                   PollingStreamAdapter))
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires selectable pipes')
+    def test_adapter_selection_pipes(self):
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb', 0) as stream:
+            wrapper = streamexpect.wrap(stream)
+            self.assertTrue(isinstance(wrapper.stream_adapter,
+                                       SelectorStreamAdapter))
+            # Buffered streams hold data that waiting on them would not see
+            with os.fdopen(os.dup(read_fd), 'rb') as buffered:
+                wrapper = streamexpect.wrap(buffered)
+                self.assertTrue(isinstance(wrapper.stream_adapter,
+                                           PollingStreamAdapter))
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires selectable pipes')
+    def test_wrap_fd(self):
+        read_fd, write_fd = os.pipe()
+        with streamexpect.wrap_fd(read_fd, unicode=True,
+                                  write_fd=write_fd) as wrapper:
+            wrapper.write(u('tau iota mu'))
+            match = wrapper.expect_text(u('iota'))
+            self.assertEqual(u('iota'), match.match)
+        with self.assertRaises(OSError):
+            os.fstat(read_fd)
 
     def test_expect_text(self):
         stream = PiecewiseStream(u('tau iota mu'), max_chunk=3)
@@ -467,6 +2202,16 @@ class TestWrapper(unittest.TestCase):
         self.assertTrue(match is not None)
         self.assertEqual(u('iota'), match.match)
 
+    def test_expect_text_offsets_after_match(self):
+        stream = PiecewiseStream(u('tau iota mu nu'), max_chunk=3)
+        wrapper = streamexpect.wrap(stream, unicode=True)
+        wrapper.expect_text(u('iota'))
+        match = wrapper.expect_regex(u('^ mu'))
+        self.assertEqual(0, match.start)
+        self.assertEqual(3, match.end)
+        match = wrapper.expect_text(u('nu'))
+        self.assertEqual(1, match.start)
+
     def test_expect_bytes_twice_on_one_buffer(self):
         source, drain = socket.socketpair()
         try:
@@ -498,6 +2243,16 @@ class TestWrapper(unittest.TestCase):
             source.close()
             drain.close()
 
+    def test_expect_bytes_with_trimmed_unconsumed_data(self):
+        stream = ChunkedStream([b'abcdefgh', b'ij', b'k', b'lm'])
+        wrapper = streamexpect.wrap(stream, unicode=False, window=8)
+        match = wrapper.expect_bytes(b'jk')
+        self.assertEqual(b'jk', match.match)
+        with self.assertRaises(ExpectTimeout):
+            wrapper.expect_bytes(b'f', timeout=0)
+        match = wrapper.expect_bytes(b'm')
+        self.assertEqual(1, match.start)
+
     def test_expect_text_twice(self):
         stream = PiecewiseStream(u('tau iota mu'), max_chunk=3)
         wrapper = streamexpect.wrap(stream, unicode=True)
@@ -518,6 +2273,24 @@ class TestWrapper(unittest.TestCase):
         self.assertTrue(match is not None)
         self.assertEqual(u('mu'), match.match)
         
+    def test_expect_text_with_trimmed_unconsumed_data(self):
+        stream = ChunkedStream([u('abcdefgh'), u('ij'), u('k')])
+        wrapper = streamexpect.wrap(stream, unicode=True, window=8)
+        match = wrapper.expect_text(u('jk'))
+        self.assertEqual(u('jk'), match.match)
+        # Everything up to the match has been consumed
+        with self.assertRaises(ExpectTimeout):
+            wrapper.expect_text(u('f'), timeout=0)
+
+    def test_expect_text_twice_after_normalized_text(self):
+        ligature = six.unichr(0xFB01)
+        stream = PiecewiseStream(ligature * 4 + u(' alpha beta'), max_chunk=3)
+        wrapper = streamexpect.wrap(stream, unicode=True)
+        match = wrapper.expect_text(u('alpha'))
+        self.assertEqual(5, match.start)
+        match = wrapper.expect_text(u('beta'))
+        self.assertEqual(u('beta'), match.match)
+
     def test_expect_unicode_regex(self):
         stream = PiecewiseStream(u('pi epsilon mu'), max_chunk=3)
         wrapper = streamexpect.wrap(stream, unicode=True)
@@ -558,3 +2331,203 @@ class TestWrapper(unittest.TestCase):
     def test_unhandled_type(self):
         with self.assertRaises(TypeError):
             streamexpect.wrap(b'')
+
+
+@unittest.skipIf(sys.platform == 'win32', 'requires pseudo-terminals')
+class TestSpawn(unittest.TestCase):
+
+    def python(self, code, **kwargs):
+        return streamexpect.spawn([sys.executable, '-c', code], **kwargs)
+
+    def test_interact(self):
+        code = ('import sys\n'
+                'sys.stdout.write("name? ")\n'
+                'sys.stdout.flush()\n'
+                'print(sys.stdin.readline().strip()[::-1])\n')
+        with self.python(code) as expecter:
+            expecter.expect_bytes(b'name? ', timeout=5)
+            expecter.write(b'alpha\n')
+            self.assertEqual(b'ahpla', expecter.expect_bytes(b'ahpla',
+                                                             timeout=5).match)
+            self.assertEqual(0, expecter.wait(5))
+            # The end of the terminal is reached once the process exits
+            with self.assertRaises(ExpectTimeout):
+                expecter.expect_bytes(b'beta', timeout=0.01)
+
+    def test_unicode(self):
+        code = 'print(u"caf\\u00e9")'
+        with self.python(code, unicode=True,
+                         env=dict(os.environ, PYTHONIOENCODING='utf-8')) \
+                as expecter:
+            match = expecter.expect_text(u('caf\u00e9'), timeout=5)
+            self.assertEqual(u('caf\u00e9'), match.match)
+
+    def test_controlling_terminal(self):
+        # Opening /dev/tty fails without a controlling terminal
+        code = ('import os\n'
+                'with open("/dev/tty", "w") as tty:\n'
+                '    tty.write("%d %d\\n" % (os.getsid(0), os.getpid()))\n')
+        with self.python(code) as expecter:
+            match = expecter.expect_regex(br'(\d+) (\d+)', timeout=5)
+            self.assertEqual(match.groups[0], match.groups[1])
+            self.assertEqual(0, expecter.wait(5))
+
+    def test_program_lookup(self):
+        path, name = os.path.split(sys.executable)
+        with streamexpect.spawn([name, '-c', 'print(6 * 7)'],
+                                env=dict(os.environ, PATH=path)) as expecter:
+            expecter.expect_bytes(b'42', timeout=5)
+        with self.assertRaises(OSError):
+            streamexpect.spawn(['streamexpect-no-such-program'])
+
+    def test_close_stops_process(self):
+        code = ('import signal, time\n'
+                'signal.signal(signal.SIGHUP, signal.SIG_IGN)\n'
+                'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+                'print("ready")\n'
+                'time.sleep(30)\n')
+        expecter = self.python(code)
+        expecter.expect_bytes(b'ready', timeout=5)
+        with self.assertRaises(ExpectTimeout):
+            expecter.wait(0.01)
+        self.assertEqual(-signal.SIGKILL, expecter.close(timeout=0.05))
+
+
+class TestScanFile(unittest.TestCase):
+
+    def capture(self, data):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def scan(self, data, searcher, **kwargs):
+        matches = streamexpect.scan_file(self.capture(data), searcher,
+                                         **kwargs)
+        return [(x.start, x.end, x.match) for x in matches]
+
+    def test_chunk_boundaries(self):
+        data = b'aaab aab ab aaaab'
+        searcher = RegexSearcher(br'a+b')
+        expected = [(0, 4, b'aaab'), (5, 8, b'aab'), (9, 11, b'ab'),
+                    (12, 17, b'aaaab')]
+        for chunk_size in (1, 2, 3, 5, 100):
+            self.assertEqual(expected, self.scan(data, searcher, workers=1,
+                                                 chunk_size=chunk_size))
+
+    def test_overlapping_matches(self):
+        # Chunks searched from their start would find "aa" at 1 and 3, but
+        # the search resumes after the match that straddles the boundary
+        searcher = BytesSearcher(b'aa')
+        self.assertEqual([(0, 2, b'aa'), (2, 4, b'aa')],
+                         self.scan(b'aaaaa', searcher, workers=1,
+                                   chunk_size=1))
+
+    def test_collection(self):
+        alpha = BytesSearcher(b'alpha')
+        beta = RegexSearcher(br'be(ta)')
+        path = self.capture(b'beta alpha beta')
+        matches = streamexpect.scan_file(path, SearcherCollection(alpha, beta),
+                                         workers=1, chunk_size=4)
+        self.assertEqual([beta, alpha, beta], [x.searcher for x in matches])
+        self.assertEqual([11, 15], [matches[2].start, matches[2].end])
+        self.assertEqual((b'ta',), matches[2].groups)
+
+    def test_unsplittable_searchers(self):
+        data = b'ab\nab\nab'
+        self.assertEqual([(0, 8, data)],
+                         self.scan(data, RegexSearcher(br'a.*b', re.DOTALL),
+                                   workers=1, chunk_size=1))
+        self.assertEqual([(0, 2, b'ab'), (3, 5, b'ab'), (6, 8, b'ab')],
+                         self.scan(data, RegexSearcher(br'^ab', re.M),
+                                   workers=1, chunk_size=1))
+
+    def test_anchors(self):
+        # Anchors see the data before each match, as re.finditer does
+        data = b'hello world foo'
+        self.assertEqual([x.start() for x in re.finditer(br'\b', data)],
+                         [x[0] for x in self.scan(data, RegexSearcher(br'\b'),
+                                                  workers=1)])
+        self.assertEqual([(0, 3, b'foo')],
+                         self.scan(b'foofoo', RegexSearcher(br'\bfoo'),
+                                   workers=1))
+
+    def test_workers(self):
+        data = b''.join(b'line %d\n' % x for x in range(1000))
+        searcher = RegexSearcher(br'line \d{0,2}7\n')
+        matches = self.scan(data, searcher, workers=2, chunk_size=512)
+        self.assertEqual(100, len(matches))
+        self.assertEqual(self.scan(data, searcher, workers=1), matches)
+
+    def test_bad_arguments(self):
+        self.assertEqual([], self.scan(b'', BytesSearcher(b'a')))
+        with self.assertRaises(TypeError):
+            self.scan(b'a', TextSearcher(u('a')))
+        with self.assertRaises(ValueError):
+            self.scan(b'a', BytesSearcher(b'a'), chunk_size=0)
+
+
+class TestTranscriptSink(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def test_batching(self):
+        with TranscriptSink(self.path('log'), flush_interval=None) as sink:
+            sink(b'alpha ')
+            buf = bytearray(b'beta ')
+            sink(buf)
+            # Buffers are copied, as the caller may change them
+            buf[:] = b'xxxx'
+            sink(u('gamma \u00e9'))
+            self.assertEqual(b'', self.read('log'))
+        self.assertEqual(u('alpha beta gamma \u00e9').encode('utf-8'),
+                         self.read('log'))
+        with self.assertRaises(ValueError):
+            sink(b'delta')
+
+    def test_buffer_size(self):
+        sink = TranscriptSink(self.path('log'), flush_interval=None,
+                              buffer_size=4)
+        try:
+            sink(b'alpha')
+            # The thread writes the data once the buffer is full
+            end = time.time() + 5
+            while not self.read('log') and time.time() < end:
+                time.sleep(0.01)
+            self.assertEqual(b'alpha', self.read('log'))
+        finally:
+            sink.close()
+
+    def test_rotation(self):
+        with TranscriptSink(self.path('{session}-{pid}.log'), max_bytes=4,
+                            backup_count=2) as sink:
+            sink(b'alpha beta')
+        self.assertTrue(sink.path.endswith('-%d.log' % os.getpid()))
+        name = os.path.basename(sink.path)
+        self.assertEqual([b'ta', b'a be', b'alph'],
+                         [self.read(x) for x in (name, name + '.1',
+                                                 name + '.2')])
+        self.assertFalse(os.path.exists(self.path(name + '.3')))
+
+    def test_wrap(self):
+        stream = PiecewiseStream(b'tau iota mu', max_chunk=3)
+        with TranscriptSink(self.path('log')) as sink:
+            wrapper = streamexpect.wrap(stream, transcript=sink)
+            wrapper.expect_bytes(b'mu')
+        self.assertEqual(b'tau iota mu', self.read('log'))
+
+    def test_bad_arguments(self):
+        for kwargs in ({'flush_interval': 0}, {'buffer_size': 0},
+                       {'max_bytes': 0}):
+            with self.assertRaises(ValueError):
+                TranscriptSink(io.BytesIO(), **kwargs)